@@ -1,97 +1,235 @@
-import json
 import os
+import json
+import base64
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime as dt
 
 import boto3
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# Clients are created lazily once per container and reused by all the (warm) invocations
+_clients = {}
+_executor = ThreadPoolExecutor(max_workers=4)
+
+
+def get_detections_table():
+    if 'detections' not in _clients:
+        _clients['detections'] = boto3.resource('dynamodb', endpoint_url=os.environ.get('DYNAMODB_ENDPOINT_URL')).Table('detections')
+
+    return _clients['detections']
+
+
+def get_s3():
+    if 's3' not in _clients:
+        _clients['s3'] = boto3.client('s3', endpoint_url=os.environ.get('S3_ENDPOINT_URL'))
+
+    return _clients['s3']
+
+
+def get_iot_data():
+    if 'iot-data' not in _clients:
+        _clients['iot-data'] = boto3.client('iot-data', region_name='us-east-1', endpoint_url=os.environ.get('IOT_DATA_ENDPOINT_URL'))
+
+    return _clients['iot-data']
+
 
 def lambda_handler(event, context):
     print(f"Received {event}")
+    event = decode_event(event)
+
+    # Reports coalesced by the device arrive as one batch message. They share a timestamp, so each one gets its index in the batch
+    if 'batch' in event:
+        now = dt.now()
+        records = [create_record(report, now, batch_index) for batch_index, report in enumerate(event['batch'])]
+    else:
+        records = [create_record(event)]
+
+    # Save records in DynamoDB, concurrently with preparing the upload urls and publishing them back to the device
+    # (the device needs a few round trips to upload a frame, so the record is saved long before detectf needs it)
+    if len(records) == 1:
+        save_future = _executor.submit(save_dynamo_db, records[0])
+    else:
+        save_future = _executor.submit(save_dynamo_db_batch, records)
+
+    for record in records:
+        handle_record(record)
+
+    save_future.result()
+
 
-    # Save record in DynamoDB
-    record = create_record(event)
-    save_dynamo_db(record)
+def decode_event(event):
+    """
+    Devices publish json or msgpack reports. To accept both, the IoT rule passes the raw payload base64 encoded:
+    SELECT encode(*, 'base64') AS payload FROM 'report/detection'
+    Events of a plain json rule (SELECT * FROM 'report/detection') are used as is.
+    """
+    if set(event.keys()) != {'payload'}:
+        return event
 
+    payload = base64.b64decode(event['payload'])
+    if payload[:1] == b'{':
+        return json.loads(payload)
+    if msgpack is None:
+        raise ValueError("Got a msgpack report, but the msgpack package isn't deployed with this function")
+
+    return msgpack.unpackb(payload, raw=False)
+
+
+def handle_record(record):
     # Prepare s3 image file upload details and send the topic back to device
     body = {
         'month': record['month'],
         'report_time': record['report_time'],
-        'frame_upload': {},
-        'frame_features_upload': {}
-    }
-    fill_image_upload_url(body, record['s3_frame']['s3_filepath'], 'frame_upload')
-    fill_image_upload_url(body, record['s3_frame_features']['s3_filepath'], 'frame_features_upload')
-    publish_topic(f"to/device/{event['client_id']}", body)
-
-
-def fill_image_upload_url(body, filepath, out_key):
-    presigned_image_url, s3_bucket, s3_image_path = create_upload_url(filepath)
-    body[out_key] = {
-        'upload_url': presigned_image_url,
-        'bucket': s3_bucket,
-        'image_path': s3_image_path,
     }
+    if 'camera_id' in record:
+        # Lets a multi camera device route the reply to the camera that reported
+        body['camera_id'] = record['camera_id']
+    if 'report_id' in record:
+        # Lets the device match the reply with the frames of the report (replies of a batch may arrive in any order)
+        body['report_id'] = record['report_id']
+    fill_frame_upload_urls(body, record)
+
+    # Upload urls of the rest of the reported frames, in the order of the report's frames
+    more_frames_upload = []
+    for more_frame in record.get('s3_more_frames', []):
+        urls = {}
+        fill_frame_upload_urls(urls, more_frame)
+        more_frames_upload.append(urls)
+    if more_frames_upload:
+        body['more_frames_upload'] = more_frames_upload
+
+    publish_topic(f"to/device/{record['client_id']}", body)
+
+
+def fill_frame_upload_urls(body, frame_filepaths):
+    """
+    frame_filepaths - The S3 files of a frame (see create_frame_filepaths)
+    """
+    fill_image_upload_urls(body, {
+        'frame_upload': frame_filepaths['s3_frame']['s3_filepath'],
+        'frame_features_upload': frame_filepaths['s3_frame_features']['s3_filepath']
+    })
+
+    # Crops of the frame (devices in the crops upload mode) are uploaded under their own keys
+    crops = frame_filepaths.get('s3_crops', [])
+    if crops:
+        crops_upload = {}
+        fill_image_upload_urls(crops_upload, {j: crop['s3_filepath'] for j, crop in enumerate(crops)})
+        body['crops_upload'] = [crops_upload[j] for j in range(len(crops))]
+
+
+def fill_image_upload_urls(body, filepaths):
+    """
+    filepaths - A dict of body key -> S3 file path
+    """
+    for out_key, (presigned_image_url, s3_bucket, s3_image_path) in zip(filepaths.keys(), create_upload_urls(filepaths.values())):
+        body[out_key] = {
+            'upload_url': presigned_image_url,
+            'bucket': s3_bucket,
+            'image_path': s3_image_path,
+        }
 
 
-def create_record(event):
-    now = dt.now()
+def create_record(event, now=None, batch_index=None):
+    # A single timestamp for the whole record
+    now = now or dt.now()
     report_time = f"{now.day:02}_{now.hour:02}_{now.minute:02}_{now.second:02}_{now.microsecond}"
-    s3_filename = f"{report_time}.jpg"
-    s3_filepath = f"{dt.now().year}/{dt.now().month:02}/{s3_filename}"
-    s3_features_filename = f"{report_time}_features.jpg"
-    s3_features_filepath = f"{dt.now().year}/{dt.now().month:02}/{s3_features_filename}"
+    if batch_index is not None:
+        # Unique within the batch, so no report of the batch overwrites another one
+        report_time = f"{report_time}_{batch_index}"
+    # Devices may upload webp instead of jpeg
+    extension = 'webp' if event.get('image_format') == 'webp' else 'jpg'
+    # Amount of crops of each reported frame (devices in the crops upload mode)
+    crops = [frame.get('crops', 0) for frame in event.get('frames', [])] or [0]
 
     record = {
         **event,
         'month': f"{now.year}_{now.month}",  # DynamoDB Partition Key
         'report_time': report_time,  # DynamoDB Sort Key
+        **create_frame_filepaths(now, report_time, extension, crops[0])
+    }
+
+    # The first frame of the report is the frame above, the rest of the reported frames (if any) get their own files
+    if len(crops) > 1:
+        record['s3_more_frames'] = [create_frame_filepaths(now, f"{report_time}__frame{i}", extension, crops[i])
+                                    for i in range(1, len(crops))]
+
+    return record
+
+
+def create_frame_filepaths(now, frame_name, extension='jpg', crops=0):
+    s3_filename = f"{frame_name}.{extension}"
+    s3_features_filename = f"{frame_name}_features.{extension}"
+
+    filepaths = {
         's3_frame': {
             's3_filename': s3_filename,
-            's3_filepath': s3_filepath
+            's3_filepath': f"{now.year}/{now.month:02}/{s3_filename}"
         },
         's3_frame_features': {
             's3_filename': s3_features_filename,
-            's3_filepath': s3_features_filepath
+            's3_filepath': f"{now.year}/{now.month:02}/{s3_features_filename}"
         }
     }
+    if crops:
+        crop_filenames = [f"{frame_name}__crop{j}.{extension}" for j in range(crops)]
+        filepaths['s3_crops'] = [{
+            's3_filename': crop_filename,
+            's3_filepath': f"{now.year}/{now.month:02}/{crop_filename}"
+        } for crop_filename in crop_filenames]
 
-    return record
+    return filepaths
 
 
 def save_dynamo_db(record):
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table('detections')
-    response = table.put_item(Item=record)
+    response = get_detections_table().put_item(Item=record)
 
     return response
 
 
-def create_upload_url(s3_image_path):
-    s3_client = boto3.client('s3')
+def save_dynamo_db_batch(records):
+    # The batch writer groups the puts into BatchWriteItem calls (and resends unprocessed items).
+    # The role of this Lambda needs dynamodb:BatchWriteItem on the detections table (detectf doesn't).
+    # Records of a batch have unique keys (see create_record), so none of them is dropped
+    with get_detections_table().batch_writer() as batch:
+        for record in records:
+            batch.put_item(Item=record)
+
+
+def create_upload_urls(s3_image_paths):
+    s3_client = get_s3()
 
     # AWS Bucket
     s3_bucket = os.environ['BUCKET_NAME']
 
-    # Generate presigned product image urls:
-    presigned_image_url = s3_client.generate_presigned_post(
-        Bucket=s3_bucket,
-        Key=s3_image_path,
-        Fields={"acl": "private", "Content-Type": "jpeg"},
-        Conditions=[
-            {"acl": "private"},
-            {"Content-Type": "jpeg"}
-        ],
-        ExpiresIn=3600
-    )
+    # Generate presigned product image urls (signed locally, no round trip to S3):
+    results = []
+    for s3_image_path in s3_image_paths:
+        content_type = 'image/webp' if s3_image_path.endswith('.webp') else 'jpeg'
+        presigned_image_url = s3_client.generate_presigned_post(
+            Bucket=s3_bucket,
+            Key=s3_image_path,
+            Fields={"acl": "private", "Content-Type": content_type},
+            Conditions=[
+                {"acl": "private"},
+                {"Content-Type": content_type}
+            ],
+            ExpiresIn=3600
+        )
 
-    print(f"presigned_image_url: {presigned_image_url}")
+        print(f"presigned_image_url: {presigned_image_url}")
+        results.append((presigned_image_url, s3_bucket, s3_image_path))
 
-    return presigned_image_url, s3_bucket, s3_image_path
+    return results
 
 
 def publish_topic(topic, message):
-    client = boto3.client('iot-data', region_name='us-east-1')
-    response = client.publish(
+    response = get_iot_data().publish(
         topic=topic,
         qos=1,
         payload=json.dumps(message)
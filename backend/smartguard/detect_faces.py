@@ -5,10 +5,10 @@ except ImportError:
 
 
 # Needed for detection and embeddings extraction
-import io
 import re
 import json
 import boto3
+from botocore.exceptions import ClientError
 import imutils
 import cv2
 import os
@@ -16,80 +16,184 @@ import logging
 import numpy as np
 import pickle
 
+from face_index import FaceIndex
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+CONFIG = {
+    'bucket': 'smart-guard-files',
+    'detector': 'models/face_detection_model',
+    'embedding_model': 'models/embeddings/openface_nn4.small2.v1.t7',
+    'recognizer_model': 'models/recognizer/recognizer.pickle',
+    'le': 'models/recognizer/le.pickle',
+    'embeddings': 'models/embeddings/embeddings.pickle',
+    # index - Nearest neighbours over the embeddings (no sklearn needed), svm - The trained sklearn recognizer
+    'recognition_engine': os.environ.get('RECOGNITION_ENGINE', 'index'),
+    'confidence': 0.3,
+    # Set to use local DynamoDB / S3 stand-ins (e.g. DynamoDB Local, MinIO)
+    'dynamodb_endpoint_url': os.environ.get('DYNAMODB_ENDPOINT_URL'),
+    's3_endpoint_url': os.environ.get('S3_ENDPOINT_URL')
+}
+
+# Models and clients are loaded lazily once per container and reused by all the (warm) invocations
+_models = {}
+_clients = {}
+
+
+def get_models():
+    if not _models:
+        # load our serialized face detector from disk
+        logger.info("loading face detector...")
+        protoPath = os.path.sep.join([CONFIG["detector"], "deploy.prototxt"])
+        modelPath = os.path.sep.join([CONFIG["detector"], "res10_300x300_ssd_iter_140000.caffemodel"])
+        _models['detector'] = cv2.dnn.readNetFromCaffe(protoPath, modelPath)
+
+        # load our serialized face embedding model from disk
+        logger.info("loading face recognizer...")
+        _models['embedder'] = cv2.dnn.readNetFromTorch(CONFIG["embedding_model"])
+
+        if CONFIG['recognition_engine'] == 'svm':
+            # load the actual face recognition model along with the label encoder (unpickling them imports sklearn)
+            with open(CONFIG["recognizer_model"], "rb") as f:
+                _models['recognizer'] = pickle.loads(f.read())
+            with open(CONFIG["le"], "rb") as f:
+                _models['le'] = pickle.loads(f.read())
+        else:
+            _models['face_index'] = FaceIndex.from_embeddings_pickle(CONFIG['embeddings'])
+
+    return _models
+
+
+def get_s3():
+    if 's3' not in _clients:
+        _clients['s3'] = boto3.client('s3', endpoint_url=CONFIG['s3_endpoint_url'])
+
+    return _clients['s3']
+
+
+def get_detections_table():
+    if 'detections' not in _clients:
+        _clients['detections'] = boto3.resource('dynamodb', endpoint_url=CONFIG['dynamodb_endpoint_url']).Table('detections')
+
+    return _clients['detections']
+
 
 def handler(event, context):
     logger.info("Starting")
     logger.info(event)
 
-    args = {
-        'bucket': 'smart-guard-files',
-        's3_image_filepath':  event['Records'][0]['s3']['object']['key'],
-        'local_image_filepath': '/tmp/image.jpg',
-        'detector': 'models/face_detection_model',
-        'embedding_model': 'models/embeddings/openface_nn4.small2.v1.t7',
-        'recognizer_model': 'models/recognizer/recognizer.pickle',
-        'le': 'models/recognizer/le.pickle',
-        'confidence': 0.3
-    }
+    # Handle all the records of the event (a notification may hold several objects)
+    images = load_images([record['s3']['object']['key'] for record in event.get('Records', [])])
+    if not images:
+        return
 
-    if any(txt in args['s3_image_filepath'] for txt in ['features', 'recognition']):
-        logger.info(f"Skipping file {args['s3_image_filepath']}")
+    models = get_models()
+
+    # Detect the faces of all the images, then embed and classify all of them at once
+    faces = detect_faces(models['detector'], images)
+    recognize_faces(models, faces)
+
+    dynamo_updates = []
+    for s3_image_filepath, image in images.items():
+        recognition_resuls = {}
+        for face in faces:
+            if face['key'] == s3_image_filepath:
+                # draw the bounding box of the face along with the associated
+                # probability
+                recognition_resuls[face['name']] = {
+                    'probability': int(face['proba'] * 100),
+                    'start_x': face['start_x'],
+                    'start_y': face['start_y'],
+                    'end_x': face['end_x'],
+                    'end_y': face['end_y']
+                }
+
+        if not recognition_resuls:
+            logger.info(f"Didn't find any recognition results in {s3_image_filepath}")
+
+        month, report_time, frame_index, crop_index = parse_key(s3_image_filepath)
+        dynamo_updates.append((to_dynamo_month(month), report_time, recognition_resuls, recognitions_attribute(frame_index, crop_index)))
+
+        if recognition_resuls:
+            # Choose best result
+            best_recognition_key = max(recognition_resuls, key=lambda k: recognition_resuls[k]['probability'])
+            best_recognition = recognition_resuls[best_recognition_key]
+            logger.info(f"Recognition Results: {recognition_resuls}.\nBest: {best_recognition_key}")
+
+            frame_name = f"{report_time}__frame{frame_index}" if frame_index else report_time
+            if crop_index is not None:
+                frame_name += f"__crop{crop_index}"
+            upload_recognitions_image(image, best_recognition_key, best_recognition, month, frame_name)
+
+    # Write the recognitions of all the records together
+    if len(dynamo_updates) == 1:
+        update_dynamo(*dynamo_updates[0])
+    elif dynamo_updates:
+        update_dynamo_many(dynamo_updates)
+
+
+def load_images(s3_image_filepaths):
+    """
+    Download and decode the images of the given keys. Returns a dict of key -> image (resized to a width of 600 pixels)
+    """
+    images = {}
+    for s3_image_filepath in s3_image_filepaths:
+        if any(txt in s3_image_filepath for txt in ['features', 'recognition']):
+            logger.info(f"Skipping file {s3_image_filepath}")
+            continue
 
-        return
-    
-    logger.info(f"Handling S3 image file {args['s3_image_filepath']}")
-
-    # load our serialized face detector from disk
-    logger.info("loading face detector...")
-    protoPath = os.path.sep.join([args["detector"], "deploy.prototxt"])
-    modelPath = os.path.sep.join([args["detector"], "res10_300x300_ssd_iter_140000.caffemodel"])
-    detector = cv2.dnn.readNetFromCaffe(protoPath, modelPath)
-
-    # load our serialized face embedding model from disk
-    logger.info("loading face recognizer...")
-    embedder = cv2.dnn.readNetFromTorch(args["embedding_model"])
-
-    # load the actual face recognition model along with the label encoder
-    recognizer = pickle.loads(open(args["recognizer_model"], "rb").read())
-    le = pickle.loads(open(args["le"], "rb").read())
-
-    # load the image, resize it to have a width of 600 pixels (while maintaining the aspect ratio), and then grab the image dimensions
-    logger.info(f"Downloading file from s3://{args['bucket']}/{args['s3_image_filepath']}")
-    s3 = boto3.client('s3')
-    try:
-        s3.download_file(args['bucket'], args['s3_image_filepath'], args['local_image_filepath'])
-    except Exception:
-        logger.exception("")
-        return
-    logger.info("Downloaded file successfully")
+        logger.info(f"Handling S3 image file {s3_image_filepath}")
+
+        # load the image, resize it to have a width of 600 pixels (while maintaining the aspect ratio), and then grab the image dimensions
+        logger.info(f"Downloading file from s3://{CONFIG['bucket']}/{s3_image_filepath}")
+        try:
+            image = download_image(CONFIG['bucket'], s3_image_filepath)
+        except Exception:
+            logger.exception("")
+            continue
+        logger.info("Downloaded file successfully")
 
-    image = cv2.imread(args['local_image_filepath'])
-    image = imutils.resize(image, width=600)
-    (h, w) = image.shape[:2]
+        image = imutils.resize(image, width=600)
+        (h, w) = image.shape[:2]
+        logger.info(f"Image size - h: {h}, w: {w}")
 
-    logger.info(f"Image size - h: {h}, w: {w}")
+        images[s3_image_filepath] = image
 
-    # construct a blob from the image
-    image_blob = cv2.dnn.blobFromImage(cv2.resize(image, (300, 300)), 1.0, (300, 300), (104.0, 177.0, 123.0), swapRB=False, crop=False)
+    return images
+
+
+def detect_faces(detector, images):
+    """
+    Localize the faces of all the images in one forward pass of the detector.
+    Returns a list of dicts with the image key, the face ROI and its bounding box
+    """
+    keys = list(images.keys())
+
+    # construct a blob from the images
+    images_blob = cv2.dnn.blobFromImages([cv2.resize(images[key], (300, 300)) for key in keys], 1.0, (300, 300), (104.0, 177.0, 123.0),
+                                         swapRB=False, crop=False)
 
     # apply OpenCV's deep learning-based face detector to localize
-    # faces in the input image
-    detector.setInput(image_blob)
+    # faces in the input images
+    detector.setInput(images_blob)
     detections = detector.forward()
-    recognition_resuls = {}
 
-    # loop over the detections
+    faces = []
+
+    # loop over the detections. The first column of a detection is the index of its image in the batch
     for i in range(0, detections.shape[2]):
         # extract the confidence (i.e., probability) associated with the
         # prediction
         confidence = detections[0, 0, i, 2]
 
         # filter out weak detections
-        if confidence > args["confidence"]:
-            logger.info(f"Found high confidence: {confidence}. Conf confidence: {args['confidence']}")
+        if confidence > CONFIG["confidence"]:
+            logger.info(f"Found high confidence: {confidence}. Conf confidence: {CONFIG['confidence']}")
+
+            key = keys[int(detections[0, 0, i, 0])]
+            image = images[key]
+            (h, w) = image.shape[:2]
 
             # compute the (x, y)-coordinates of the bounding box for the
             # face
@@ -104,80 +208,141 @@ def handler(event, context):
             if fW < 20 or fH < 20:
                 continue
 
-            # construct a blob for the face ROI, then pass the blob
-            # through our face embedding model to obtain the 128-d
-            # quantification of the face
-            faceBlob = cv2.dnn.blobFromImage(face, 1.0 / 255, (96, 96), (0, 0, 0), swapRB=True, crop=False)
-            embedder.setInput(faceBlob)
-            vec = embedder.forward()
+            faces.append({'key': key, 'face': face, 'start_x': startX, 'start_y': startY, 'end_x': endX, 'end_y': endY})
 
-            logger.debug(f"Found vec: {vec}")
+    return faces
 
-            # perform classification to recognize the face
-            preds = recognizer.predict_proba(vec)[0]
-            j = np.argmax(preds)
-            proba = preds[j]
-            name = le.classes_[j]
 
-            # draw the bounding box of the face along with the associated
-            # probability
-            recognition_resuls[name] = {
-                'probability': int(proba * 100),
-                'start_x': startX,
-                'start_y': startY,
-                'end_x': endX,
-                'end_y': endY
-            }
+def recognize_faces(models, faces):
+    """
+    Embed all the faces in one batched forward pass and classify all of them in one call.
+    Sets the 'name' and 'proba' of each face
+    """
+    if not faces:
+        return
+
+    embedder = models['embedder']
+
+    # construct a blob of all the face ROIs, then pass the blob
+    # through our face embedding model to obtain the 128-d
+    # quantification of each face
+    faces_blob = cv2.dnn.blobFromImages([face['face'] for face in faces], 1.0 / 255, (96, 96), (0, 0, 0), swapRB=True, crop=False)
+    embedder.setInput(faces_blob)
+    vecs = embedder.forward()
+
+    logger.debug(f"Found vecs: {vecs}")
+
+    if 'face_index' in models:
+        # match all the faces against the embeddings index in one matmul
+        for face, (name, similarity) in zip(faces, models['face_index'].match(vecs)):
+            face['name'] = name
+            face['proba'] = max(0.0, similarity)
 
-    if not recognition_resuls:
-        logger.info("Didn't find any recognition results")
+        return
+
+    # perform classification to recognize the faces
+    recognizer, le = models['recognizer'], models['le']
+    preds = recognizer.predict_proba(vecs)
+    best = np.argmax(preds, axis=1)
+    for face, j, face_preds in zip(faces, best, preds):
+        face['name'] = le.classes_[j]
+        face['proba'] = face_preds[j]
 
-    month, report_time = parse_key(args['s3_image_filepath'])
-    update_dynamo(month.replace('/', '_'), report_time, recognition_resuls)
 
-    if recognition_resuls:
-        # Choose best result
-        best_recognition_key = max(recognition_resuls, key=lambda k: recognition_resuls[k]['probability'])
-        best_recognition = recognition_resuls[best_recognition_key]
-        logger.info(f"Recognition Results: {recognition_resuls}.\nBest: {best_recognition_key}")
+def download_image(bucket, key):
+    # Read the object straight into memory and decode it there, without going through /tmp
+    body = get_s3().get_object(Bucket=bucket, Key=key)['Body'].read()
+    image = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f"Failed decoding image s3://{bucket}/{key}")
 
-        upload_recognitions_image(image, best_recognition_key, best_recognition, month, report_time)
+    return image
 
 
 def parse_key(s3_file_key):
     """
     2020/09/28_09_14_26_283950__test1.jpg
     2020/09/28_09_14_26_283950.jpg
+    2020/09/28_09_14_26_283950__frame1.jpg - The second frame of the report
+    2020/09/28_09_14_26_283950__frame1__crop0.jpg - The first crop of the second frame (devices in the crops upload mode)
+    2020/09/28_09_14_26_283950.webp
+    Returns the month, the report time, the index of the frame in the report and the index of the crop (None if not a crop)
     """
     s3_file_key = s3_file_key.replace('__test1', '')
-    match = re.match("([0-9]{4}/[0-9]{2})/(.*).jpg", s3_file_key)
+    match = re.match(r"([0-9]{4}/[0-9]{2})/(.*?)(?:__frame([0-9]+))?(?:__crop([0-9]+))?\.(?:jpg|webp)$", s3_file_key)
     month = match.group(1)
     report_time = match.group(2)
+    frame_index = int(match.group(3) or 0)
+    crop_index = int(match.group(4)) if match.group(4) is not None else None
+
+    return month, report_time, frame_index, crop_index
+
+
+def recognitions_attribute(frame_index, crop_index=None):
+    # Every frame of a report has its own attribute, so the frames' updates don't overwrite each other (in whatever order they arrive).
+    # Every crop of a frame is recognized as a separate image, so it has its own attribute as well
+    attribute = f"recognitions_{frame_index}" if frame_index else 'recognitions'
+
+    return f"{attribute}_crop{crop_index}" if crop_index is not None else attribute
+
 
-    return month, report_time
+def to_dynamo_month(month):
+    # The detections partition key is "<year>_<month>" without zero padding (see detection_report.create_record)
+    year, month = month.split('/')
 
+    return f"{year}_{int(month)}"
 
-def update_dynamo(month, report_time, recognitions):
-    table = boto3.resource('dynamodb').Table('detections')
 
-    # get item
+def update_dynamo(month, report_time, recognitions, attribute='recognitions'):
+    update_dynamo_attributes(month, report_time, {attribute: recognitions})
+
+
+def update_dynamo_attributes(month, report_time, attributes_recognitions):
+    """
+    Set the recognitions of several frames / crops of a report (attribute name -> recognitions) in a single round trip
+    """
+    table = get_detections_table()
+
+    # Set only the recognitions. The condition makes sure the item isn't created if the report doesn't exist
     dynamo_key = {'month': month, 'report_time': report_time}
-    response = table.get_item(Key=dynamo_key)
-    if not response or not response.get('Item'):
+    attributes = list(attributes_recognitions.items())
+    try:
+        table.update_item(
+            Key=dynamo_key,
+            UpdateExpression='SET ' + ', '.join(f"#recognitions{i} = :recognitions{i}" for i in range(len(attributes))),
+            ConditionExpression='attribute_exists(#month)',
+            ExpressionAttributeNames={'#month': 'month', **{f"#recognitions{i}": attribute for i, (attribute, _) in enumerate(attributes)}},
+            ExpressionAttributeValues={f":recognitions{i}": to_dynamo_recognitions(recognitions)
+                                       for i, (_, recognitions) in enumerate(attributes)}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
         logger.info(f"Couldn't find key in DynamoDB. Dynamo key: {dynamo_key}")
         return
 
-    # update
-    item = response['Item']
-    item['recognitions'] = [{k: v['probability']} for k, v in recognitions.items()]
+    logger.info("Updated DynamoDB successfully")
 
-    # put (idempotent)
-    table.put_item(Item=item)
 
-    logger.info("Updated DynamoDB successfully")
+def update_dynamo_many(updates):
+    """
+    Update the recognitions of several frames / crops, one update per report - the updates of the frames and the crops
+    of the same report are merged into one (they're all attributes of the same item).
+    Nothing needs to be atomic, so every report is updated on its own (a missing report doesn't fail the others).
+    """
+    reports = {}
+    for month, report_time, recognitions, attribute in updates:
+        reports.setdefault((month, report_time), {})[attribute] = recognitions
+
+    for (month, report_time), attributes_recognitions in reports.items():
+        update_dynamo_attributes(month, report_time, attributes_recognitions)
+
+
+def to_dynamo_recognitions(recognitions):
+    return [{k: v['probability']} for k, v in recognitions.items()]
 
 
-def upload_recognitions_image(image, best_recognition_key, best_recognition, month, report_time):
+def upload_recognitions_image(image, best_recognition_key, best_recognition, month, frame_name):
     # Draw rectangle and text
     text = f"{best_recognition_key} ({best_recognition['probability']}%)"
     y = best_recognition['start_y'] - 10 if best_recognition['start_y'] - 10 > 10 else best_recognition['start_y'] + 10
@@ -185,11 +350,9 @@ def upload_recognitions_image(image, best_recognition_key, best_recognition, mon
                   (0, 0, 255), 2)
     cv2.putText(image, text, (best_recognition['start_x'], y), cv2.FONT_HERSHEY_SIMPLEX, 0.45, (0, 0, 255), 2)
     encoded_image_bytes = cv2.imencode('.jpg', image)[1]
-    stream = io.BytesIO(encoded_image_bytes)
 
-    # Upload new image with rectangle and text
-    s3 = boto3.client('s3')
-    s3.upload_fileobj(stream, 'smart-guard-files', f"{month}/{report_time}_recognition.jpg")
+    # Upload new image with rectangle and text, straight from the encoded buffer
+    get_s3().put_object(Body=encoded_image_bytes.tobytes(), Bucket=CONFIG['bucket'], Key=f"{month}/{frame_name}_recognition.jpg")
     logger.info("Uploaded recognitions image successfully")
 
 
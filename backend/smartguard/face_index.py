@@ -0,0 +1,128 @@
+import pickle
+import logging
+
+import numpy as np
+
+
+logger = logging.getLogger()
+
+UNKNOWN_NAME = 'unknown'
+
+
+class FaceIndex:
+    """
+    Nearest neighbour face recognition over the 128-d face embeddings (models/embeddings/embeddings.pickle).
+    All the embeddings are kept L2 normalized in one matrix, so matching a batch of faces is a single matmul (cosine similarity)
+    followed by a k nearest neighbours vote.
+    Identities can be enrolled and removed without retraining anything, and no sklearn is needed.
+    """
+    def __init__(self, embeddings, names, k=3, threshold=0.5):
+        """
+        embeddings - (N, 128) array (or a list of 128-d vectors)
+        names - The label of each embedding
+        k - Amount of nearest neighbours voting on a face
+        threshold - Minimal cosine similarity of a match. Faces without a closer neighbour are recognized as "unknown"
+        """
+        self.k = k
+        self.threshold = threshold
+        self.matrix = np.empty((0, 0), dtype=np.float32)
+        self.labels = np.empty(0, dtype=np.int32)
+        self.names = []
+        self.label_rows = {}
+
+        self.add_many(embeddings, names)
+
+    @classmethod
+    def from_embeddings_pickle(cls, path, **kwargs):
+        with open(path, "rb") as f:
+            data = pickle.loads(f.read())
+
+        return cls(data['embeddings'], data['names'], **kwargs)
+
+    def save(self, path):
+        # Same format as embeddings.pickle
+        with open(path, "wb") as f:
+            f.write(pickle.dumps({
+                'embeddings': list(self.matrix),
+                'names': [self.names[label] for label in self.labels]
+            }))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def add(self, name, embeddings):
+        """
+        Enroll an identity (or add more embeddings to an existing one)
+        """
+        embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        self.add_many(embeddings, [name] * len(embeddings))
+
+    def add_many(self, embeddings, names):
+        if len(names) == 0:
+            return
+
+        embeddings = normalize(np.atleast_2d(np.asarray(embeddings, dtype=np.float32)))
+        for name in names:
+            if name not in self.label_rows:
+                self.label_rows[name] = None
+                self.names.append(name)
+        name_to_label = {name: label for label, name in enumerate(self.names)}
+
+        self.matrix = np.vstack([self.matrix, embeddings]) if len(self.matrix) else embeddings
+        self.labels = np.concatenate([self.labels, np.array([name_to_label[name] for name in names], dtype=np.int32)])
+        self._index_labels()
+
+    def remove(self, name):
+        """
+        Remove an identity with all its embeddings
+        """
+        if name not in self.label_rows:
+            return
+
+        label = self.names.index(name)
+        keep = self.labels != label
+        self.matrix = self.matrix[keep]
+        self.labels = self.labels[keep]
+
+        # Shift the labels after the removed one
+        self.labels[self.labels > label] -= 1
+        del self.names[label]
+        self._index_labels()
+
+    def match(self, vecs):
+        """
+        Recognize a batch of face embeddings. Returns a list of (name, similarity) - one per embedding
+        """
+        vecs = normalize(np.atleast_2d(np.asarray(vecs, dtype=np.float32)))
+        if not len(self.labels):
+            return [(UNKNOWN_NAME, 0.0)] * len(vecs)
+
+        # (faces, index size) cosine similarities in one matmul
+        similarities = vecs @ self.matrix.T
+
+        k = min(self.k, similarities.shape[1])
+        nearest = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+
+        results = []
+        for face_similarities, face_nearest in zip(similarities, nearest):
+            # Vote of the k nearest neighbours, weighted by their similarity
+            votes = np.zeros(len(self.names), dtype=np.float32)
+            np.add.at(votes, self.labels[face_nearest], face_similarities[face_nearest])
+            label = int(np.argmax(votes))
+
+            # The similarity of the best match is the closest embedding of the winning identity
+            similarity = float(face_similarities[self.label_rows[self.names[label]]].max())
+            if similarity < self.threshold:
+                results.append((UNKNOWN_NAME, similarity))
+            else:
+                results.append((self.names[label], similarity))
+
+        return results
+
+    def _index_labels(self):
+        self.label_rows = {name: np.flatnonzero(self.labels == label) for label, name in enumerate(self.names)}
+
+
+def normalize(vecs):
+    norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+    return vecs / np.maximum(norms, 1e-12)
@@ -0,0 +1,333 @@
+"""
+Offline harness of the backend Lambdas - no AWS account needed.
+Replays batches of sample images through detection_report.lambda_handler (the device's report) and detect_faces.handler
+(the S3 upload notification), with in-memory S3, DynamoDB and IoT stand-ins injected into the Lambdas' client caches.
+Reports the cold start (in fresh processes), the warm per-invocation latency and its breakdown across model load, decode,
+inference, encode and I/O.
+Run from backend/smartguard (the models are loaded relative to it):
+    python local_harness.py --images ~/samples --batches 20 --batch-size 4 --io-latency-ms 20
+"""
+import io
+import os
+import sys
+import json
+import queue
+import time
+import glob
+import logging
+import argparse
+import threading
+import statistics
+import multiprocessing
+from collections import defaultdict
+from contextlib import contextmanager, redirect_stdout
+from typing import Dict, List, Optional
+
+from botocore.exceptions import ClientError
+
+# detection_report lives one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('BUCKET_NAME', 'smart-guard-files')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+STAGES = ('model_load', 'decode', 'inference', 'encode', 'io', 'other')
+PERCENTILES = (50, 90, 99)
+
+
+class Timings:
+    """
+    Exclusive time of nested stages - a stage timed inside another one is deducted from the outer one.
+    Nesting is tracked per thread, so stages that run concurrently (detection_report saves to DynamoDB on a worker thread)
+    are all counted, and their sum may exceed the wall time of the invocation.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.totals = defaultdict(float)
+
+    @contextmanager
+    def timed(self, stage: str):
+        stack = self.local.__dict__.setdefault('stack', [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            children = stack.pop()
+            with self.lock:
+                self.totals[stage] += elapsed - children
+            if stack:
+                stack[-1] += elapsed
+
+    def wrap(self, module, name: str, stage: str) -> None:
+        func = getattr(module, name)
+
+        def timed_func(*args, **kwargs):
+            with self.timed(stage):
+                return func(*args, **kwargs)
+
+        setattr(module, name, timed_func)
+
+    def reset(self) -> None:
+        self.totals = defaultdict(float)
+
+
+class FakeS3:
+    def __init__(self, io_call):
+        self.io_call = io_call
+        self.objects = {}
+
+    def get_object(self, Bucket, Key):
+        with self.io_call():
+            if (Bucket, Key) not in self.objects:
+                raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': Key}}, 'GetObject')
+            return {'Body': io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def put_object(self, Body, Bucket, Key):
+        with self.io_call():
+            self.objects[(Bucket, Key)] = bytes(Body)
+
+    def generate_presigned_post(self, Bucket, Key, Fields=None, Conditions=None, ExpiresIn=3600):
+        # Signed locally in the real client as well, no round trip
+        return {'url': f"http://localhost/{Bucket}/", 'fields': {**(Fields or {}), 'key': Key}}
+
+
+class FakeBatchWriter:
+    def __init__(self, table):
+        self.table = table
+        self.pending = []
+
+    def put_item(self, Item):
+        self.pending.append(Item)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        # One BatchWriteItem round trip per 25 items
+        for i in range(0, len(self.pending), 25):
+            with self.table.io_call():
+                for item in self.pending[i:i + 25]:
+                    self.table.items[(item['month'], item['report_time'])] = item
+
+
+class FakeTable:
+    """
+    The detections table - supports exactly the calls the Lambdas make (puts, and the conditional recognitions update)
+    """
+    name = 'detections'
+
+    def __init__(self, io_call):
+        self.io_call = io_call
+        self.items = {}
+        self.updates = 0
+
+    def put_item(self, Item):
+        with self.io_call():
+            self.items[(Item['month'], Item['report_time'])] = Item
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues):
+        with self.io_call():
+            item = self.items.get((Key['month'], Key['report_time']))
+            if item is None:
+                raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException', 'Message': str(Key)}}, 'UpdateItem')
+            self.updates += 1
+            # "SET #name0 = :value0, #name1 = :value1"
+            for assignment in UpdateExpression[len('SET '):].split(', '):
+                name, value = assignment.split(' = ')
+                item[ExpressionAttributeNames[name]] = ExpressionAttributeValues[value]
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return FakeBatchWriter(self)
+
+
+class FakeIotData:
+    def __init__(self, io_call):
+        self.io_call = io_call
+        self.messages = []
+
+    def publish(self, topic, qos, payload):
+        with self.io_call():
+            self.messages.append((topic, json.loads(payload)))
+
+
+class Harness:
+    def __init__(self, images: List[bytes], io_latency_sec: float = 0.0, verbose: bool = False):
+        self.images = images
+        self.io_latency_sec = io_latency_sec
+        self.verbose = verbose
+        self.timings = Timings()
+        self.next_image = 0
+
+        # Imported here, so a cold run measures the import time of the Lambdas as well
+        start = time.perf_counter()
+        import detection_report
+        import detect_faces
+        self.import_time = time.perf_counter() - start
+        self.detection_report = detection_report
+        self.detect_faces = detect_faces
+        if not verbose:
+            logging.getLogger().setLevel(logging.WARNING)
+
+        self.s3 = FakeS3(self.io_call)
+        self.table = FakeTable(self.io_call)
+        self.iot_data = FakeIotData(self.io_call)
+        detection_report._clients.update({'detections': self.table, 's3': self.s3, 'iot-data': self.iot_data})
+        detect_faces._clients.update({'detections': self.table, 's3': self.s3})
+
+        self.timings.wrap(detect_faces, 'get_models', 'model_load')
+        self.timings.wrap(detect_faces, 'load_images', 'decode')
+        self.timings.wrap(detect_faces, 'detect_faces', 'inference')
+        self.timings.wrap(detect_faces, 'recognize_faces', 'inference')
+        self.timings.wrap(detect_faces, 'upload_recognitions_image', 'encode')
+
+    @contextmanager
+    def io_call(self):
+        with self.timings.timed('io'):
+            if self.io_latency_sec:
+                time.sleep(self.io_latency_sec)
+            yield
+
+    def invoke(self, handler, event) -> dict:
+        self.timings.reset()
+        start = time.perf_counter()
+        with self.timings.timed('other'):
+            if self.verbose:
+                handler(event, None)
+            else:
+                with redirect_stdout(io.StringIO()):
+                    handler(event, None)
+
+        total = time.perf_counter() - start
+        return {'total': total, **{stage: self.timings.totals.get(stage, 0.0) for stage in STAGES}}
+
+    def run_batch(self, batch_size: int) -> Dict[str, dict]:
+        """
+        Report a batch of detections, upload their frames the way the device does, and run the face detection of the batch
+        """
+        reports = [{'client_id': 'harness', 'score': 5} for _ in range(batch_size)]
+        published = len(self.iot_data.messages)
+        report = self.invoke(self.detection_report.lambda_handler, {'batch': reports} if batch_size > 1 else reports[0])
+
+        keys = []
+        for _, reply in self.iot_data.messages[published:]:
+            upload = reply['frame_upload']
+            self.s3.objects[(upload['bucket'], upload['image_path'])] = self.images[self.next_image % len(self.images)]
+            self.next_image += 1
+            keys.append(upload['image_path'])
+
+        event = {'Records': [{'s3': {'bucket': {'name': self.detect_faces.CONFIG['bucket']}, 'object': {'key': key}}} for key in keys]}
+        detection = self.invoke(self.detect_faces.handler, event)
+
+        return {'detection_report': report, 'detect_faces': detection}
+
+
+def load_sample_images(images_dir: Optional[str]) -> List[bytes]:
+    if images_dir:
+        paths = sorted(glob.glob(os.path.join(images_dir, '*.jpg')) + glob.glob(os.path.join(images_dir, '*.jpeg')))
+        if not paths:
+            raise ValueError(f"No jpg images in {images_dir}")
+        images = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                images.append(f.read())
+        return images
+
+    # Noise frames - no faces, but the decode and the detector cost the same
+    import cv2
+    import numpy as np
+    rng = np.random.default_rng(0)
+    return [cv2.imencode('.jpg', rng.integers(0, 255, (720, 1280, 3), dtype=np.uint8))[1].tobytes() for _ in range(4)]
+
+
+def cold_run(images: List[bytes], io_latency_sec: float, batch_size: int, results: multiprocessing.Queue) -> None:
+    # Runs in a fresh (spawned) interpreter
+    start = time.perf_counter()
+    harness = Harness(images, io_latency_sec)
+    invocations = harness.run_batch(batch_size)
+    results.put({
+        'import': harness.import_time,
+        'first_invocation': {name: timings['total'] for name, timings in invocations.items()},
+        'model_load': invocations['detect_faces']['model_load'],
+        'total': time.perf_counter() - start
+    })
+
+
+def get_cold_result(process: multiprocessing.Process, results: multiprocessing.Queue, timeout_sec: float = 600) -> dict:
+    # Don't wait for the whole timeout when the process already died (e.g. failed loading the models)
+    deadline = time.monotonic() + timeout_sec
+    while time.monotonic() < deadline:
+        try:
+            return results.get(timeout=1)
+        except queue.Empty:
+            if not process.is_alive() and results.empty():
+                raise RuntimeError(f"Cold run process exited with code {process.exitcode}")
+
+    process.terminate()
+    raise TimeoutError(f"Cold run didn't finish in {timeout_sec} seconds")
+
+
+def summarize(values: List[float]) -> dict:
+    values = sorted(values)
+    summary = {'count': len(values), 'avg_ms': round(statistics.mean(values) * 1000, 2) if values else None}
+    for p in PERCENTILES:
+        summary[f"p{p}_ms"] = round(values[min(len(values) - 1, len(values) * p // 100)] * 1000, 2) if values else None
+
+    return summary
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Offline cold / warm latency harness of the backend Lambdas")
+    parser.add_argument('--images', help="A directory of sample jpg frames. Synthetic frames are used if not given")
+    parser.add_argument('--batches', type=int, default=20, help="Warm invocations of each Lambda")
+    parser.add_argument('--batch-size', type=int, default=1, help="Reports (and images) per invocation")
+    parser.add_argument('--cold-runs', type=int, default=3, help="Cold starts, each in a fresh process")
+    parser.add_argument('--io-latency-ms', type=float, default=0, help="Simulated round trip of every S3 / DynamoDB / IoT call")
+    parser.add_argument('--output', help="Write the results to this json file")
+    parser.add_argument('--verbose', action='store_true', help="Keep the Lambdas' logs")
+    args = parser.parse_args()
+
+    images = load_sample_images(args.images)
+    io_latency_sec = args.io_latency_ms / 1000
+
+    cold = []
+    context = multiprocessing.get_context('spawn')
+    for _ in range(args.cold_runs):
+        results = context.Queue()
+        process = context.Process(target=cold_run, args=(images, io_latency_sec, args.batch_size, results))
+        process.start()
+        cold.append(get_cold_result(process, results))
+        process.join()
+
+    harness = Harness(images, io_latency_sec, args.verbose)
+    harness.run_batch(args.batch_size)  # Warm up (loads the models)
+    warm = defaultdict(list)
+    for _ in range(args.batches):
+        for name, timings in harness.run_batch(args.batch_size).items():
+            warm[name].append(timings)
+
+    report = {
+        'cold': {
+            'import': summarize([run['import'] for run in cold]),
+            'model_load': summarize([run['model_load'] for run in cold]),
+            **{f"first_{name}": summarize([run['first_invocation'][name] for run in cold]) for name in ('detection_report', 'detect_faces')}
+        },
+        'warm': {name: {
+            'latency': summarize([timings['total'] for timings in invocations]),
+            'breakdown_avg_ms': {stage: round(statistics.mean(t[stage] for t in invocations) * 1000, 2) for stage in STAGES}
+        } for name, invocations in warm.items()},
+        'updated_detections': sum(1 for item in harness.table.items.values() if 'recognitions' in item),
+        'detections': len(harness.table.items)
+    }
+    print(json.dumps(report, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
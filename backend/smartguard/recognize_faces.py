@@ -4,60 +4,34 @@ except ImportError:
   pass
 
 
-import pickle
-import numpy as np
-import sklearn
+import json
 
+from detect_faces import get_models, load_images, detect_faces, recognize_faces
 
-def handler(event, context):
-    # load the actual face recognition model along with the label encoder
-    recognizer = pickle.loads(open(args["recognizer"], "rb").read())
-    le = pickle.loads(open(args["le"], "rb").read())
-
-    # loop over the detections
-    for i in range(0, detections.shape[2]):
-        # extract the confidence (i.e., probability) associated with the
-        # prediction
-        confidence = detections[0, 0, i, 2]
-
-        # filter out weak detections
-        if confidence > args["confidence"]:
-            # compute the (x, y)-coordinates of the bounding box for the
-            # face
-            box = detections[0, 0, i, 3:7] * np.array([w, h, w, h])
-            (startX, startY, endX, endY) = box.astype("int")
-
-            # extract the face ROI
-            face = image[startY:endY, startX:endX]
-            (fH, fW) = face.shape[:2]
-
-            # ensure the face width and height are sufficiently large
-            if fW < 20 or fH < 20:
-                continue
 
-            # construct a blob for the face ROI, then pass the blob
-            # through our face embedding model to obtain the 128-d
-            # quantification of the face
-            faceBlob = cv2.dnn.blobFromImage(face, 1.0 / 255, (96, 96), (0, 0, 0), swapRB=True, crop=False)
-            embedder.setInput(faceBlob)
-            vec = embedder.forward()
-
-            # perform classification to recognize the face
-            preds = recognizer.predict_proba(vec)[0]
-            j = np.argmax(preds)
-            proba = preds[j]
-            name = le.classes_[j]
-
-            # draw the bounding box of the face along with the associated
-            # probability
-            text = "{}: {:.2f}%".format(name, proba * 100)
-            y = startY - 10 if startY - 10 > 10 else startY + 10
-            cv2.rectangle(image, (startX, startY), (endX, endY), (0, 0, 255), 2)
-            cv2.putText(image, text, (startX, y), cv2.FONT_HERSHEY_SIMPLEX, 0.45, (0, 0, 255), 2)
-
-    # show the output image
-    cv2.imshow("Image", image)
-    cv2.waitKey(0)
+def handler(event, context):
+    """
+    Recognize the faces of the given S3 images and return them, without updating the detections
+    event - {"keys": ["2020/09/28_09_14_26_283950.jpg", ...]} (or a single "key")
+    """
+    images = load_images(event.get('keys') or [event['key']])
+
+    # load the face detector, the embedder and the recognizer (once per container)
+    models = get_models()
+
+    faces = detect_faces(models['detector'], images)
+    recognize_faces(models, faces)
+
+    body = {key: [] for key in images}
+    for face in faces:
+        body[face['key']].append({
+            'name': face['name'],
+            'probability': int(face['proba'] * 100),
+            'start_x': int(face['start_x']),
+            'start_y': int(face['start_y']),
+            'end_x': int(face['end_x']),
+            'end_y': int(face['end_y'])
+        })
 
     response = {
         "statusCode": 200,
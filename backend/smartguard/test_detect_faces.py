@@ -0,0 +1,64 @@
+"""
+Recognitions updates of detect_faces against the in-memory detections table of the local harness.
+Run from backend/smartguard:
+    python -m unittest test_detect_faces
+"""
+import unittest
+from contextlib import nullcontext
+
+import detect_faces
+from local_harness import FakeTable
+
+
+class UpdateDynamoManyTest(unittest.TestCase):
+    def setUp(self):
+        self.table = FakeTable(nullcontext)
+        detect_faces._clients['detections'] = self.table
+
+    def tearDown(self):
+        detect_faces._clients.pop('detections', None)
+
+    def add_report(self, month, report_time):
+        self.table.put_item(Item={'month': month, 'report_time': report_time})
+
+    def recognitions_update(self, key, name, probability):
+        month, report_time, frame_index, crop_index = detect_faces.parse_key(key)
+        recognitions = {name: {'probability': probability}}
+
+        return detect_faces.to_dynamo_month(month), report_time, recognitions, detect_faces.recognitions_attribute(frame_index, crop_index)
+
+    def test_two_crops_of_one_report(self):
+        self.add_report('2020_9', '28_1')
+
+        detect_faces.update_dynamo_many([
+            self.recognitions_update('2020/09/28_1__crop0.jpg', 'edi', 90),
+            self.recognitions_update('2020/09/28_1__crop1.jpg', 'dana', 80)
+        ])
+
+        item = self.table.items[('2020_9', '28_1')]
+        self.assertEqual(item['recognitions_crop0'], [{'edi': 90}])
+        self.assertEqual(item['recognitions_crop1'], [{'dana': 80}])
+        # A single update of the report
+        self.assertEqual(self.table.updates, 1)
+
+    def test_frames_and_crops_of_several_reports(self):
+        self.add_report('2020_9', '28_1')
+        self.add_report('2020_9', '28_2')
+
+        detect_faces.update_dynamo_many([
+            self.recognitions_update('2020/09/28_1.jpg', 'edi', 90),
+            self.recognitions_update('2020/09/28_1__frame1__crop0.jpg', 'dana', 80),
+            self.recognitions_update('2020/09/28_2__frame2.webp', 'edi', 70),
+            # The report doesn't exist, it shouldn't fail the others
+            self.recognitions_update('2020/09/28_3.jpg', 'edi', 60)
+        ])
+
+        self.assertEqual(self.table.items[('2020_9', '28_1')]['recognitions'], [{'edi': 90}])
+        self.assertEqual(self.table.items[('2020_9', '28_1')]['recognitions_1_crop0'], [{'dana': 80}])
+        self.assertEqual(self.table.items[('2020_9', '28_2')]['recognitions_2'], [{'edi': 70}])
+        self.assertNotIn(('2020_9', '28_3'), self.table.items)
+        self.assertEqual(self.table.updates, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
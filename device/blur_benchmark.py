@@ -0,0 +1,84 @@
+"""
+Micro benchmark of video_processing.blur against the original blur implementation, across resolutions and amount of faces.
+Run from the repository root:
+    python -m device.blur_benchmark
+"""
+import time
+from typing import List
+
+import cv2
+import numpy as np
+from numpy import ndarray
+
+from device.common import FrameObject
+from device import video_processing
+
+
+RESOLUTIONS = [(640, 480), (1280, 720), (1920, 1080)]
+FACES_AMOUNTS = [0, 1, 3, 6]
+REPEATS = 20
+
+
+def legacy_blur(frame: ndarray, faces: List[FrameObject]) -> ndarray:
+    # The original implementation - copies the whole frame per face and blurs in full resolution
+    def get_face_range(face, frame):
+        margins_y = int(face.h * video_processing.UNBLURRED_FACE_MARGIN_PERCENT)
+        margins_x = int(face.w * video_processing.UNBLURRED_FACE_MARGIN_PERCENT)
+
+        yfrom = max(0, face.y - margins_y)
+        yto = min(frame.shape[0], face.y + face.h + margins_y)
+        xfrom = max(0, face.x - margins_x)
+        xto = min(frame.shape[1], face.x + face.w + margins_x)
+
+        return yfrom, yto, xfrom, xto
+
+    original_face_images = []
+    for face in faces:
+        yfrom, yto, xfrom, xto = get_face_range(face, frame)
+        original_face_images.append(frame.copy()[yfrom:yto, xfrom:xto])
+
+    frame_blurred = cv2.GaussianBlur(frame, (51, 51), 0)
+
+    for i, face in enumerate(faces):
+        yfrom, yto, xfrom, xto = get_face_range(face, frame)
+        frame_blurred[yfrom:yto, xfrom:xto] = original_face_images[i]
+
+    return frame_blurred
+
+
+def create_faces(width: int, height: int, amount: int) -> List[FrameObject]:
+    size = height // 8
+    return [FrameObject(x=(i * width // max(1, amount)) % (width - size), y=height // 3, w=size, h=size, area=size * size)
+            for i in range(amount)]
+
+
+def measure(func, repeats: int = REPEATS) -> float:
+    # Returns the median time in ms
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    return sorted(times)[len(times) // 2] * 1000
+
+
+def main():
+    print(f"{'resolution':>12} {'faces':>6} {'legacy':>10} {'gaussian':>10} {'box':>10} {'downscale':>10} {'downscale+out':>14}")
+    for width, height in RESOLUTIONS:
+        frame = np.random.randint(0, 255, (height, width, 3), dtype=np.uint8)
+        out = np.empty_like(frame)
+        for faces_amount in FACES_AMOUNTS:
+            faces = create_faces(width, height, faces_amount)
+            results = [
+                measure(lambda: legacy_blur(frame, faces)),
+                measure(lambda: video_processing.blur(frame, faces, method=video_processing.BLUR_METHOD_GAUSSIAN)),
+                measure(lambda: video_processing.blur(frame, faces, method=video_processing.BLUR_METHOD_BOX)),
+                measure(lambda: video_processing.blur(frame, faces, method=video_processing.BLUR_METHOD_DOWNSCALE)),
+                measure(lambda: video_processing.blur(frame, faces, out=out, method=video_processing.BLUR_METHOD_DOWNSCALE)),
+            ]
+            print(f"{f'{width}x{height}':>12} {faces_amount:>6} " + ' '.join(f"{r:>{w}.2f}" for r, w in zip(results, [10, 10, 10, 10, 14])))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,107 +1,228 @@
-from typing import Optional
+from typing import Optional, Any
 from datetime import datetime as dt
 import time
 import sys
+import logging
 
 import cv2
+import numpy as np
 
-from device import video_processing, objects_monitor
+from device import video_processing, objects_monitor, metrics
+from device.frame_reader import FrameReader, DROP_OLDEST
+from device.frame_pool import FramePool, FRAMES_IN_FLIGHT
+from device.face_detection import create_face_detector, FACE_DETECTOR_HAAR, FACE_DETECTOR_DNN
+from device.tracking import FaceTracker
+from device.motion_detection import create_motion_detector, MOTION_DETECTOR_DIFF
+from device.frame_store import DEFAULT_MEMORY_BUDGET, ENCODING_JPEG
+from device.frame_rate import FrameRateScheduler, IDLE_FPS, CPU_BUDGET
+from device.frames_sender import FrameEncoder, UPLOAD_MODE_FULL, IMAGE_FORMAT_JPEG
+from device.clip_recorder import ClipRecorder, CLIPS_DIR, PRE_ROLL_SEC, POST_ROLL_SEC, CLIP_SEGMENT_BYTES, CLIPS_MAX_BYTES
 
 
 this = sys.modules[__name__]
 this.conf = {}
-this.video_output = None
+this.clip_recorder = None
 this.should_save_video = False
-
-
-def init(display: bool, fps: int, input: Optional[str]) -> None:
+this.reader = None
+this.pool = None
+this.display_frame = None
+this.scheduler = None
+this.face_detector = None
+this.face_tracker = None
+this.motion_detector = None
+this.logger = logging.getLogger(__name__)
+
+
+def init(display: bool, fps: int, input: Optional[str], threaded: bool = False, queue_size: int = 2, drop_policy: str = DROP_OLDEST,
+         face_detection_scale: float = 0.5, motion_detector: str = MOTION_DETECTOR_DIFF,
+         motion_working_width: Optional[int] = video_processing.MOTION_WORKING_WIDTH,
+         frame_store_budget: int = DEFAULT_MEMORY_BUDGET, frame_store_encoding: str = ENCODING_JPEG,
+         face_detection_interval: int = 5, opencv_tracker: Optional[str] = None,
+         face_detector: str = FACE_DETECTOR_HAAR, dnn_input_size: int = 300, dnn_confidence: float = 0.5,
+         camera_index: int = 0, mqtt: Optional[Any] = None, uploader: Optional[Any] = None,
+         record_clips: bool = False, clips_dir: str = CLIPS_DIR, pre_roll_sec: float = PRE_ROLL_SEC, post_roll_sec: float = POST_ROLL_SEC,
+         clip_segment_bytes: int = CLIP_SEGMENT_BYTES, clips_max_bytes: int = CLIPS_MAX_BYTES,
+         idle_fps: Optional[float] = IDLE_FPS, cpu_budget: Optional[float] = CPU_BUDGET,
+         upload_mode: str = UPLOAD_MODE_FULL, upload_format: str = IMAGE_FORMAT_JPEG, upload_target_bytes: Optional[int] = None) -> None:
+    """
+    fps - The maximal processing frame rate, used while there's motion. Without motion it drops to idle_fps,
+          and it's capped so processing uses at most cpu_budget of a core (None disables each of them)
+    record_clips - Automatically record a clip of every activity (with pre_roll_sec before it and post_roll_sec after it).
+                   Without it, clips are recorded only manually (the 'v' key)
+    upload_mode / upload_format / upload_target_bytes - How the reported frames are uploaded (see FrameEncoder)
+    """
     this.conf['display'] = display
     this.conf['fps'] = fps
     this.conf['input'] = input
+    this.conf['camera_index'] = camera_index
+    this.conf['threaded'] = threaded
+    this.conf['queue_size'] = queue_size
+    this.conf['drop_policy'] = drop_policy
+    this.conf['record_clips'] = record_clips
+
+    this.scheduler = FrameRateScheduler(fps, idle_fps, cpu_budget=cpu_budget)
+
+    this.motion_detector = create_motion_detector(motion_detector, working_width=motion_working_width)
+    if face_detector == FACE_DETECTOR_DNN:
+        this.face_detector = create_face_detector(face_detector, input_size=dnn_input_size, confidence=dnn_confidence)
+    else:
+        this.face_detector = create_face_detector(face_detector, scale=face_detection_scale)
+
+    # Faces are tracked across frames, and the full detection runs only every face_detection_interval frames (or when a track is lost)
+    this.face_tracker = FaceTracker(this.face_detector, face_detection_interval, opencv_tracker=opencv_tracker)
 
-    objects_monitor.init(fps)
+    # Pre-roll frames are kept only for automatic recording, manual recording starts from the key press
+    pre_roll_sec = pre_roll_sec if record_clips else 0
+
+    this.clip_recorder = ClipRecorder(fps, clips_dir, pre_roll_sec, post_roll_sec, clip_segment_bytes, clips_max_bytes)
+
+    # Enough capture buffers for every holder of frames - the reader queue, the frames in flight, and the clip recorder
+    # (its pre-roll and writer queue) if clips can be recorded at all (automatically, or manually from the display)
+    clip_frames = this.clip_recorder.max_held_frames() if record_clips or display else 0
+    this.pool = FramePool(queue_size + FRAMES_IN_FLIGHT + clip_frames)
+    this.clip_recorder.pool = this.pool
+
+    objects_monitor.init(fps, frame_store_budget, frame_store_encoding, mqtt=mqtt, uploader=uploader,
+                         encoder=FrameEncoder(upload_mode, upload_format, upload_target_bytes))
 
 
 def capture() -> None:
     if not this.conf['input']:
-        cap = cv2.VideoCapture(0)
+        cap = cv2.VideoCapture(this.conf['camera_index'])
     else:
         cap = cv2.VideoCapture(this.conf['input'])
 
-    width = cap.get(cv2.CAP_PROP_FRAME_WIDTH)
-    height = cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
+    this.clip_recorder.start()
 
-    ret, frame1 = cap.read()
-    prev_time = time.time()
-    while cap.isOpened():
-        ret, frame2 = cap.read()
+    if this.conf['threaded']:
+        # Frames are grabbed by a dedicated thread, the loop below only processes them
+        this.reader = FrameReader(cap, this.scheduler.fps, bool(this.conf['input']), this.conf['queue_size'], this.conf['drop_policy'],
+                                  pool=this.pool)
+        this.reader.start()
+        metrics.register_collector(collect_reader_metrics)
 
+    prev_time = time.time()
+    while this.reader.is_running() if this.reader else cap.isOpened():
         process_frame = False
-        if this.conf['input']:
+        read_start = time.perf_counter()
+        if this.reader:
+            # The reader thread already throttles the frames according to the scheduled frame rate
+            ret, frame = this.reader.read()
+            if not ret:
+                break
+            process_frame = True
+        elif this.conf['input']:
+            ret, frame = this.pool.read(cap)
+
             # When reading from a file, we need to wait explicitly the fps time
-            time.sleep(1/this.conf['fps'])
+            time.sleep(this.scheduler.interval())
             process_frame = True
         else:
+            ret, frame = this.pool.read(cap)
+
             # When reading from camera, we need to continue processing the frames with the cameras capability
-            # and process only the wanted frames according to the user requested frame rate
+            # and process only the wanted frames according to the scheduled frame rate
             cur_time = time.time()
             elapsed_time = cur_time - prev_time
-            if elapsed_time > 1/this.conf['fps']:
+            if elapsed_time > this.scheduler.interval():
                 process_frame = True
                 prev_time = cur_time
+        metrics.observe('stage_seconds', time.perf_counter() - read_start, stage='read')
 
+        detected_objects = []
+        detected_faces = []
         if process_frame:
-            # Detect motion
-            detected_objects = video_processing.detect_motion(frame1, frame2, draw=this.conf['display'])
+            metrics.inc('processed_frames_total')
+            frame_start = time.perf_counter()
+            # Detect motion (the motion detector keeps its own downscaled history, so only the current frame is needed)
+            with metrics.timer('stage_seconds', stage='motion'):
+                detected_objects = this.motion_detector.detect(frame)
 
-            # Detect faces
-            detected_faces = []
-            if detected_objects:
-                detected_faces = video_processing.detect_faces(frame1, detected_objects, draw=this.conf['display'])
+            # Detect (or track) faces
+            with metrics.timer('stage_seconds', stage='faces'):
+                detected_faces = this.face_tracker.update(frame, detected_objects)
 
             # Blur faces (just for debugging)
-            # frame1 = video_processing.blur(frame1, detected_faces)
+            # frame = video_processing.blur(frame, detected_faces)
+
+            with metrics.timer('stage_seconds', stage='add_frame'):
+                objects_monitor.add_frame(frame, detected_objects, detected_faces, this.face_tracker.coasted_faces)
 
-            objects_monitor.add_frame(frame2, detected_objects, detected_faces)
+            # Adapt the frame rate to the motion and to the processing cost of the frame
+            frame_time = time.perf_counter() - frame_start
+            metrics.observe('stage_seconds', frame_time, stage='frame')
+            fps = this.scheduler.update(bool(detected_objects), frame_time)
+            metrics.set_gauge('fps', fps)
+            if this.reader:
+                this.reader.fps = fps
 
-        save_video(frame2, width, height)
+        if process_frame:
+            # Clips are written in the processing frame rate
+            record_clip(frame)
 
         # On every frame we need to check the last activity
-        objects_monitor.check_activity()
+        with metrics.timer('stage_seconds', stage='check_activity'):
+            objects_monitor.check_activity()
 
         if this.conf['display']:
-            cv2.imshow("Live video", frame1)
+            cv2.imshow("Live video", draw_display(frame, detected_objects, detected_faces))
 
             ret_key = cv2.waitKey(1)
             if ret_key & 0xFF == ord('q'):
                 print('"q" pressed. Finishing video capturing')
+                this.pool.release(frame)
                 break
             elif ret_key & 0xFF == ord('s'):
                 filename = dt.now().strftime("%H_%M_%S.jpg")
                 print(f"'s' pressed. Saving image to {filename}")
-                cv2.imwrite(filename, frame2)
+                cv2.imwrite(filename, frame)
             elif ret_key & 0xFF == ord('v'):
                 this.should_save_video = not this.should_save_video
 
-        # Prev frame is now current frame
-        frame1 = frame2
+        # Done with the frame, its buffer can be reused (unless the clip recorder still holds it)
+        this.pool.release(frame)
+
+    if this.reader:
+        this.reader.stop()
+        this.logger.info(f"Finished capturing. {this.reader.stats()}")
+        this.reader = None
+
+    this.logger.info(f"Motion detection cost: {this.motion_detector.stats()}")
+    this.logger.info(f"Face detection cost: {this.face_detector.stats()}")
+    this.logger.info(f"Face tracking: {this.face_tracker.stats()}")
+    this.logger.info(f"Frame rate: {this.scheduler.stats()}")
+    this.logger.info(f"Frame pool: {this.pool.stats()}")
 
     cap.release()
 
-    # TODO - Move to some generic place
-    if this.video_output:
-        this.video_output.release()
-        this.video_output = None
+    this.clip_recorder.stop()
+    this.logger.info(f"Clip recording: {this.clip_recorder.stats()}")
 
     cv2.destroyAllWindows()
 
 
-def save_video(frame, width, height):
-    if not this.should_save_video:
-        return
+def collect_reader_metrics() -> None:
+    if this.reader:
+        reader_stats = this.reader.stats()
+        metrics.set_counter('reader_read_frames_total', reader_stats['read_frames'])
+        metrics.set_counter('reader_dropped_frames_total', reader_stats['dropped_frames'])
+        metrics.set_gauge('reader_queued_frames', reader_stats['queued_frames'])
+
+
+def draw_display(frame, detected_objects, detected_faces):
+    # Overlays are drawn on a separate display layer (reused between frames), never on the shared read-only frame
+    if this.display_frame is None or this.display_frame.shape != frame.shape:
+        this.display_frame = np.empty_like(frame)
+    np.copyto(this.display_frame, frame)
+    video_processing.draw_objects_in_frame(this.display_frame, detected_objects)
+    video_processing.draw_objects_in_frame(this.display_frame, detected_faces, (255, 0, 0))
+
+    return this.display_frame
 
-    if not this.video_output:
-        fourcc = cv2.VideoWriter_fourcc('m', 'p', '4', 'v')
-        this.video_output = cv2.VideoWriter('output.mp4', fourcc, this.conf['fps'], (int(width), int(height)))
 
-    this.video_output.write(frame)
+def record_clip(frame):
+    # Frames are only queued here, the clip is encoded by the recorder's writer thread
+    now = time.time()
+    if this.should_save_video or (this.conf['record_clips'] and objects_monitor.has_activity()):
+        this.clip_recorder.trigger(now)
+    this.clip_recorder.add(frame, now)
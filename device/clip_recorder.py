@@ -0,0 +1,247 @@
+import os
+import time
+import queue
+import logging
+import threading
+from collections import deque
+from datetime import datetime as dt
+from typing import Optional, Deque, Tuple
+
+import cv2
+from numpy import ndarray
+
+from device import metrics
+from device.frame_pool import FramePool
+
+
+CLIPS_DIR = 'clips'
+PRE_ROLL_SEC = 3
+POST_ROLL_SEC = 5
+CLIP_SEGMENT_BYTES = 50 * 1024 * 1024
+CLIPS_MAX_BYTES = 1024 * 1024 * 1024
+CLIP_QUEUE_SIZE = 64
+
+# How often (in frames) the writer checks the size of the current segment
+SEGMENT_SIZE_CHECK_FRAMES = 30
+
+# A longer gap between frames isn't filled with repeated frames (e.g. the recorder was falling behind)
+MAX_FRAME_GAP_SEC = 2
+
+
+class ClipRecorder:
+    """
+    Records event clips - from pre_roll_sec before the first trigger() until post_roll_sec after the last one.
+    The last frames are kept in a small pre-roll ring (references only - pooled frames are retained until written or evicted),
+    and the frames of a clip are encoded by a background writer thread. add() and trigger() never block -
+    when the writer falls behind (queue_size frames are waiting), frames are dropped (and counted) rather than slowing the capture loop.
+    The start / end of a clip are never dropped.
+    Clips are split into segments of up to segment_bytes, and the oldest clips are deleted when the clips directory
+    exceeds max_bytes.
+    At most max_held_frames() frames are retained at once - the pre-roll ring and the writer queue.
+    The processing frame rate varies (see FrameRateScheduler), while a clip has a fixed rate of fps - frames are timestamped when
+    added, and written as many times as needed to keep the clip in real time.
+    """
+    def __init__(self, fps: int, clips_dir: str = CLIPS_DIR, pre_roll_sec: float = PRE_ROLL_SEC, post_roll_sec: float = POST_ROLL_SEC,
+                 segment_bytes: int = CLIP_SEGMENT_BYTES, max_bytes: int = CLIPS_MAX_BYTES, queue_size: int = CLIP_QUEUE_SIZE,
+                 pool: Optional[FramePool] = None):
+        self.fps = fps
+        self.pool = pool
+        self.clips_dir = clips_dir
+        self.post_roll_sec = post_roll_sec
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+
+        self.pre_roll: Deque[Tuple[ndarray, float]] = deque(maxlen=int(pre_roll_sec * fps))
+        self.recording = False
+        self.last_trigger: Optional[float] = None
+        # Only the frames are bounded, so the clip control jobs always get in
+        self.jobs = queue.Queue()
+        self.queue_size = queue_size
+        self.queued_frames = 0
+        self.queue_lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+
+        # Writer state (used only by the writer thread)
+        self.writer: Optional[cv2.VideoWriter] = None
+        self.clip_name: Optional[str] = None
+        self.segment = 0
+        self.segment_path: Optional[str] = None
+        self.segment_frames = 0
+        self.segment_start = 0.0
+        self.next_size_check = 0
+
+        # Counters
+        self.clips = 0
+        self.written_frames = 0
+        self.dropped_frames = 0
+
+        self.logger = logging.getLogger(__name__)
+
+    def start(self) -> None:
+        os.makedirs(self.clips_dir, exist_ok=True)
+        self.thread = threading.Thread(target=self._run, name='clip_writer', daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        """
+        Finish the current clip and wait for the writer to flush it. All the retained frames are released
+        """
+        if self.recording:
+            self._end_clip()
+        if self.thread:
+            # The writer releases the queued frames as it goes
+            self.jobs.put(None)
+            self.thread.join()
+            self.thread = None
+        else:
+            while not self.jobs.empty():
+                job = self.jobs.get_nowait()
+                if job and job[0] == 'frame':
+                    self._dequeued_frame()
+                    self._release(job[1][0])
+
+        while self.pre_roll:
+            self._release(self.pre_roll.popleft()[0])
+
+    def max_held_frames(self) -> int:
+        return self.pre_roll.maxlen + self.queue_size
+
+    def trigger(self, now: Optional[float] = None) -> None:
+        """
+        Start a clip (with the pre-roll frames), or extend the current one
+        """
+        self.last_trigger = now or time.time()
+        if self.recording:
+            return
+
+        self.recording = True
+        self.clips += 1
+        self._enqueue(('start', dt.now().strftime("%Y%m%d_%H%M%S")))
+        while self.pre_roll:
+            self._enqueue(('frame', self.pre_roll.popleft()))
+
+    def add(self, frame: ndarray, now: Optional[float] = None) -> None:
+        if not self.recording:
+            if not self.pre_roll.maxlen:
+                return
+            if len(self.pre_roll) == self.pre_roll.maxlen:
+                self._release(self.pre_roll.popleft()[0])
+            self._retain(frame)
+            self.pre_roll.append((frame, now or time.time()))
+            return
+
+        now = now or time.time()
+        self._retain(frame)
+        self._enqueue(('frame', (frame, now)))
+        if now - self.last_trigger > self.post_roll_sec:
+            self._end_clip()
+
+    def stats(self) -> dict:
+        return {
+            'recording': self.recording,
+            'clips': self.clips,
+            'written_frames': self.written_frames,
+            'dropped_frames': self.dropped_frames,
+            'queue_depth': self.jobs.qsize()
+        }
+
+    def _end_clip(self) -> None:
+        self.recording = False
+        self._enqueue(('end', None))
+
+    def _enqueue(self, job: Tuple[str, Optional[object]]) -> None:
+        if job[0] == 'frame':
+            with self.queue_lock:
+                full = self.queued_frames >= self.queue_size
+                if not full:
+                    self.queued_frames += 1
+            if full:
+                self.dropped_frames += 1
+                metrics.inc('clip_dropped_frames_total')
+                self._release(job[1][0])
+                return
+
+        self.jobs.put_nowait(job)
+
+    def _dequeued_frame(self) -> None:
+        with self.queue_lock:
+            self.queued_frames -= 1
+
+    def _retain(self, frame: ndarray) -> None:
+        if self.pool:
+            self.pool.retain(frame)
+
+    def _release(self, frame: ndarray) -> None:
+        if self.pool:
+            self.pool.release(frame)
+
+    def _run(self) -> None:
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self._close_segment()
+                break
+
+            try:
+                kind, data = job
+                if kind == 'start':
+                    self._close_segment()
+                    self.clip_name = data
+                    self.segment = 0
+                elif kind == 'end':
+                    self._close_segment()
+                    self.clip_name = None
+                    self._rotate()
+                else:
+                    self._dequeued_frame()
+                    frame, frame_time = data
+                    try:
+                        if self.clip_name:
+                            with metrics.timer('stage_seconds', stage='clip_write'):
+                                self._write(frame, frame_time)
+                    finally:
+                        self._release(frame)
+            except Exception:
+                self.logger.exception("Failed writing clip")
+
+    def _write(self, frame: ndarray, frame_time: float) -> None:
+        if self.writer is None:
+            self.segment_path = os.path.join(self.clips_dir, f"{self.clip_name}_{self.segment:03}.mp4")
+            fourcc = cv2.VideoWriter_fourcc('m', 'p', '4', 'v')
+            self.writer = cv2.VideoWriter(self.segment_path, fourcc, self.fps, (frame.shape[1], frame.shape[0]))
+            self.segment_frames = 0
+            self.segment_start = frame_time
+            self.next_size_check = SEGMENT_SIZE_CHECK_FRAMES
+
+        # The frame lasts until its time in the clip, so frames processed at a lower rate are repeated
+        repeats = round((frame_time - self.segment_start) * self.fps) + 1 - self.segment_frames
+        repeats = min(max(1, repeats), max(1, int(MAX_FRAME_GAP_SEC * self.fps)))
+        for _ in range(repeats):
+            self.writer.write(frame)
+        self.segment_frames += repeats
+        self.written_frames += 1
+
+        # Continue the clip in a new segment once the current one is big enough
+        if self.segment_frames >= self.next_size_check:
+            self.next_size_check = self.segment_frames + SEGMENT_SIZE_CHECK_FRAMES
+            if os.path.getsize(self.segment_path) >= self.segment_bytes:
+                self._close_segment()
+                self.segment += 1
+
+    def _close_segment(self) -> None:
+        if self.writer is not None:
+            self.writer.release()
+            self.writer = None
+            self.logger.info(f"Saved clip segment {self.segment_path} ({self.segment_frames} frames)")
+
+    def _rotate(self) -> None:
+        # Delete the oldest clips segments until the directory fits the budget (names are sortable by time)
+        paths = sorted(os.path.join(self.clips_dir, name) for name in os.listdir(self.clips_dir) if name.endswith('.mp4'))
+        sizes = {path: os.path.getsize(path) for path in paths}
+        total = sum(sizes.values())
+        for path in paths:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= sizes[path]
+            self.logger.info(f"Deleted old clip segment {path}")
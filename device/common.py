@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime as dt
 from typing import List, Optional
 
@@ -12,12 +12,16 @@ class FrameObject:
     w: int
     h: int
     area: int
+    track_id: Optional[int] = None  # Id of the FaceTracker track (faces only)
 
 
 @dataclass
 class MonitoredFrame:
     time: dt
-    frame: ndarray
+    frame: Optional[ndarray]
     objects: List[FrameObject]
     faces: List[FrameObject]
     score: Optional[float]
+    frame_id: Optional[int] = None  # Id of the frame pixels in the FrameStore
+    # Faces missed by the last detection whose last box is kept (see FaceTracker) - left unblurred, but not scored
+    coasted_faces: List[FrameObject] = field(default_factory=list)
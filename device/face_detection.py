@@ -0,0 +1,212 @@
+import os
+import time
+from typing import List, Tuple
+
+import cv2
+from numpy import ndarray
+
+from device.common import FrameObject
+
+
+FACE_DETECTOR_HAAR = 'haar'
+FACE_DETECTOR_DNN = 'dnn'
+
+HAAR_CASCADE_PATH = 'device/haarcascade_frontalface_default.xml'
+DNN_MODEL_DIR = 'backend/smartguard/models/face_detection_model'
+
+# Haar cascade detection window size (of haarcascade_frontalface_default.xml). Faces smaller than that can't be detected.
+HAAR_WINDOW_SIZE = 24
+
+Roi = Tuple[int, int, int, int]
+
+
+def get_motion_rois(frame_shape: tuple, detected_objects: List[FrameObject], padding: float) -> List[Roi]:
+    """
+    Pad each motion box by a percentage of its size (so a face on the edge of a moving body isn't cut),
+    clip it to the frame and merge overlapping boxes, so every pixel is scanned only once.
+    Returns a list of (x, y, w, h)
+    """
+    frame_h, frame_w = frame_shape[:2]
+
+    rois = []
+    for obj in detected_objects:
+        pad_x = int(obj.w * padding)
+        pad_y = int(obj.h * padding)
+        x1 = max(0, obj.x - pad_x)
+        y1 = max(0, obj.y - pad_y)
+        x2 = min(frame_w, obj.x + obj.w + pad_x)
+        y2 = min(frame_h, obj.y + obj.h + pad_y)
+        if x2 > x1 and y2 > y1:
+            rois.append([x1, y1, x2, y2])
+
+    # Merge until there are no overlapping boxes left (there are only a few motion boxes, so quadratic is fine)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(rois)):
+            for j in range(i + 1, len(rois)):
+                a, b = rois[i], rois[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    rois[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del rois[j]
+                    merged = True
+                    break
+            if merged:
+                break
+
+    return [(x1, y1, x2 - x1, y2 - y1) for x1, y1, x2, y2 in rois]
+
+
+def is_inside_objects(face: FrameObject, detected_objects: List[FrameObject]) -> bool:
+    """
+    Check if the detected face is moving (and not just some false positive of a static object)
+    Do this by going through all detected objects and checking if the center of the face is inside the bounds of any of those objects
+    """
+    center_face_x = int(face.x + face.w/2)
+    center_face_y = int(face.y + face.h/2)
+    for detected_object in detected_objects:
+        if detected_object.x < center_face_x < detected_object.x + detected_object.w \
+                and detected_object.y < center_face_y < detected_object.y + detected_object.h:
+            return True
+
+    return False
+
+
+class FaceDetector:
+    """
+    Base class of the face detection engines.
+    Detection runs only inside the (padded and merged) motion ROIs, and only faces with their center inside a motion box are returned.
+    Every engine keeps track of its own cost per call.
+    """
+    name = None
+
+    def __init__(self, roi_padding: float = 0.1):
+        self.roi_padding = roi_padding
+
+        self.calls = 0
+        self.total_time = 0.0
+        self.last_time = 0.0
+
+    def detect(self, frame: ndarray, detected_objects: List[FrameObject]) -> List[FrameObject]:
+        start = time.perf_counter()
+
+        detected_faces = []
+        for roi in get_motion_rois(frame.shape, detected_objects, self.roi_padding):
+            for face in self._detect_roi(frame, roi):
+                if is_inside_objects(face, detected_objects):
+                    detected_faces.append(face)
+
+        self.last_time = time.perf_counter() - start
+        self.total_time += self.last_time
+        self.calls += 1
+
+        return detected_faces
+
+    def stats(self) -> dict:
+        return {
+            'name': self.name,
+            'calls': self.calls,
+            'last_ms': round(self.last_time * 1000, 3),
+            'avg_ms': round(self.total_time * 1000 / self.calls, 3) if self.calls else None
+        }
+
+    def _detect_roi(self, frame: ndarray, roi: Roi) -> List[FrameObject]:
+        """
+        Returns the faces inside the ROI in full resolution coordinates
+        """
+        raise NotImplementedError()
+
+
+class HaarFaceDetector(FaceDetector):
+    """
+    Haar cascade face detection engine.
+    The cascade is loaded once, and each ROI is downscaled to a working scale, with the min/max face size derived from the ROI size.
+    """
+    name = FACE_DETECTOR_HAAR
+
+    def __init__(self, cascade_path: str = HAAR_CASCADE_PATH, scale: float = 0.5, roi_padding: float = 0.1,
+                 scale_factor: float = 1.1, min_neighbors: int = 4, min_face_ratio: float = 0.1, max_face_ratio: float = 1.0):
+        super().__init__(roi_padding)
+        self.cascade = cv2.CascadeClassifier(cascade_path)
+        if self.cascade.empty():
+            raise ValueError(f"Failed loading Haar cascade from {cascade_path}")
+
+        self.scale = scale
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.min_face_ratio = min_face_ratio
+        self.max_face_ratio = max_face_ratio
+
+    def _detect_roi(self, frame: ndarray, roi: Roi) -> List[FrameObject]:
+        roi_x, roi_y, roi_w, roi_h = roi
+        gray = cv2.cvtColor(frame[roi_y:roi_y + roi_h, roi_x:roi_x + roi_w], cv2.COLOR_BGR2GRAY)
+
+        # Never upscale, and don't shrink the ROI below the cascade's window
+        scale = min(1.0, max(self.scale, HAAR_WINDOW_SIZE / min(roi_w, roi_h)))
+        if scale < 1.0:
+            gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+        roi_side = min(gray.shape[:2])
+        min_size = max(HAAR_WINDOW_SIZE, int(roi_side * self.min_face_ratio))
+        max_size = max(min_size, int(roi_side * self.max_face_ratio))
+
+        faces = self.cascade.detectMultiScale(gray, self.scale_factor, self.min_neighbors,
+                                              minSize=(min_size, min_size), maxSize=(max_size, max_size))
+
+        detected_faces = []
+        for (x, y, w, h) in faces:
+            # Map back to full resolution coordinates
+            x, y, w, h = int(x / scale) + roi_x, int(y / scale) + roi_y, int(w / scale), int(h / scale)
+            detected_faces.append(FrameObject(x, y, w, h, w * h))
+
+        return detected_faces
+
+
+class DnnFaceDetector(FaceDetector):
+    """
+    The OpenCV SSD (res10_300x300) face detector - the same model the backend uses.
+    Far less false positives than the Haar cascade. The net is loaded once, and each ROI is resized to input_size x input_size
+    (smaller is faster, 300 is the size the model was trained on).
+    """
+    name = FACE_DETECTOR_DNN
+
+    def __init__(self, model_dir: str = DNN_MODEL_DIR, input_size: int = 300, confidence: float = 0.5, roi_padding: float = 0.1,
+                 min_face_size: int = 20):
+        super().__init__(roi_padding)
+        self.net = cv2.dnn.readNetFromCaffe(os.path.join(model_dir, 'deploy.prototxt'),
+                                            os.path.join(model_dir, 'res10_300x300_ssd_iter_140000.caffemodel'))
+        self.input_size = input_size
+        self.confidence = confidence
+        self.min_face_size = min_face_size
+
+    def _detect_roi(self, frame: ndarray, roi: Roi) -> List[FrameObject]:
+        roi_x, roi_y, roi_w, roi_h = roi
+        size = (self.input_size, self.input_size)
+        blob = cv2.dnn.blobFromImage(cv2.resize(frame[roi_y:roi_y + roi_h, roi_x:roi_x + roi_w], size), 1.0, size,
+                                     (104.0, 177.0, 123.0), swapRB=False, crop=False)
+        self.net.setInput(blob)
+        detections = self.net.forward()
+
+        detected_faces = []
+        for i in range(detections.shape[2]):
+            if detections[0, 0, i, 2] < self.confidence:
+                continue
+
+            # The box is relative to the ROI size. Map back to full resolution coordinates
+            start_x, start_y, end_x, end_y = detections[0, 0, i, 3:7].clip(0, 1) * (roi_w, roi_h, roi_w, roi_h)
+            x, y, w, h = int(start_x) + roi_x, int(start_y) + roi_y, int(end_x - start_x), int(end_y - start_y)
+            if w < self.min_face_size or h < self.min_face_size:
+                continue
+
+            detected_faces.append(FrameObject(x, y, w, h, w * h))
+
+        return detected_faces
+
+
+def create_face_detector(name: str = FACE_DETECTOR_HAAR, **kwargs) -> FaceDetector:
+    if name == FACE_DETECTOR_HAAR:
+        return HaarFaceDetector(**kwargs)
+    elif name == FACE_DETECTOR_DNN:
+        return DnnFaceDetector(**kwargs)
+
+    raise ValueError(f"Unknown face detector '{name}'")
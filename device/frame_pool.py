@@ -0,0 +1,122 @@
+import logging
+import threading
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+from numpy import ndarray
+
+
+# Frames held at once outside of the reader queue - the frame being processed, plus one being read
+FRAMES_IN_FLIGHT = 2
+
+
+class FramePool:
+    """
+    Preallocated, recycled capture buffers. The buffers are slots of a single block, allocated once when the frame size is known
+    (and again only if the camera changes its resolution).
+    Frames are handed out as read-only views, so no stage can draw on the shared pixels (overlays are drawn on their own layers).
+    Ownership is explicit - read() returns a frame with one reference. Whoever keeps a frame beyond the current loop iteration
+    (the reader queue, the clip recorder) takes another reference with retain(), and every reference is given back with release().
+    When all the buffers are taken, read() falls back to a regular (unpooled) frame, so a slow consumer costs allocations, never frames.
+    release() / retain() of unpooled frames do nothing.
+    """
+    def __init__(self, size: int):
+        self.size = max(1, size)
+        self.lock = threading.Lock()
+        self.block: Optional[ndarray] = None
+        self.block_address = 0
+        self.frame_shape: Optional[Tuple[int, ...]] = None
+        self.references: List[int] = []
+        self.free: List[int] = []
+
+        # Counters
+        self.pooled_reads = 0
+        self.unpooled_reads = 0
+
+        self.logger = logging.getLogger(__name__)
+
+    def read(self, cap: cv2.VideoCapture) -> Tuple[bool, Optional[ndarray]]:
+        """
+        Same contract as cv2.VideoCapture.read(), but the frame is read into a free buffer of the pool
+        """
+        slot = self._acquire()
+        if slot is None:
+            ret, frame = cap.read()
+            self.unpooled_reads += 1
+            if ret and frame.shape != self.frame_shape:
+                self._allocate(frame.shape, frame.dtype)
+            return ret, frame
+
+        buffer = self.block[slot]
+        ret, frame = cap.read(buffer)
+        if not ret or frame is None or frame.__array_interface__['data'][0] != buffer.__array_interface__['data'][0]:
+            # Nothing was read, or the capture allocated a new array (e.g. the resolution changed)
+            self._release_slot(slot)
+            self.unpooled_reads += 1
+            if ret and frame.shape != self.frame_shape:
+                self._allocate(frame.shape, frame.dtype)
+            return ret, frame
+
+        self.pooled_reads += 1
+        view = buffer.view()
+        view.flags.writeable = False
+
+        return True, view
+
+    def retain(self, frame: Optional[ndarray]) -> None:
+        slot = self._slot(frame)
+        if slot is not None:
+            with self.lock:
+                self.references[slot] += 1
+
+    def release(self, frame: Optional[ndarray]) -> None:
+        slot = self._slot(frame)
+        if slot is not None:
+            self._release_slot(slot)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'size': self.size,
+                'free': len(self.free),
+                'memory_usage': self.block.nbytes if self.block is not None else 0,
+                'pooled_reads': self.pooled_reads,
+                'unpooled_reads': self.unpooled_reads
+            }
+
+    def _allocate(self, frame_shape: Tuple[int, ...], dtype) -> None:
+        with self.lock:
+            # Frames of the previous block stay valid (numpy keeps the block alive), they are just not recycled anymore
+            self.block = np.empty((self.size, *frame_shape), dtype=dtype)
+            self.block_address = self.block.__array_interface__['data'][0]
+            self.frame_shape = frame_shape
+            self.references = [0] * self.size
+            self.free = list(range(self.size))
+        self.logger.info(f"Allocated {self.size} frame buffers of {frame_shape} ({self.block.nbytes // 1024 // 1024}MB)")
+
+    def _acquire(self) -> Optional[int]:
+        with self.lock:
+            if not self.free:
+                return None
+            slot = self.free.pop()
+            self.references[slot] = 1
+            return slot
+
+    def _release_slot(self, slot: int) -> None:
+        with self.lock:
+            if self.references[slot] > 0:
+                self.references[slot] -= 1
+                if self.references[slot] == 0:
+                    self.free.append(slot)
+
+    def _slot(self, frame: Optional[ndarray]) -> Optional[int]:
+        if frame is None or self.block is None:
+            return None
+
+        offset = frame.__array_interface__['data'][0] - self.block_address
+        slot_bytes = self.block[0].nbytes
+        if offset < 0 or offset >= self.block.nbytes or offset % slot_bytes or frame.nbytes != slot_bytes:
+            return None
+
+        return offset // slot_bytes
@@ -0,0 +1,78 @@
+import time
+from typing import Optional
+
+
+IDLE_FPS = 2
+IDLE_AFTER_SEC = 10
+CPU_BUDGET = None  # e.g. 0.5 to use at most half a core
+MIN_FPS = 1
+
+
+class FrameRateScheduler:
+    """
+    Chooses the processing frame rate of a camera:
+    * Motion switches to max_fps immediately, and the rate stays there until there was no motion for idle_after_sec.
+      Then it drops to idle_fps (motion detection still runs at the idle rate, so the start of an event is still caught)
+    * cpu_budget caps the rate so the processing takes at most this fraction of one core -
+      fps <= cpu_budget / (average processing time of a frame)
+    idle_fps / cpu_budget of None disable the idle rate / the cpu cap.
+    """
+    def __init__(self, max_fps: float, idle_fps: Optional[float] = IDLE_FPS, idle_after_sec: float = IDLE_AFTER_SEC,
+                 cpu_budget: Optional[float] = CPU_BUDGET, min_fps: float = MIN_FPS, smoothing: float = 0.2):
+        self.max_fps = max_fps
+        self.idle_fps = min(idle_fps, max_fps) if idle_fps else max_fps
+        self.idle_after_sec = idle_after_sec
+        self.cpu_budget = cpu_budget
+        self.min_fps = min(min_fps, self.idle_fps)
+        self.smoothing = smoothing
+
+        # Start active, so whatever is in front of the camera at startup is processed at the full rate
+        self.fps = max_fps
+        self.last_motion = time.time()
+        self.avg_processing_time = 0.0
+
+        # Counters
+        self.active_frames = 0
+        self.idle_frames = 0
+        self.cpu_limited_frames = 0
+
+    def update(self, motion: bool, processing_time: float, now: Optional[float] = None) -> float:
+        """
+        Report a processed frame. Returns the frame rate to continue with
+        """
+        now = now or time.time()
+        if motion:
+            self.last_motion = now
+
+        # Exponential moving average, so a single slow frame doesn't halve the rate
+        if self.avg_processing_time:
+            self.avg_processing_time += self.smoothing * (processing_time - self.avg_processing_time)
+        else:
+            self.avg_processing_time = processing_time
+
+        if now - self.last_motion < self.idle_after_sec:
+            fps = self.max_fps
+            self.active_frames += 1
+        else:
+            fps = self.idle_fps
+            self.idle_frames += 1
+
+        if self.cpu_budget and self.avg_processing_time > 0 and fps > self.cpu_budget / self.avg_processing_time:
+            fps = self.cpu_budget / self.avg_processing_time
+            self.cpu_limited_frames += 1
+
+        self.fps = max(self.min_fps, fps)
+
+        return self.fps
+
+    def interval(self) -> float:
+        return 1 / self.fps
+
+    def stats(self) -> dict:
+        return {
+            'fps': round(self.fps, 2),
+            'avg_processing_ms': round(self.avg_processing_time * 1000, 1),
+            'active_frames': self.active_frames,
+            'idle_frames': self.idle_frames,
+            'cpu_limited_frames': self.cpu_limited_frames
+        }
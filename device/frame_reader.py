@@ -0,0 +1,151 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import Optional, Tuple
+
+import cv2
+from numpy import ndarray
+
+from device.frame_pool import FramePool
+
+
+DROP_OLDEST = 'oldest'
+DROP_NEWEST = 'newest'
+DROP_NONE = 'block'
+DROP_POLICIES = (DROP_OLDEST, DROP_NEWEST, DROP_NONE)
+
+
+class FrameReader:
+    """
+    Reads frames from the camera (or a video file) on a dedicated thread, so a slow processing stage never stalls cap.read()
+    and the driver buffer never hands us stale frames.
+    Frames are handed to the processing stage through a bounded queue. When the queue is full, the drop policy decides what happens:
+    * oldest - Drop the oldest queued frame (processing always gets the freshest frames)
+    * newest - Drop the frame that was just read
+    * block - Don't drop anything, wait until the processing stage catches up (useful when replaying a file)
+    With a frame pool, frames are read into its recycled buffers. A frame returned by read() is owned by the caller,
+    which should release it back to the pool when done.
+    """
+    def __init__(self, cap: cv2.VideoCapture, fps: int, from_file: bool, queue_size: int = 2, drop_policy: str = DROP_OLDEST,
+                 pool: Optional[FramePool] = None):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"Unknown drop policy '{drop_policy}'. Should be one of {DROP_POLICIES}")
+
+        self.cap = cap
+        self.fps = fps
+        self.from_file = from_file
+        self.queue_size = max(1, queue_size)
+        self.drop_policy = drop_policy
+        self.pool = pool
+
+        self.frames = deque()
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread: Optional[threading.Thread] = None
+
+        # Counters
+        self.read_frames = 0
+        self.dropped_frames = 0
+        self.processed_frames = 0
+
+        self.logger = logging.getLogger(__name__)
+
+    def start(self) -> None:
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='frame_reader', daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+        # Frames that were read but never processed go back to the pool
+        with self.condition:
+            while self.frames:
+                self._release(self.frames.popleft())
+
+    def is_running(self) -> bool:
+        with self.condition:
+            return self.running or len(self.frames) > 0
+
+    def read(self) -> Tuple[bool, Optional[ndarray]]:
+        """
+        Same contract as cv2.VideoCapture.read() - Blocks until a frame is available and returns (False, None) once the reader has stopped
+        """
+        with self.condition:
+            while not self.frames and self.running:
+                self.condition.wait()
+
+            if not self.frames:
+                return False, None
+
+            frame = self.frames.popleft()
+            self.processed_frames += 1
+            self.condition.notify_all()
+
+            return True, frame
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {
+                'read_frames': self.read_frames,
+                'dropped_frames': self.dropped_frames,
+                'processed_frames': self.processed_frames,
+                'queued_frames': len(self.frames)
+            }
+
+    def _run(self) -> None:
+        prev_time = time.time()
+        while self.running and self.cap.isOpened():
+            ret, frame = self.pool.read(self.cap) if self.pool else self.cap.read()
+            if not ret:
+                break
+
+            if self.from_file:
+                # When reading from a file, we need to wait explicitly the fps time
+                time.sleep(1/self.fps)
+            else:
+                # When reading from camera, keep reading with the camera's capability so the driver buffer is always drained,
+                # but queue only the wanted frames according to the user requested frame rate
+                cur_time = time.time()
+                if cur_time - prev_time <= 1/self.fps:
+                    self._release(frame)
+                    continue
+                prev_time = cur_time
+
+            self._put(frame)
+
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+        self.logger.info(f"Frame reader finished. {self.stats()}")
+
+    def _put(self, frame: ndarray) -> None:
+        with self.condition:
+            self.read_frames += 1
+
+            if len(self.frames) >= self.queue_size:
+                if self.drop_policy == DROP_NONE:
+                    while len(self.frames) >= self.queue_size and self.running:
+                        self.condition.wait()
+                elif self.drop_policy == DROP_NEWEST:
+                    self.dropped_frames += 1
+                    self._release(frame)
+                    return
+                else:
+                    self._release(self.frames.popleft())
+                    self.dropped_frames += 1
+
+            self.frames.append(frame)
+            self.condition.notify_all()
+
+    def _release(self, frame: ndarray) -> None:
+        if self.pool:
+            self.pool.release(frame)
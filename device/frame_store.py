@@ -0,0 +1,174 @@
+import logging
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+from numpy import ndarray
+
+
+ENCODING_RAW = 'raw'
+ENCODING_DOWNSCALE = 'downscale'
+ENCODING_JPEG = 'jpeg'
+ENCODINGS = (ENCODING_RAW, ENCODING_DOWNSCALE, ENCODING_JPEG)
+
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+
+# When a jpeg doesn't fit into its slot, it's encoded again with those qualities
+JPEG_FALLBACK_QUALITIES = (60, 40, 20)
+# Frames start from the last quality that fit (usually a single encode), and every that many frames a higher quality is tried again
+JPEG_QUALITY_RAISE_EVERY = 50
+
+
+class FrameStore:
+    """
+    A ring of preallocated fixed size slots holding the pixels of the monitored frames, within a hard memory budget (in bytes).
+    The whole ring is allocated once (on the first frame, when the frame size is known) and never grows.
+    Encodings:
+    * raw - Frames are copied as is. The amount of slots is reduced if the budget can't hold all of them
+    * downscale - Frames are downscaled by the given scale before being copied, and upscaled back when taken out of the store
+    * jpeg - Frames are jpeg encoded in memory. Each slot gets an equal share of the budget. Encoding starts from the last
+             quality that fit, so a scene that needs a lower quality doesn't pay for the higher ones on every frame
+    put() returns a frame id (or None if the frame didn't fit), and get() returns the full resolution frame of an id
+    (or None if its slot was already reused). Slots are reused in the order of the frame ids, so every id older than oldest_id()
+    is gone.
+    """
+    def __init__(self, capacity: int, memory_budget: int = DEFAULT_MEMORY_BUDGET, encoding: str = ENCODING_JPEG,
+                 jpeg_quality: int = 85, scale: float = 0.5):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown frame store encoding '{encoding}'. Should be one of {ENCODINGS}")
+
+        self.capacity = capacity
+        self.memory_budget = memory_budget
+        self.encoding = encoding
+        self.jpeg_quality = jpeg_quality
+        self.jpeg_qualities = (jpeg_quality,) + tuple(q for q in JPEG_FALLBACK_QUALITIES if q < jpeg_quality)
+        self.jpeg_quality_index = 0
+        self.scale = scale if encoding == ENCODING_DOWNSCALE else 1.0
+
+        self.frame_shape: Optional[Tuple[int, ...]] = None
+        self.stored_shape: Optional[Tuple[int, ...]] = None
+        self.slots = 0
+        self.slot_size = 0
+        self.buffer: Optional[ndarray] = None
+        self.lengths: Optional[ndarray] = None
+        self.ids: Optional[ndarray] = None
+        self.next_id = 0
+
+        # Counters
+        self.stored_frames = 0
+        self.rejected_frames = 0
+        self.jpeg_encodes = 0
+
+        self.logger = logging.getLogger(__name__)
+
+    def put(self, frame: ndarray) -> Optional[int]:
+        if self.frame_shape != frame.shape:
+            self._allocate(frame.shape)
+
+        frame_id = self.next_id
+        self.next_id += 1
+        slot = frame_id % self.slots
+
+        if self.encoding == ENCODING_JPEG:
+            length = self._encode_jpeg(frame, slot)
+        else:
+            stored = self.buffer[slot, :self.slot_size].reshape(self.stored_shape)
+            if self.scale < 1.0:
+                cv2.resize(frame, (self.stored_shape[1], self.stored_shape[0]), dst=stored, interpolation=cv2.INTER_AREA)
+            else:
+                np.copyto(stored, frame)
+            length = self.slot_size
+
+        if length:
+            self.ids[slot] = frame_id
+            self.lengths[slot] = length
+            self.stored_frames += 1
+        else:
+            self.ids[slot] = -1
+            self.rejected_frames += 1
+            return None
+
+        return frame_id
+
+    def get(self, frame_id: Optional[int]) -> Optional[ndarray]:
+        """
+        Decode a frame back to full resolution. The returned frame is a new array, it's not affected by following puts.
+        """
+        if frame_id is None or self.buffer is None:
+            return None
+
+        slot = frame_id % self.slots
+        if self.ids[slot] != frame_id:
+            return None
+
+        if self.encoding == ENCODING_JPEG:
+            return cv2.imdecode(self.buffer[slot, :self.lengths[slot]], cv2.IMREAD_COLOR)
+
+        stored = self.buffer[slot, :self.slot_size].reshape(self.stored_shape)
+        if self.scale < 1.0:
+            return cv2.resize(stored, (self.frame_shape[1], self.frame_shape[0]), interpolation=cv2.INTER_LINEAR)
+
+        return stored.copy()
+
+    def oldest_id(self) -> int:
+        return max(0, self.next_id - self.slots)
+
+    def memory_usage(self) -> int:
+        return self.buffer.nbytes if self.buffer is not None else 0
+
+    def used_memory(self) -> int:
+        """
+        Bytes taken by the stored frames (a jpeg takes only part of its slot), out of the allocated memory_usage()
+        """
+        return int(self.lengths[self.ids >= 0].sum()) if self.buffer is not None else 0
+
+    def stats(self) -> dict:
+        return {
+            'encoding': self.encoding,
+            'slots': self.slots,
+            'slot_size': self.slot_size,
+            'memory_usage': self.memory_usage(),
+            'used_memory': self.used_memory(),
+            'stored_frames': self.stored_frames,
+            'rejected_frames': self.rejected_frames,
+            'jpeg_encodes': self.jpeg_encodes,
+            'jpeg_quality': self.jpeg_qualities[self.jpeg_quality_index]
+        }
+
+    def _allocate(self, frame_shape: Tuple[int, ...]) -> None:
+        self.frame_shape = frame_shape
+        if self.scale < 1.0:
+            self.stored_shape = (max(1, int(frame_shape[0] * self.scale)), max(1, int(frame_shape[1] * self.scale))) + frame_shape[2:]
+        else:
+            self.stored_shape = frame_shape
+
+        if self.encoding == ENCODING_JPEG:
+            self.slots = self.capacity
+            self.slot_size = self.memory_budget // self.slots
+        else:
+            self.slot_size = int(np.prod(self.stored_shape))
+            self.slots = max(1, min(self.capacity, self.memory_budget // self.slot_size))
+
+        self.buffer = np.empty((self.slots, self.slot_size), dtype=np.uint8)
+        self.lengths = np.zeros(self.slots, dtype=np.int64)
+        self.ids = np.full(self.slots, -1, dtype=np.int64)
+
+        self.logger.info(f"Allocated frame store. {self.stats()}")
+
+    def _encode_jpeg(self, frame: ndarray, slot: int) -> int:
+        # Runs on the capture thread - start from the last quality that fit, and only once in a while try a higher one again
+        start = self.jpeg_quality_index
+        if start > 0 and self.next_id % JPEG_QUALITY_RAISE_EVERY == 0:
+            start -= 1
+
+        for index in range(start, len(self.jpeg_qualities)):
+            _, encoded = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_qualities[index]])
+            self.jpeg_encodes += 1
+            if len(encoded) <= self.slot_size:
+                self.buffer[slot, :len(encoded)] = encoded.ravel()
+                self.jpeg_quality_index = index
+                return len(encoded)
+
+        self.logger.warning(f"Frame doesn't fit into a frame store slot of {self.slot_size} bytes even with the lowest jpeg quality")
+
+        return 0
@@ -1,84 +1,395 @@
 import io
+import sys
+import time
 import logging
-from typing import List, Any, Optional
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import nullcontext
+from typing import List, Any, Optional, Tuple, Callable
 
 import cv2
 import requests
+from requests.adapters import HTTPAdapter
 from numpy import ndarray
 
-from device.common import MonitoredFrame
-from device import video_processing
+from device.common import MonitoredFrame, FrameObject
+from device import video_processing, metrics
 
 
+UPLOAD_WORKERS = 4
+UPLOAD_RETRIES = 2
+UPLOAD_RETRY_BACKOFF_SEC = 0.5
+UPLOAD_TIMEOUT_SEC = 30
+
+UPLOAD_MODE_FULL = 'full'  # The full frame, and the full blurred frame
+UPLOAD_MODE_CROPS = 'crops'  # Padded crops of the faces (or moving objects) under their own keys, and a small blurred thumbnail of the scene
+UPLOAD_MODES = (UPLOAD_MODE_FULL, UPLOAD_MODE_CROPS)
+IMAGE_FORMAT_JPEG = 'jpeg'
+IMAGE_FORMAT_WEBP = 'webp'
+IMAGE_FORMATS = (IMAGE_FORMAT_JPEG, IMAGE_FORMAT_WEBP)
+DEFAULT_QUALITY = 95  # cv2.imencode's default jpeg quality
+MIN_QUALITY = 30
+QUALITY_SEARCH_STEPS = 4
+CROP_PADDING = 0.5  # Of the crop size, on each side
+MAX_CROPS_AREA_RATIO = 0.5  # Upload the full frame when the crops cover more than this part of it
+THUMBNAIL_WIDTH = 320
+SAVINGS_SAMPLE_EVERY = 10  # Every N frames, the legacy encoding is measured as well to estimate the bytes saved
+
 logger = logging.getLogger(__name__)
 
+this = sys.modules[__name__]
+this.uploader = None
+
+# The presigned upload urls of a frame - (original frame, blurred frame with features, crops)
+UploadUrls = Tuple[dict, dict, List[dict]]
+
 
-def send_motion_frames(frames: List[MonitoredFrame], upload_url_data: dict, upload_url_data_features: dict) -> None:
-    # TODO - Send concurrently
+class FrameEncoder:
     """
-    Send only the face in the frame (extract a larger area around the head)
-    If no face, send only metadata
+    Prepares and encodes the two upload variants of a reported frame (the original, and the blurred features image) in one pass -
+    the crops, the thumbnail and the scaled objects are computed once for both of them.
+    Modes:
+    * full - The full frame and the full blurred frame (as before)
+    * crops - The padded crops of the faces (or of the moving objects when there are no faces), each one a separate image
+              (uploaded under its own key instead of the full frame), and a small blurred and annotated thumbnail of the whole scene.
+              When the crops would cover most of the frame, the full frame is the original as in the full mode
+    With a target_bytes, the quality of every image is searched (a few encodes, starting from the last quality that fit)
+    for the best quality that fits the target. Without one, images are encoded in the default quality.
+    Every SAVINGS_SAMPLE_EVERY frames the legacy encoding (full frames, default quality) is measured too, to estimate the bytes saved.
     """
-    for monitored_frame in frames:
-        # Upload original frame
-        prepare_and_upload_file(monitored_frame.frame, upload_url_data)
+    def __init__(self, mode: str = UPLOAD_MODE_FULL, image_format: str = IMAGE_FORMAT_JPEG, target_bytes: Optional[int] = None,
+                 crop_padding: float = CROP_PADDING, thumbnail_width: int = THUMBNAIL_WIDTH):
+        if mode not in UPLOAD_MODES:
+            raise ValueError(f"Unknown upload mode '{mode}'. Should be one of {UPLOAD_MODES}")
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError(f"Unknown image format '{image_format}'. Should be one of {IMAGE_FORMATS}")
 
-        # Upload a blurred frame with all the detected objects
-        blurred_frame = video_processing.blur(monitored_frame.frame, monitored_frame.faces)
-        video_processing.draw_objects_in_frame(blurred_frame, monitored_frame.objects)
-        video_processing.draw_objects_in_frame(blurred_frame, monitored_frame.faces, (255, 0, 0))
-        prepare_and_upload_file(blurred_frame, upload_url_data_features)
+        self.mode = mode
+        self.image_format = image_format
+        self.target_bytes = target_bytes
+        self.crop_padding = crop_padding
+        self.thumbnail_width = thumbnail_width
+        self.last_quality = {'original': DEFAULT_QUALITY, 'features': DEFAULT_QUALITY, 'crop': DEFAULT_QUALITY}
 
-        # TODO - An option to upload multiple frames
-        break
+        # Counters
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.output_bytes = 0
+        self.encoded_bytes = 0  # Including the encodes of the quality search
+        self.encodes = 0
+        self.sampled_bytes = 0
+        self.sampled_legacy_bytes = 0
 
+    def count_crops(self, monitored_frame: MonitoredFrame) -> int:
+        """
+        The amount of crops encode() makes of the frame (0 when the full frame is the original)
+        """
+        if self.mode != UPLOAD_MODE_CROPS:
+            return 0
 
-def prepare_and_upload_file(frame: ndarray, upload_url_data: dict):
-    # Compress frame to jpg and convert ndarray to a stream
-    encoded_image_bytes = cv2.imencode('.jpg', frame)[1]
-    stream = io.BytesIO(encoded_image_bytes)
+        return len(self._crop_boxes(monitored_frame.frame.shape, monitored_frame.faces or monitored_frame.objects))
 
-    upload_file_s3(upload_url_data, stream)
+    def encode(self, monitored_frame: MonitoredFrame, timed: Optional[Callable[[str], Any]] = None,
+               crops: bool = True) -> Tuple[Optional[bytes], bytes, List[bytes]]:
+        """
+        Returns the encoded (original, features, crops) images of the frame - either the original or the crops are given
+        timed - An optional context manager factory, called with the stage name ('blur', 'annotate', 'encode') to time each stage
+        crops - Whether the crops can be uploaded (there are upload urls for them). Otherwise the original is the full frame
+        """
+        timed = timed or (lambda stage: nullcontext())
+        frame, faces, objects = monitored_frame.frame, monitored_frame.faces, monitored_frame.objects
+        # Coasted faces aren't cropped or annotated, only kept unblurred
+        coasted_faces = monitored_frame.coasted_faces
 
+        crop_images = []
+        if self.mode == UPLOAD_MODE_CROPS and crops:
+            crop_images = [frame[y1:y2, x1:x2] for x1, y1, x2, y2 in self._crop_boxes(frame.shape, faces or objects)]
+        original = frame if not crop_images else None
+        if self.mode == UPLOAD_MODE_CROPS:
+            # The features image is a thumbnail, so blurring and annotating it is cheap as well
+            scale = min(1.0, self.thumbnail_width / frame.shape[1])
+            frame = cv2.resize(frame, (int(frame.shape[1] * scale), int(frame.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+            faces, objects, coasted_faces = scale_objects(faces, scale), scale_objects(objects, scale), scale_objects(coasted_faces, scale)
 
-def get_upload_url_data() -> dict:
-    response = requests.get('https://3yhxtqrdvk.execute-api.us-east-1.amazonaws.com/default/getPresignedUrl')
-    res = response.json()
+        with timed('blur'):
+            features = video_processing.blur(frame, faces + coasted_faces)
+        with timed('annotate'):
+            video_processing.draw_objects_in_frame(features, objects)
+            video_processing.draw_objects_in_frame(features, faces, (255, 0, 0))
 
-    return res['upload_url']
+        with timed('encode'):
+            original_bytes = self.encode_image(original, 'original') if original is not None else None
+            features_bytes = self.encode_image(features, 'features')
+            crops_bytes = [self.encode_image(crop, 'crop') for crop in crop_images]
+
+        output_bytes = len(original_bytes or b'') + len(features_bytes) + sum(len(crop) for crop in crops_bytes)
+        with self.lock:
+            self.frames += 1
+            self.output_bytes += output_bytes
+            sample = (self.frames - 1) % SAVINGS_SAMPLE_EVERY == 0
+        if sample and (self.mode != UPLOAD_MODE_FULL or self.target_bytes or self.image_format != IMAGE_FORMAT_JPEG):
+            self._sample_savings(monitored_frame, output_bytes)
+
+        return original_bytes, features_bytes, crops_bytes
+
+    def encode_image(self, image: ndarray, variant: str = 'original') -> bytes:
+        if not self.target_bytes:
+            return self._encode(image, DEFAULT_QUALITY)
+
+        # Start from the quality that fit last time (frames of a camera are alike), search down if it doesn't fit anymore
+        # and probe once upwards if it fits with a large margin. Frames are encoded concurrently, the last one to finish wins
+        with self.lock:
+            quality = self.last_quality[variant]
+        data = self._encode(image, quality)
+        if len(data) <= self.target_bytes:
+            if quality < DEFAULT_QUALITY and len(data) < self.target_bytes * 0.7:
+                higher = self._encode(image, min(DEFAULT_QUALITY, quality + 10))
+                if len(higher) <= self.target_bytes:
+                    quality, data = min(DEFAULT_QUALITY, quality + 10), higher
+        else:
+            low, high = MIN_QUALITY, quality - 1
+            best = None
+            for _ in range(QUALITY_SEARCH_STEPS):
+                if low > high:
+                    break
+                mid = (low + high) // 2
+                candidate = self._encode(image, mid)
+                if len(candidate) <= self.target_bytes:
+                    best, quality = candidate, mid
+                    low = mid + 1
+                else:
+                    high = mid - 1
+            # Nothing fits - upload the smallest we have
+            if best is None:
+                quality, best = MIN_QUALITY, self._encode(image, MIN_QUALITY)
+            data = best
+
+        with self.lock:
+            self.last_quality[variant] = quality
+
+        return data
+
+    def stats(self) -> dict:
+        with self.lock:
+            savings_ratio = 1 - self.sampled_bytes / self.sampled_legacy_bytes if self.sampled_legacy_bytes else 0.0
+            return {
+                'mode': self.mode,
+                'format': self.image_format,
+                'frames': self.frames,
+                'encodes': self.encodes,
+                'output_bytes': self.output_bytes,
+                'quality': dict(self.last_quality),
+                'savings_ratio': round(savings_ratio, 3),
+                'bytes_saved_estimate': int(self.output_bytes * savings_ratio / (1 - savings_ratio)) if savings_ratio < 1 else None
+            }
 
+    def _encode(self, image: ndarray, quality: int) -> bytes:
+        if self.image_format == IMAGE_FORMAT_WEBP:
+            data = cv2.imencode('.webp', image, [cv2.IMWRITE_WEBP_QUALITY, quality])[1].tobytes()
+        else:
+            data = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
 
-def upload_file_s3(upload_url_data: dict, frame_stream: Any) -> None:
-    url = upload_url_data['url']
+        with self.lock:
+            self.encodes += 1
+            self.encoded_bytes += len(data)
 
+        return data
+
+    def _crop_boxes(self, frame_shape: Tuple[int, ...], frame_objects: List[FrameObject]) -> List[Tuple[int, int, int, int]]:
+        # The padded (x1, y1, x2, y2) boxes of the objects, or none when it's better to upload the full frame
+        height, width = frame_shape[:2]
+        boxes = []
+        for frame_object in frame_objects:
+            pad_x, pad_y = int(frame_object.w * self.crop_padding), int(frame_object.h * self.crop_padding)
+            x1, y1 = max(0, frame_object.x - pad_x), max(0, frame_object.y - pad_y)
+            x2, y2 = min(width, frame_object.x + frame_object.w + pad_x), min(height, frame_object.y + frame_object.h + pad_y)
+            if x2 > x1 and y2 > y1:
+                boxes.append((x1, y1, x2, y2))
+
+        if sum((x2 - x1) * (y2 - y1) for x1, y1, x2, y2 in boxes) > width * height * MAX_CROPS_AREA_RATIO:
+            return []
+
+        return boxes
+
+    def _sample_savings(self, monitored_frame: MonitoredFrame, encoded_bytes: int) -> None:
+        legacy_bytes = len(cv2.imencode('.jpg', monitored_frame.frame)[1])
+        legacy_bytes += len(cv2.imencode('.jpg', video_processing.blur(monitored_frame.frame, monitored_frame.faces))[1])
+        with self.lock:
+            self.sampled_bytes += encoded_bytes
+            self.sampled_legacy_bytes += legacy_bytes
+        metrics.set_gauge('upload_savings_ratio', self.stats()['savings_ratio'])
+
+
+def scale_objects(frame_objects: List[FrameObject], scale: float) -> List[FrameObject]:
+    return [FrameObject(int(o.x * scale), int(o.y * scale), int(o.w * scale), int(o.h * scale), int(o.area * scale * scale), o.track_id)
+            for o in frame_objects]
+
+
+class FramesUploader:
     """
-    curl -X POST \
-      https://smart-guard-files.s3.amazonaws.com/ \
-      -H 'cache-control: no-cache' \
-      -H 'content-type: multipart/form-data; boundary=----WebKitFormBoundary7MA4YWxkTrZu0gW' \
-      -F AWSAccessKeyId=ASI... \
-      -F signature=YzATDe... \
-      -F policy=eyJleHBpc... \
-      -F Content-Type=jpeg \
-      -F key=4446.jpg \
-      -F 'x-amz-security-token=IQoJb3JpZ2luX2VjEHoaCXVzLWVhc3Qt...' \
-      -F acl=private \
-      -F file=@9076.jpg
+    Uploads encoded frames to S3 presigned urls (the frames are prepared and encoded by the post processing, see submit_encoded).
+    All uploads go through one pooled HTTP session (keep-alive, so the TLS connection is reused),
+    and the original and blurred/features uploads of all frames run in parallel on a small worker pool.
+    Failed uploads (connection errors and 5xx) are retried a bounded amount of times.
     """
+    def __init__(self, workers: int = UPLOAD_WORKERS, retries: int = UPLOAD_RETRIES, timeout: float = UPLOAD_TIMEOUT_SEC):
+        self.retries = retries
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='uploader')
+
+        # Counters
+        self.lock = threading.Lock()
+        self.uploads = 0
+        self.failed_uploads = 0
+        self.retried_uploads = 0
+        self.uploaded_bytes = 0
+        self.latencies = deque(maxlen=1000)
+
+    def submit(self, upload_url_data: dict, data: bytes) -> Future:
+        """
+        Upload an encoded frame on the worker pool
+        """
+        return self.executor.submit(self.upload_file_s3, upload_url_data, data)
+
+    def upload_file_s3(self, upload_url_data: dict, data: bytes) -> bool:
+        url = upload_url_data['url']
+
+        """
+        curl -X POST \
+          https://smart-guard-files.s3.amazonaws.com/ \
+          -H 'cache-control: no-cache' \
+          -H 'content-type: multipart/form-data; boundary=----WebKitFormBoundary7MA4YWxkTrZu0gW' \
+          -F AWSAccessKeyId=ASI... \
+          -F signature=YzATDe... \
+          -F policy=eyJleHBpc... \
+          -F Content-Type=jpeg \
+          -F key=4446.jpg \
+          -F 'x-amz-security-token=IQoJb3JpZ2luX2VjEHoaCXVzLWVhc3Qt...' \
+          -F acl=private \
+          -F file=@9076.jpg
+        """
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(UPLOAD_RETRY_BACKOFF_SEC * 2 ** (attempt - 1))
+                with self.lock:
+                    self.retried_uploads += 1
 
-    response = requests.post(url, data=upload_url_data['fields'], files={
-        'file': (upload_url_data['fields']['key'], frame_stream, 'image/jpeg')
-    })
+            start = time.perf_counter()
+            try:
+                response = self.session.post(url, data=upload_url_data['fields'], timeout=self.timeout, files={
+                    'file': (upload_url_data['fields']['key'], io.BytesIO(data), 'image/webp' if data[:4] == b'RIFF' else 'image/jpeg')
+                })
+            except requests.RequestException as e:
+                logger.warning(f"Failed uploading frame (attempt {attempt + 1}). {e}")
+                continue
 
-    if 300 > response.status_code >= 200:
-        logger.info("Uploaded frame successfully")
-    else:
-        logging.info("Failed uploading frame. " + response.text)
+            if 300 > response.status_code >= 200:
+                with self.lock:
+                    self.uploads += 1
+                    self.uploaded_bytes += len(data)
+                    self.latencies.append(time.perf_counter() - start)
+                metrics.observe('stage_seconds', time.perf_counter() - start, stage='upload')
+                metrics.inc('uploaded_bytes_total', len(data))
+                logger.info("Uploaded frame successfully")
+
+                return True
+
+            logger.info(f"Failed uploading frame (attempt {attempt + 1}). " + response.text)
+            if response.status_code < 500:
+                # Client errors (e.g. an expired presigned url) won't be fixed by retrying
+                break
+
+        with self.lock:
+            self.failed_uploads += 1
+        metrics.inc('failed_uploads_total')
+
+        return False
+
+    def stats(self) -> dict:
+        with self.lock:
+            latencies = sorted(self.latencies)
+            return {
+                'uploads': self.uploads,
+                'failed_uploads': self.failed_uploads,
+                'retried_uploads': self.retried_uploads,
+                'uploaded_bytes': self.uploaded_bytes,
+                'latency_p50_ms': round(latencies[len(latencies) // 2] * 1000, 1) if latencies else None,
+                'latency_max_ms': round(latencies[-1] * 1000, 1) if latencies else None
+            }
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+
+def submit_encoded(uploader: Any, upload_urls: UploadUrls, original: Optional[bytes], features: bytes, crops: List[bytes]) -> List[Future]:
+    """
+    Upload the encoded images of a frame (see FrameEncoder.encode) through the uploader, each one to its own url
+    """
+    upload_url_data, upload_url_data_features, crops_upload_url_data = upload_urls
+    futures = [uploader.submit(upload_url_data_features, features)]
+    if original is not None:
+        futures.append(uploader.submit(upload_url_data, original))
+    for crop_upload_url_data, crop in zip(crops_upload_url_data, crops):
+        futures.append(uploader.submit(crop_upload_url_data, crop))
+
+    return futures
+
+
+def get_uploader() -> FramesUploader:
+    if this.uploader is None:
+        this.uploader = FramesUploader()
+
+    return this.uploader
+
+
+def get_upload_url_data() -> dict:
+    response = get_uploader().session.get('https://3yhxtqrdvk.execute-api.us-east-1.amazonaws.com/default/getPresignedUrl')
+    res = response.json()
+
+    return res['upload_url']
+
+
+def upload_file_s3(upload_url_data: dict, frame_stream: Any) -> bool:
+    return get_uploader().upload_file_s3(upload_url_data, frame_stream.read())
 
 
 if __name__ == '__main__':
-    # Testing
+    # Testing against a local HTTP stub standing in for S3
     from datetime import datetime as dt
-    img = cv2.imread('/home/edi/Downloads/9076.jpg', 1)
-    frame = MonitoredFrame(time=dt.now(), frame=img, objects=[], faces=[], score=0)
-    send_motion_frames([frame])
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    import numpy as np
+
+    class S3Stub(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers['Content-Length']))
+            self.send_response(204)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), S3Stub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    stub_url = {'url': f"http://127.0.0.1:{server.server_port}/", 'fields': {'key': 'test.jpg'}}
+
+    img = np.random.randint(0, 255, (720, 1280, 3), dtype=np.uint8)
+    encoder = FrameEncoder()
+    frames = [MonitoredFrame(time=dt.now(), frame=img, objects=[], faces=[], score=0) for _ in range(3)]
+    futures = [future for monitored_frame in frames
+               for future in submit_encoded(get_uploader(), (stub_url, stub_url, []), *encoder.encode(monitored_frame))]
+    print(all(future.result() for future in futures), get_uploader().stats())
+
+    # Crops and a thumbnail, within 30KB
+    encoder = FrameEncoder(UPLOAD_MODE_CROPS, target_bytes=30 * 1024)
+    face = FrameObject(600, 200, 120, 150, 120 * 150)
+    _, features, crops = encoder.encode(MonitoredFrame(time=dt.now(), frame=img, objects=[face], faces=[face], score=0))
+    print(f"Crops: {[len(crop) for crop in crops]} bytes, thumbnail: {len(features)} bytes. {encoder.stats()}")
+    server.shutdown()
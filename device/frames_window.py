@@ -0,0 +1,100 @@
+from collections import deque
+from datetime import datetime as dt
+from typing import List, Optional
+
+import numpy as np
+
+from device.common import FrameObject, MonitoredFrame
+
+
+class FramesWindow:
+    """
+    Metadata of the monitored frames, kept in a columnar ring buffer (numpy arrays for the times, scores and frame ids).
+    Scores are given once, when a frame is appended.
+    A monotonic deque of the frames in the last window_sec seconds (ordered by time, with decreasing scores) answers
+    "what is the best frame in the window" in O(1) amortized time, so checking the activity costs almost nothing.
+    Only frames with stored pixels (a frame id) can be the best frame.
+    """
+    def __init__(self, capacity: int, window_sec: float):
+        self.capacity = capacity
+        self.window_sec = window_sec
+
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.scores = np.zeros(capacity, dtype=np.float32)
+        self.frame_ids = np.full(capacity, -1, dtype=np.int64)
+        self.objects: List[Optional[List[FrameObject]]] = [None] * capacity
+        self.faces: List[Optional[List[FrameObject]]] = [None] * capacity
+        self.coasted_faces: List[Optional[List[FrameObject]]] = [None] * capacity
+
+        # Sequence number of the next appended frame. The slot of a sequence number is seq % capacity
+        self.count = 0
+
+        # Sequence numbers of the candidates for the window max
+        self.max_candidates = deque()
+
+        # Sequence number of the newest frame with stored pixels
+        self.newest_stored = None
+
+    def __len__(self) -> int:
+        return min(self.count, self.capacity)
+
+    def append(self, time: float, score: float, frame_id: Optional[int], objects: List[FrameObject], faces: List[FrameObject],
+               coasted_faces: Optional[List[FrameObject]] = None) -> None:
+        seq = self.count
+        slot = seq % self.capacity
+        self.times[slot] = time
+        self.scores[slot] = score
+        self.frame_ids[slot] = frame_id if frame_id is not None else -1
+        self.objects[slot] = objects
+        self.faces[slot] = faces
+        self.coasted_faces[slot] = coasted_faces or []
+        self.count += 1
+
+        # Frames without pixels or without any score can never be the best frame
+        if frame_id is None:
+            return
+        self.newest_stored = seq
+        if score <= 0:
+            return
+
+        # Keep the earliest frame among frames with the same score (same as max())
+        while self.max_candidates and self.scores[self.max_candidates[-1] % self.capacity] < score:
+            self.max_candidates.pop()
+        self.max_candidates.append(seq)
+
+    def best(self, now: float, oldest_frame_id: int = 0) -> Optional[MonitoredFrame]:
+        """
+        The frame with the highest score in the last window_sec seconds, or None if there was no scored frame in the window.
+        oldest_frame_id - Frames with older ids were evicted from the frame store, so they're out of the window as well
+        """
+        self._expire(now, oldest_frame_id)
+        if not self.max_candidates:
+            return None
+
+        return self.get(self.max_candidates[0])
+
+    def newest(self, now: float) -> Optional[MonitoredFrame]:
+        """
+        The newest frame with stored pixels in the last window_sec seconds (whatever its score)
+        """
+        if self.newest_stored is None or self.newest_stored < self.count - self.capacity or \
+                self.times[self.newest_stored % self.capacity] < now - self.window_sec:
+            return None
+
+        return self.get(self.newest_stored)
+
+    def get(self, seq: int) -> MonitoredFrame:
+        slot = seq % self.capacity
+        frame_id = int(self.frame_ids[slot])
+
+        return MonitoredFrame(time=dt.fromtimestamp(self.times[slot]), frame=None, objects=self.objects[slot], faces=self.faces[slot],
+                              score=float(self.scores[slot]), frame_id=frame_id if frame_id >= 0 else None,
+                              coasted_faces=self.coasted_faces[slot])
+
+    def _expire(self, now: float, oldest_frame_id: int = 0) -> None:
+        # Frame ids grow with the sequence numbers, so the candidates evicted from the frame store are always the oldest ones
+        oldest_seq = self.count - self.capacity
+        while self.max_candidates and (self.max_candidates[0] < oldest_seq or
+                                       self.times[self.max_candidates[0] % self.capacity] < now - self.window_sec or
+                                       self.frame_ids[self.max_candidates[0] % self.capacity] < oldest_frame_id):
+            self.max_candidates.popleft()
@@ -0,0 +1,208 @@
+"""
+Built-in instrumentation of the device - counters, gauges and latency histograms.
+Exposed in the Prometheus text exposition format, either by a local HTTP endpoint or by a periodically written file
+(e.g. for node_exporter's textfile collector).
+Camera processes forward snapshots of their metrics to the supervisor, which renders them with a camera label.
+"""
+import os
+import sys
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Tuple
+
+
+PREFIX = 'smartguard_'
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+this = sys.modules[__name__]
+this.lock = threading.Lock()
+this.counters: Dict[MetricKey, float] = {}
+this.gauges: Dict[MetricKey, float] = {}
+this.histograms: Dict[MetricKey, List] = {}  # key -> [bucket counts, sum, count]
+this.collectors: List[Callable[[], None]] = []
+this.remote_snapshots: Dict[str, dict] = {}  # camera id -> the last snapshot of its process
+this.logger = logging.getLogger(__name__)
+
+
+def _key(name: str, labels: dict) -> MetricKey:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    key = _key(name, labels)
+    with this.lock:
+        this.counters[key] = this.counters.get(key, 0) + value
+
+
+def set_counter(name: str, value: float, **labels) -> None:
+    """
+    Set a counter that is counted elsewhere (e.g. a component's own monotonic counter), from a collector
+    """
+    with this.lock:
+        this.counters[_key(name, labels)] = value
+
+
+def set_gauge(name: str, value: float, **labels) -> None:
+    with this.lock:
+        this.gauges[_key(name, labels)] = value
+
+
+def observe(name: str, value: float, **labels) -> None:
+    key = _key(name, labels)
+    with this.lock:
+        histogram = this.histograms.get(key)
+        if histogram is None:
+            histogram = this.histograms[key] = [[0] * len(DEFAULT_BUCKETS), 0.0, 0]
+
+        for i, bound in enumerate(DEFAULT_BUCKETS):
+            if value <= bound:
+                histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+@contextmanager
+def timer(name: str, **labels):
+    """
+    Observe the duration (in seconds) of the block in a histogram
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def register_collector(collector: Callable[[], None]) -> None:
+    """
+    The collector is called before every rendering, to refresh gauges from state that is kept elsewhere (queues, buffers, counters)
+    """
+    with this.lock:
+        if collector not in this.collectors:
+            this.collectors.append(collector)
+
+
+def _collect() -> None:
+    for collector in list(this.collectors):
+        try:
+            collector()
+        except Exception:
+            this.logger.exception("Metrics collector failed")
+
+
+def snapshot() -> dict:
+    """
+    A copy of all the metrics of this process (picklable, to be passed to another process)
+    """
+    _collect()
+    with this.lock:
+        return {
+            'counters': dict(this.counters),
+            'gauges': dict(this.gauges),
+            'histograms': {key: [list(buckets), total, count] for key, (buckets, total, count) in this.histograms.items()}
+        }
+
+
+def set_remote_snapshot(camera_id: str, metrics_snapshot: dict) -> None:
+    with this.lock:
+        this.remote_snapshots[camera_id] = metrics_snapshot
+
+
+def render() -> str:
+    _collect()
+
+    def format_labels(labels, extra=()):
+        labels = labels + tuple(extra)
+        return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}' if labels else ''
+
+    lines = []
+    with this.lock:
+        # The metrics of this process, and the metrics of every camera process with its camera label
+        sources = [((), {'counters': this.counters, 'gauges': this.gauges, 'histograms': this.histograms})]
+        sources += [((('camera', camera_id),), remote) for camera_id, remote in sorted(this.remote_snapshots.items())]
+
+        for metric_type in ('counter', 'gauge'):
+            metrics = [(source_labels, key, value) for source_labels, source in sources for key, value in source[f"{metric_type}s"].items()]
+            for name in sorted({name for _, (name, _), _ in metrics}):
+                lines.append(f"# TYPE {PREFIX}{name} {metric_type}")
+                for source_labels, (metric_name, labels), value in metrics:
+                    if metric_name == name:
+                        lines.append(f"{PREFIX}{name}{format_labels(source_labels + labels)} {value}")
+
+        histograms = [(source_labels, key, value) for source_labels, source in sources for key, value in source['histograms'].items()]
+        for name in sorted({name for _, (name, _), _ in histograms}):
+            lines.append(f"# TYPE {PREFIX}{name} histogram")
+            for source_labels, (metric_name, labels), (buckets, total, count) in histograms:
+                if metric_name != name:
+                    continue
+                labels = source_labels + labels
+                for bound, bucket_count in zip(DEFAULT_BUCKETS, buckets):
+                    lines.append(f"{PREFIX}{name}_bucket{format_labels(labels, [('le', bound)])} {bucket_count}")
+                lines.append(f"{PREFIX}{name}_bucket{format_labels(labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{PREFIX}{name}_sum{format_labels(labels)} {total}")
+                lines.append(f"{PREFIX}{name}_count{format_labels(labels)} {count}")
+
+    return '\n'.join(lines) + '\n'
+
+
+def start_http_server(port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics_http', daemon=True).start()
+    this.logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+    return server
+
+
+def start_file_writer(path: str, period_sec: float = 15) -> threading.Thread:
+    def write_periodically():
+        while True:
+            time.sleep(period_sec)
+            try:
+                # Write and rename, so readers never see a partial file
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, 'w') as f:
+                    f.write(render())
+                os.replace(tmp_path, path)
+            except Exception:
+                this.logger.exception(f"Failed writing metrics to {path}")
+
+    thread = threading.Thread(target=write_periodically, name='metrics_file', daemon=True)
+    thread.start()
+    this.logger.info(f"Writing metrics to {path} every {period_sec} seconds")
+
+    return thread
+
+
+def start_forwarder(send: Callable[[dict], None], period_sec: float = 15) -> threading.Thread:
+    """
+    Periodically send a snapshot of the metrics of this process (e.g. a camera process, to the supervisor)
+    """
+    def forward_periodically():
+        while True:
+            time.sleep(period_sec)
+            try:
+                send(snapshot())
+            except Exception:
+                this.logger.exception("Failed forwarding metrics")
+
+    thread = threading.Thread(target=forward_periodically, name='metrics_forwarder', daemon=True)
+    thread.start()
+
+    return thread
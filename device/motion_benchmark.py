@@ -0,0 +1,121 @@
+"""
+Benchmark and equivalence check of the downscaled motion detection against the original full resolution implementation.
+Every box of the original detection should be found by the downscaled one (and vice versa) with an IoU of at least MIN_IOU,
+on at least MIN_MATCHED_FRAMES of the frames. Both detect_motion and the diff motion detector (which keeps its own history)
+are checked. Exits with 1 otherwise.
+Run from the repository root:
+    python -m device.motion_benchmark
+    python -m device.motion_benchmark --input test1.mp4
+"""
+import sys
+import time
+import argparse
+from typing import Iterator, List
+
+import cv2
+import numpy as np
+from numpy import ndarray
+
+from device.common import FrameObject
+from device import video_processing
+from device.motion_detection import FrameDiffMotionDetector
+from device.tracking import iou
+
+
+RESOLUTIONS = [(640, 480), (1280, 720), (1920, 1080)]
+FRAMES = 100
+MIN_IOU = 0.7
+MIN_MATCHED_FRAMES = 0.95
+
+
+def legacy_detect_motion(prev_frame: ndarray, cur_frame: ndarray) -> List[FrameObject]:
+    # The original implementation - full resolution BGR diff and 20 iterations of a 3x3 dilate
+    diff = cv2.absdiff(prev_frame, cur_frame)
+    gray = cv2.cvtColor(diff, cv2.COLOR_BGR2GRAY)
+    blur = cv2.GaussianBlur(gray, (5, 5), 0)
+    _, thresh = cv2.threshold(blur, 20, 255, cv2.THRESH_BINARY)
+    dilated = cv2.dilate(thresh, None, iterations=20)
+    contours, _ = cv2.findContours(dilated, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+
+    detected_objects = []
+    for contour in contours:
+        area = cv2.contourArea(contour)
+        if area > 10000:
+            x, y, w, h = cv2.boundingRect(contour)
+            detected_objects.append(FrameObject(x, y, w, h, area))
+
+    return detected_objects
+
+
+def synthetic_frames(width: int, height: int, amount: int) -> Iterator[ndarray]:
+    # A static background with a few moving blocks
+    rng = np.random.default_rng(0)
+    background = cv2.GaussianBlur(rng.integers(0, 255, (height, width, 3), dtype=np.uint8), (9, 9), 0)
+    block = max(16, height // 5)
+    for i in range(amount):
+        frame = background.copy()
+        for j in range(2):
+            x = (i * (9 + 6 * j) + j * width // 2) % max(1, width - block)
+            y = (j * height // 2 + i * 2) % max(1, height - block)
+            cv2.rectangle(frame, (x, y), (x + block, y + block), (40 * j, 255 - 60 * j, 128), -1)
+        yield frame
+
+
+def video_frames(path: str, width: int, height: int, amount: int) -> Iterator[ndarray]:
+    cap = cv2.VideoCapture(path)
+    try:
+        for _ in range(amount):
+            ret, frame = cap.read()
+            if not ret:
+                break
+            yield cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+    finally:
+        cap.release()
+
+
+def matched(objects: List[FrameObject], others: List[FrameObject]) -> bool:
+    return all(any(iou(o, other) >= MIN_IOU for other in others) for o in objects)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Downscaled vs original motion detection")
+    parser.add_argument('--input', help="A recorded video. Synthetic frames are used if not given")
+    parser.add_argument('--frames', type=int, default=FRAMES)
+    args = parser.parse_args()
+
+    equivalent = True
+    print(f"{'resolution':>12} {'legacy ms':>10} {'new ms':>10} {'matched':>8}")
+    for width, height in RESOLUTIONS:
+        frames = video_frames(args.input, width, height, args.frames) if args.input else synthetic_frames(width, height, args.frames)
+        legacy_time = new_time = 0.0
+        matched_frames = compared_frames = 0
+        prev_frame = None
+        detector = FrameDiffMotionDetector()
+        for frame in frames:
+            detected = detector.detect(frame)
+            if prev_frame is not None:
+                start = time.perf_counter()
+                legacy = legacy_detect_motion(prev_frame, frame)
+                legacy_time += time.perf_counter() - start
+
+                start = time.perf_counter()
+                new = video_processing.detect_motion(prev_frame, frame)
+                new_time += time.perf_counter() - start
+
+                compared_frames += 1
+                matched_frames += all(matched(legacy, objects) and matched(objects, legacy) for objects in (new, detected))
+
+            prev_frame = frame
+
+        ratio = matched_frames / compared_frames if compared_frames else 1.0
+        equivalent = equivalent and ratio >= MIN_MATCHED_FRAMES
+        print(f"{f'{width}x{height}':>12} {legacy_time * 1000 / max(1, compared_frames):>10.2f} "
+              f"{new_time * 1000 / max(1, compared_frames):>10.2f} {ratio:>8.2%}")
+
+    print("Equivalent within tolerance" if equivalent else f"Less than {MIN_MATCHED_FRAMES:.0%} of the frames matched (IoU {MIN_IOU})")
+
+    return 0 if equivalent else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+import time
+from typing import List, Optional
+
+import cv2
+import numpy as np
+from numpy import ndarray
+
+from device.common import FrameObject
+from device import video_processing
+
+
+MOTION_DETECTOR_DIFF = 'diff'
+MOTION_DETECTOR_AVERAGE = 'average'
+MOTION_DETECTOR_MOG2 = 'mog2'
+MOTION_DETECTOR_KNN = 'knn'
+
+
+class MotionDetector:
+    """
+    Base class of the motion detection backends.
+    A backend gets only the current frame (it keeps whatever state it needs) and returns the moving objects as FrameObjects
+    in full resolution coordinates. Every backend keeps track of its own per frame cost.
+    """
+    name = None
+
+    def __init__(self, working_width: Optional[int] = video_processing.MOTION_WORKING_WIDTH,
+                 min_area: int = video_processing.MOTION_MIN_AREA):
+        self.working_width = working_width
+        self.min_area = min_area
+
+        self.frames = 0
+        self.total_time = 0.0
+        self.last_time = 0.0
+
+    def detect(self, frame: ndarray) -> List[FrameObject]:
+        start = time.perf_counter()
+
+        scale = video_processing.get_motion_scale(frame, self.working_width)
+        motion_mask = self._get_motion_mask(frame, scale)
+        detected_objects = video_processing.find_motion_objects(motion_mask, scale, self.min_area) if motion_mask is not None else []
+
+        self.last_time = time.perf_counter() - start
+        self.total_time += self.last_time
+        self.frames += 1
+
+        return detected_objects
+
+    def stats(self) -> dict:
+        return {
+            'name': self.name,
+            'frames': self.frames,
+            'last_ms': round(self.last_time * 1000, 3),
+            'avg_ms': round(self.total_time * 1000 / self.frames, 3) if self.frames else None
+        }
+
+    def _get_motion_mask(self, frame: ndarray, scale: float) -> Optional[ndarray]:
+        """
+        Return a binary mask (255 = moving) of the frame downscaled by scale, or None if there isn't enough history yet
+        """
+        raise NotImplementedError()
+
+
+class FrameDiffMotionDetector(MotionDetector):
+    """
+    Two frames differencing (the original detect_motion).
+    The diff is taken in full resolution (see video_processing.detect_motion), so a copy of the previous frame is kept -
+    the frame itself goes back to the frame pool.
+    """
+    name = MOTION_DETECTOR_DIFF
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prev_frame = None
+
+    def _get_motion_mask(self, frame: ndarray, scale: float) -> Optional[ndarray]:
+        if self.prev_frame is None or self.prev_frame.shape != frame.shape:
+            self.prev_frame = frame.copy()
+            return None
+
+        motion_mask = video_processing.get_frames_motion_mask(self.prev_frame, frame, scale)
+        np.copyto(self.prev_frame, frame)
+
+        return motion_mask
+
+
+class RunningAverageMotionDetector(MotionDetector):
+    """
+    Diff against a running average of the background, updated in place (accumulateWeighted).
+    Slow lighting changes are absorbed into the background instead of firing as motion.
+    """
+    name = MOTION_DETECTOR_AVERAGE
+
+    def __init__(self, *args, alpha: float = 0.05, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.alpha = alpha
+        self.background = None
+        self.background_u8 = None
+
+    def _get_motion_mask(self, frame: ndarray, scale: float) -> Optional[ndarray]:
+        small = video_processing.prepare_motion_frame(frame, scale)
+        if self.background is None or self.background.shape != small.shape:
+            self.background = small.astype(np.float32)
+            self.background_u8 = small.copy()
+            return None
+
+        cv2.convertScaleAbs(self.background, dst=self.background_u8)
+        diff = cv2.absdiff(self.background_u8, small)
+        cv2.accumulateWeighted(small, self.background, self.alpha)
+
+        return video_processing.threshold_motion_diff(diff, scale)
+
+
+class BackgroundSubtractorMotionDetector(MotionDetector):
+    """
+    OpenCV's MOG2 / KNN background subtractors
+    """
+    def __init__(self, *args, algorithm: str = MOTION_DETECTOR_MOG2, history: int = 500, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.name = algorithm
+        if algorithm == MOTION_DETECTOR_MOG2:
+            self.subtractor = cv2.createBackgroundSubtractorMOG2(history=history, detectShadows=False)
+        elif algorithm == MOTION_DETECTOR_KNN:
+            self.subtractor = cv2.createBackgroundSubtractorKNN(history=history, detectShadows=False)
+        else:
+            raise ValueError(f"Unknown background subtractor '{algorithm}'")
+
+    def _get_motion_mask(self, frame: ndarray, scale: float) -> Optional[ndarray]:
+        mask = self.subtractor.apply(video_processing.prepare_motion_frame(frame, scale))
+
+        # Remove the salt noise of the subtractor before dilating
+        return cv2.medianBlur(mask, 3)
+
+
+def create_motion_detector(name: str = MOTION_DETECTOR_DIFF, **kwargs) -> MotionDetector:
+    if name == MOTION_DETECTOR_DIFF:
+        return FrameDiffMotionDetector(**kwargs)
+    elif name == MOTION_DETECTOR_AVERAGE:
+        return RunningAverageMotionDetector(**kwargs)
+    elif name in (MOTION_DETECTOR_MOG2, MOTION_DETECTOR_KNN):
+        return BackgroundSubtractorMotionDetector(algorithm=name, **kwargs)
+
+    raise ValueError(f"Unknown motion detector '{name}'")
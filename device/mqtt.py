@@ -1,10 +1,22 @@
-from typing import Optional, List, Callable
+from typing import Optional, List, Callable, Dict, Any
 import logging
 import json
+import threading
 
 from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 from device.singleton import Singleton
+from device import metrics
+
+
+ENCODING_JSON = 'json'
+ENCODING_MSGPACK = 'msgpack'
+MAX_BATCH_SIZE = 50
 
 
 class Mqtt(metaclass=Singleton):
@@ -22,6 +34,17 @@ class Mqtt(metaclass=Singleton):
         self.topic: Optional[str] = None
         self.callbacks: List[Mqtt.OnMessageCallback] = []
 
+        # Publishing
+        self.encoding = ENCODING_JSON
+        self.coalesce_window_sec = 0.0
+        self.max_batch_size = MAX_BATCH_SIZE
+        self.pending: Dict[str, List[Any]] = {}
+        self.flush_timer: Optional[threading.Timer] = None
+        self.publish_lock = threading.Lock()
+        self.published_messages = 0
+        self.published_bytes = 0
+        self.coalesced_messages = 0
+
         self._init_loggers()
 
     def _init_loggers(self):
@@ -66,17 +89,104 @@ class Mqtt(metaclass=Singleton):
         self.myAWSIoTMQTTClient.subscribe(self.topic, 1, self._callback)
         self.logger.info("Finished subscribing")
 
+    def configure_publishing(self, coalesce_window_sec: float = 0, encoding: str = ENCODING_JSON, max_batch_size: int = MAX_BATCH_SIZE):
+        """
+        coalesce_window_sec - Messages sent with coalesce=True are held for up to this time and published together
+                              as one {"batch": [...]} message per topic. 0 disables coalescing
+        encoding - json, or msgpack (compact binary, requires the msgpack package). With msgpack, the IoT rule of the reports
+                   must pass the payload base64 encoded (see detection_report.decode_event)
+        """
+        if encoding == ENCODING_MSGPACK and msgpack is None:
+            raise ValueError("msgpack encoding requires the msgpack package")
+        elif encoding not in (ENCODING_JSON, ENCODING_MSGPACK):
+            raise ValueError(f"Unknown encoding '{encoding}'")
+
+        self.flush()
+        self.coalesce_window_sec = coalesce_window_sec
+        self.encoding = encoding
+        self.max_batch_size = max_batch_size
+
     def register_callback(self, callback: OnMessageCallback):
         self.callbacks.append(callback)
 
     def _callback(self, client, userdata, message):
-        self.logger.info(f"Received a new message on topic {message.topic}: {message.payload}")
+        self.logger.info(f"Received a new message on topic {message.topic}")
+        self.logger.debug(f"Message payload: {message.payload}")
 
-        msg_dict = json.loads(message.payload)
+        msg_dict = decode_payload(message.payload)
         for callback in self.callbacks:
             callback(message.topic, msg_dict)
 
-    def send(self, topic, msg):
-        message_json = json.dumps(msg)
-        self.myAWSIoTMQTTClient.publish(topic, message_json, 1)
-        self.logger.info(f'Published topic "{topic}": {message_json}\n')
+    def send(self, topic, msg, coalesce: bool = False):
+        if not coalesce or self.coalesce_window_sec <= 0:
+            self._publish(topic, msg)
+            return
+
+        with self.publish_lock:
+            self.pending.setdefault(topic, []).append(msg)
+            batch_full = len(self.pending[topic]) >= self.max_batch_size
+            if not batch_full and not self.flush_timer:
+                self.flush_timer = threading.Timer(self.coalesce_window_sec, self.flush)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+
+        if batch_full:
+            self.flush()
+
+    def flush(self):
+        """
+        Publish all the pending coalesced messages
+        """
+        with self.publish_lock:
+            pending = self.pending
+            self.pending = {}
+            if self.flush_timer:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+
+        for topic, msgs in pending.items():
+            if len(msgs) > 1:
+                with self.publish_lock:
+                    self.coalesced_messages += len(msgs)
+                self._publish(topic, {'batch': msgs})
+            else:
+                self._publish(topic, msgs[0])
+
+    def stats(self) -> dict:
+        with self.publish_lock:
+            return {
+                'published_messages': self.published_messages,
+                'published_bytes': self.published_bytes,
+                'coalesced_messages': self.coalesced_messages
+            }
+
+    def _publish(self, topic, msg):
+        if self.encoding == ENCODING_MSGPACK:
+            payload = msgpack.packb(msg, use_bin_type=True)
+        else:
+            payload = json.dumps(msg, separators=(',', ':'))
+
+        with metrics.timer('stage_seconds', stage='mqtt_publish'):
+            self.myAWSIoTMQTTClient.publish(topic, payload, 1)
+        # Publishing runs on the caller's thread and on the flush timer's thread
+        with self.publish_lock:
+            self.published_messages += 1
+            self.published_bytes += len(payload)
+        metrics.inc('mqtt_published_bytes_total', len(payload))
+
+        # Don't log the payload itself unless debugging
+        self.logger.info(f'Published topic "{topic}" ({len(payload)} bytes)')
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f'Published topic "{topic}": {payload}')
+
+
+def decode_payload(payload) -> dict:
+    """
+    Messages are json, or msgpack (a msgpack map never starts with '{')
+    """
+    if isinstance(payload, str):
+        payload = payload.encode()
+    if payload[:1] == b'{' or msgpack is None:
+        return json.loads(payload)
+
+    return msgpack.unpackb(payload, raw=False)
@@ -1,23 +1,42 @@
 import sys
-import itertools
+import time
 import logging
+import threading
 
 from datetime import datetime as dt
-from typing import List
-from collections import deque
+from typing import List, Optional, Any
 
 from numpy import ndarray
 
 from device.common import FrameObject, MonitoredFrame
-from device import frames_sender
+from device.post_processing import PostProcessor
+from device.frames_sender import FrameEncoder, UploadUrls
+from device.frame_store import FrameStore, DEFAULT_MEMORY_BUDGET, ENCODING_JPEG
+from device.frames_window import FramesWindow
 from device.mqtt import Mqtt
+from device import metrics
 
 SEND_BAD_FRAMES_WITH_MOTION_AFTER_SEC = 60
 SKIP_CHECKS_AFTER_UPLOAD_MIN = 7
 CHECK_ACTIVITY_PERIOD_SEC = 5
+ACTIVITY_WINDOW_SEC = 60
+MOTION_SCORE = 1  # A frame with at least this score has motion
+GOOD_FRAME_SCORE = 3  # A frame with a higher score is a good frame
+MAX_REPORTED_FRAMES = 3
+ACTIVITY_MIN_MOTION_FRAMES = 2  # Consecutive frames with motion that make an activity (a single noisy frame doesn't)
+PENDING_REPORT_TIMEOUT_SEC = 5 * 60  # Frames of reports the backend didn't answer by then are dropped
 
 this = sys.modules[__name__]
-this.circular_buffer = None
+this.frames_window = None
+this.frame_store = None
+this.post_processor = None
+this.mqtt = None
+this.track_best_frames = {}
+this.pending_reports = {}
+this.pending_reports_lock = threading.Lock()
+this.next_report_id = 0
+this.motion_streak = 0
+this.check_activity_period = CHECK_ACTIVITY_PERIOD_SEC
 this.last_activity_check = None
 this.last_motion_detection = None
 this.last_frame_sent = None
@@ -26,23 +45,103 @@ this.fps = None
 this.logger = logging.getLogger(__name__)
 
 
-def init(fps: int) -> None:
+def init(fps: int, frame_store_budget: int = DEFAULT_MEMORY_BUDGET, frame_store_encoding: str = ENCODING_JPEG,
+         check_activity_period: float = CHECK_ACTIVITY_PERIOD_SEC, mqtt: Optional[Any] = None, uploader: Optional[Any] = None,
+         encoder: Optional[FrameEncoder] = None) -> None:
+    """
+    mqtt - Where reports are sent and backend messages come from. Defaults to the process wide Mqtt connection
+    uploader - Where the frames are uploaded through. Defaults to the process wide FramesUploader
+    encoder - How the reported frames are prepared and encoded for the upload
+    """
     this.fps = fps
-    this.circular_buffer = deque(maxlen=max(fps * 60 * 2, 1200))
+    this.mqtt = mqtt or Mqtt()
+    capacity = max(fps * 60 * 2, 1200)
+
+    # The window holds only the frames metadata, the pixels are kept (encoded) in the frame store
+    this.frames_window = FramesWindow(capacity, ACTIVITY_WINDOW_SEC)
+    this.frame_store = FrameStore(capacity, frame_store_budget, frame_store_encoding)
+    this.check_activity_period = check_activity_period
     this.last_activity_check = dt.now()
-    this.best_frames = []
-    Mqtt().register_callback(_handle_message_from_backend)
+    this.pending_reports = {}
+    this.track_best_frames = {}
 
+    # Blurring, encoding and uploading run on the post processing workers, not on the MQTT network thread
+    this.post_processor = PostProcessor(uploader=uploader, encoder=encoder)
+    this.post_processor.start()
+    this.mqtt.register_callback(_handle_message_from_backend)
+    metrics.register_collector(collect_metrics)
 
-def add_frame(frame: ndarray, objects: List[FrameObject], faces: List[FrameObject]) -> None:
-    # Insert frame only if objects were detected
-    frame = MonitoredFrame(time=dt.now(), frame=frame.copy() if objects else None, objects=objects, faces=faces, score=None)
-    this.circular_buffer.append(frame)
+
+def collect_metrics() -> None:
+    metrics.set_gauge('frame_store_memory_bytes', this.frame_store.used_memory())
+    metrics.set_gauge('frame_store_allocated_bytes', this.frame_store.memory_usage())
+    metrics.set_counter('frame_store_rejected_frames_total', this.frame_store.rejected_frames)
+    post_processing_stats = this.post_processor.stats()
+    metrics.set_gauge('post_processing_queue_depth', post_processing_stats['queue_depth'])
+    metrics.set_counter('post_processing_dropped_jobs_total', post_processing_stats['dropped_jobs'])
+
+
+def add_frame(frame: ndarray, objects: List[FrameObject], faces: List[FrameObject],
+              coasted_faces: Optional[List[FrameObject]] = None) -> None:
+    """
+    coasted_faces - Faces that weren't seen in this frame, only kept from earlier frames (see FaceTracker).
+                    They're only kept unblurred in the uploaded frames, the frame is scored by the seen faces
+    """
+    # Insert frame only if objects were detected (frames that didn't fit into the store have no id)
+    frame_id = this.frame_store.put(frame) if objects else None
+    now = time.time()
+    score = score_frame(objects, faces)
+    this.frames_window.append(now, score, frame_id, objects, faces, coasted_faces)
+    update_track_best_frames(now, frame_id, objects, faces, score, coasted_faces)
+    this.motion_streak = this.motion_streak + 1 if score >= MOTION_SCORE else 0
+
+
+def has_activity() -> bool:
+    """
+    Whether the last monitored frames are an activity (e.g. to record a clip of it)
+    """
+    return this.motion_streak >= ACTIVITY_MIN_MOTION_FRAMES
+
+
+def update_track_best_frames(now: float, frame_id: int, objects: List[FrameObject], faces: List[FrameObject], score: float,
+                             coasted_faces: Optional[List[FrameObject]] = None) -> None:
+    """
+    Keep the frame with the largest face of every tracked person
+    """
+    for face in faces:
+        if face.track_id is None:
+            continue
+
+        best = this.track_best_frames.get(face.track_id)
+        if best is None or face.area > best[0]:
+            this.track_best_frames[face.track_id] = (face.area, MonitoredFrame(
+                time=dt.fromtimestamp(now), frame=None, objects=objects, faces=faces, score=score, frame_id=frame_id,
+                coasted_faces=coasted_faces or []))
+
+
+def get_track_best_frames(now: float) -> List[MonitoredFrame]:
+    """
+    The best frames of the people tracked in the activity window, the largest face first
+    """
+    for track_id, (_, frame) in list(this.track_best_frames.items()):
+        if frame.time.timestamp() < now - ACTIVITY_WINDOW_SEC:
+            del this.track_best_frames[track_id]
+
+    best_frames = sorted(this.track_best_frames.values(), key=lambda best: best[0], reverse=True)
+
+    # A few people may share the same best frame
+    frames = []
+    for _, frame in best_frames:
+        if all(frame.frame_id != f.frame_id for f in frames):
+            frames.append(frame)
+
+    return frames
 
 
 def check_activity() -> None:
     # Every X seconds, check the last X seconds in the buffer
-    if (dt.now() - this.last_activity_check).seconds <= CHECK_ACTIVITY_PERIOD_SEC:
+    # Checking is cheap (the best frame is maintained incrementally), so the period can be 0 to check on every frame
+    if (dt.now() - this.last_activity_check).total_seconds() <= this.check_activity_period:
         return
     else:
         this.last_activity_check = dt.now()
@@ -55,21 +154,19 @@ def check_activity() -> None:
             return
 
     # If we detected something in the last X seconds, find "good" frames in the last 60 seconds
-    start = max(0, len(this.circular_buffer) - (60 * this.fps))
-    stop = len(this.circular_buffer) - 1
-    monitored_frames = list(itertools.islice(this.circular_buffer, start, stop))
-
-    # Give score to all frames
-    qualify_frames(monitored_frames)
+    # A raw / downscaled store holds fewer frames than the window, frames that were evicted from it aren't considered
+    best_frame = this.frames_window.best(time.time(), this.frame_store.oldest_id())
+    if not best_frame:
+        return
 
     # Set motion detection time
-    if not this.last_motion_detection and has_motion(monitored_frames):
+    if not this.last_motion_detection and has_motion(best_frame):
         this.logger.info("Detected motion")
         this.last_motion_detection = dt.now()
 
-    if has_good_frames(monitored_frames):
+    if is_good_frame(best_frame):
         # If found good frames, examine and send report about the best frames
-        examine_and_report_frames(monitored_frames)
+        examine_and_report_frame(best_frame)
     elif this.last_motion_detection:
         # Didn't find good frames, check whether should we send whatever we have
         sent_before = dt.now() - this.last_frame_sent if this.last_frame_sent else None
@@ -81,70 +178,120 @@ def check_activity() -> None:
         if detected_motion_since > SEND_BAD_FRAMES_WITH_MOTION_AFTER_SEC and \
                 (not sent_before or sent_before.seconds >= 60 * SKIP_CHECKS_AFTER_UPLOAD_MIN):
             this.logger.info(f"Motion detected {SEND_BAD_FRAMES_WITH_MOTION_AFTER_SEC} seconds ago and nothing sent. Sending the best we can.")
-            examine_and_report_frames(monitored_frames)
+            examine_and_report_frame(best_frame)
 
 
-def examine_and_report_frames(frames: List[MonitoredFrame]):
-    best_frame = choose_best_frame(frames)
+def examine_and_report_frame(best_frame: MonitoredFrame):
     this.logger.info(f"Best frame score: {best_frame.score}, objects: {len(best_frame.objects)}, faces: {len(best_frame.faces)}")
 
-    report_detection([best_frame])
+    # When faces are tracked, report the best frame of each person as well - after the best frame of the window, if it's better
+    candidates = get_track_best_frames(time.time())
+    if all(best_frame.score > frame.score for frame in candidates):
+        candidates = [best_frame] + [frame for frame in candidates if frame.frame_id != best_frame.frame_id]
+
+    # Decode the full resolution pixels only for the frames that are reported (and uploaded)
+    frames = []
+    for frame in candidates:
+        frame.frame = this.frame_store.get(frame.frame_id)
+        if frame.frame is not None:
+            frames.append(frame)
+            if len(frames) == MAX_REPORTED_FRAMES:
+                break
+    if not frames:
+        # Better report the latest activity than nothing
+        newest_frame = this.frames_window.newest(time.time())
+        if newest_frame:
+            newest_frame.frame = this.frame_store.get(newest_frame.frame_id)
+        if not newest_frame or newest_frame.frame is None:
+            this.logger.warning(f"Best frame {best_frame.frame_id} isn't in the frame store anymore. Skipping report.")
+            reset_activity()
+            return
+        this.logger.info(f"Best frame {best_frame.frame_id} isn't in the frame store anymore. Reporting the newest frame instead.")
+        frames = [newest_frame]
 
-    this.last_motion_detection = None
+    report_detection(frames)
+    reset_activity()
     this.last_frame_sent = dt.now()
-    if has_good_frames(frames):
+    if is_good_frame(best_frame):
         this.last_good_frame_sent = dt.now()
 
 
-def qualify_frames(frames: List[MonitoredFrame]) -> None:
-    for frame in frames:
-        """
-        1. Detected objects amount
-        2. Detected faces amount
-
-        """
-        if frame.score:
-            continue
-
-        frame.score = (1 * len(frame.objects))
-        frame.score += (5 * len(frame.faces))
-        # TODO -  * Size of objects
-        #         * Size of faces - highest weight
-        #         * Location of objects and faces (shouldn't be in the boundaries of the image) - lowest weiht
+def reset_activity() -> None:
+    # The next report is about a new activity
+    this.track_best_frames = {}
+    this.last_motion_detection = None
 
 
-def has_motion(frames: List[MonitoredFrame]) -> bool:
+def score_frame(objects: List[FrameObject], faces: List[FrameObject]) -> float:
     """
-    Find a frame with a score larger than X
+    1. Detected objects amount
+    2. Detected faces amount
+
     """
-    return any([frame.score and frame.score >= 1 for frame in frames])
+    score = (1 * len(objects))
+    score += (5 * len(faces))
+    # TODO -  * Size of objects
+    #         * Size of faces - highest weight
+    #         * Location of objects and faces (shouldn't be in the boundaries of the image) - lowest weiht
 
+    return score
 
-def has_good_frames(frames: List[MonitoredFrame]) -> bool:
-    """
-    Find a frame with a score larger than X
-    """
-    return any([frame.score and frame.score > 3 for frame in frames])
 
+def has_motion(frame: MonitoredFrame) -> bool:
+    return bool(frame.score) and frame.score >= MOTION_SCORE
 
-def choose_best_frame(frames: List[MonitoredFrame]) -> MonitoredFrame:
-    return max(frames, key=lambda f: f.score)
+
+def is_good_frame(frame: MonitoredFrame) -> bool:
+    return bool(frame.score) and frame.score > GOOD_FRAME_SCORE
 
 
 def report_detection(frames: List[MonitoredFrame]) -> None:
-    this.best_frames = frames
+    # The frames wait for the backend's reply (with their upload urls). Reports may be coalesced into one batch message and answered
+    # in any order, so the frames are kept by the id of their report, which the backend sends back
+    now = time.time()
+    with this.pending_reports_lock:
+        for report_id, (report_time, _) in list(this.pending_reports.items()):
+            if report_time < now - PENDING_REPORT_TIMEOUT_SEC:
+                this.logger.warning(f"The backend didn't answer report {report_id}, dropping its frames")
+                del this.pending_reports[report_id]
+        report_id = f"{dt.now().strftime('%Y%m%d_%H%M%S')}_{this.next_report_id}"
+        this.next_report_id += 1
+        this.pending_reports[report_id] = (now, frames)
 
     # TODO - Implement automatic serialization
-    # TODO - raspberrypi_edi - client id should be loaded from config
-    Mqtt().send("report/detection", {
-        "client_id": "raspberrypi_edi",
+    # Reports are coalesced with other reports sent in the same publishing window (if coalescing is configured)
+    this.mqtt.send("report/detection", {
+        "client_id": this.mqtt.thing_name,
+        "report_id": report_id,
+        "image_format": this.post_processor.encoder.image_format,
         "frames": [{
             'num_faces_detected': len(fr.faces),
-            'num_objects_detected': len(fr.objects)
+            'num_objects_detected': len(fr.objects),
+            # Crops are uploaded under their own keys (in the crops upload mode)
+            'crops': this.post_processor.encoder.count_crops(fr)
         } for fr in frames]
-    })
+    }, coalesce=True)
+
+
+def _upload_urls(urls: dict) -> UploadUrls:
+    # (original, features, crops) upload urls of a frame. An older backend doesn't hand out crops urls
+    return (urls['frame_upload']['upload_url'], urls['frame_features_upload']['upload_url'],
+            [crop['upload_url'] for crop in urls.get('crops_upload', [])])
 
 
 def _handle_message_from_backend(topic: str, msg: dict):
-    frames_sender.send_motion_frames(this.best_frames, msg['frame_upload']['upload_url'], msg['frame_features_upload']['upload_url'])
-    this.best_frames = []
+    # Upload urls of the next best frames (if the backend handed out urls for more than one frame)
+    upload_urls = [_upload_urls(msg)] + [_upload_urls(urls) for urls in msg.get('more_frames_upload', [])]
+
+    with this.pending_reports_lock:
+        report_id = msg.get('report_id')
+        if report_id is None and this.pending_reports:
+            # A reply of an older backend - answers the oldest report
+            report_id = next(iter(this.pending_reports))
+        pending_report = this.pending_reports.pop(report_id, None)
+    if pending_report is None:
+        this.logger.warning(f"Got upload urls of an unknown report {report_id}, ignoring")
+        return
+
+    # Only queue the job, this runs on the MQTT network thread
+    this.post_processor.submit(pending_report[1], upload_urls)
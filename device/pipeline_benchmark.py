@@ -0,0 +1,218 @@
+"""
+Headless replay benchmark of the device pipeline.
+Replays recorded videos (or synthetic frames) through motion detection, face detection / tracking, objects_monitor
+and the blur / encode path as fast as possible, with MQTT and uploads stubbed out.
+Reports per stage latency percentiles, frames per second and peak memory per resolution, and compares against a saved baseline.
+Run from the repository root:
+    python -m device.pipeline_benchmark --input test1.mp4 --resolutions 640x480,1280x720 --save-baseline bench_baseline.json
+    python -m device.pipeline_benchmark --input test1.mp4 --resolutions 640x480,1280x720 --baseline bench_baseline.json
+"""
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+from collections import defaultdict
+from concurrent.futures import Future
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from numpy import ndarray
+
+from device import video_processing, objects_monitor
+from device.face_detection import create_face_detector
+from device.motion_detection import create_motion_detector
+from device.tracking import FaceTracker
+
+
+STAGES = ('read', 'motion', 'faces', 'add_frame', 'check_activity', 'blur', 'encode', 'total')
+PERCENTILES = (50, 90, 99)
+REGRESSION_FACTOR = 1.2
+
+
+class StubMqtt:
+    """
+    Swallows the reports instead of publishing them (so nothing is uploaded either)
+    """
+    thing_name = 'benchmark'
+
+    def __init__(self):
+        self.sent = 0
+
+    def register_callback(self, callback):
+        pass
+
+    def send(self, topic, msg, coalesce: bool = False):
+        self.sent += 1
+
+
+class StubUploader:
+    def __init__(self):
+        self.uploaded_bytes = 0
+
+    def submit(self, upload_url_data: dict, data: bytes) -> Future:
+        self.uploaded_bytes += len(data)
+        future = Future()
+        future.set_result(True)
+
+        return future
+
+
+def synthetic_frames(width: int, height: int, amount: int) -> Iterator[ndarray]:
+    # A noisy static background with a few moving blocks
+    rng = np.random.default_rng(0)
+    background = rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+    block = max(16, height // 5)
+    for i in range(amount):
+        frame = background.copy()
+        for j in range(3):
+            x = (i * (7 + 5 * j) + j * width // 3) % max(1, width - block)
+            y = (j * height // 4 + i * 3) % max(1, height - block)
+            cv2.rectangle(frame, (x, y), (x + block, y + block), (40 * j, 255 - 60 * j, 128), -1)
+        yield frame
+
+
+def video_frames(path: str, width: int, height: int, amount: int) -> Iterator[ndarray]:
+    cap = cv2.VideoCapture(path)
+    try:
+        for _ in range(amount):
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if frame.shape[1] != width or frame.shape[0] != height:
+                frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+            yield frame
+    finally:
+        cap.release()
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {f"p{p}": None for p in PERCENTILES}
+
+    return {f"p{p}": round(float(np.percentile(values, p)) * 1000, 3) for p in PERCENTILES}
+
+
+def run(frames: Iterator[ndarray], motion_detector: str, face_detector: str, face_detection_interval: int) -> dict:
+    objects_monitor.init(10, mqtt=StubMqtt(), uploader=StubUploader(), check_activity_period=0)
+    motion = create_motion_detector(motion_detector)
+    tracker = FaceTracker(create_face_detector(face_detector), face_detection_interval)
+
+    times = defaultdict(list)
+    amount = 0
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    while True:
+        # Each stage is timed separately, the total is the whole frame
+        frame_start = time.perf_counter()
+        frame = next(frames, None)
+        if frame is None:
+            break
+        stage_end = time.perf_counter()
+        times['read'].append(stage_end - frame_start)
+        amount += 1
+
+        def timed(stage, func, *args, **kwargs):
+            stage_start = time.perf_counter()
+            result = func(*args, **kwargs)
+            times[stage].append(time.perf_counter() - stage_start)
+            return result
+
+        detected_objects = timed('motion', motion.detect, frame)
+        detected_faces = timed('faces', tracker.update, frame, detected_objects)
+        timed('add_frame', objects_monitor.add_frame, frame, detected_objects, detected_faces, tracker.coasted_faces)
+        timed('check_activity', objects_monitor.check_activity)
+        if detected_objects:
+            blurred = timed('blur', video_processing.blur, frame, detected_faces)
+            timed('encode', cv2.imencode, '.jpg', blurred)
+
+        times['total'].append(time.perf_counter() - frame_start)
+
+    elapsed = time.perf_counter() - start
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    objects_monitor.post_processor.stop()
+
+    return {
+        'frames': amount,
+        'fps': round(amount / elapsed, 2) if elapsed else None,
+        'peak_memory_mb': round(peak_memory / 1024 / 1024, 2),
+        'frame_store_memory_mb': round(objects_monitor.frame_store.memory_usage() / 1024 / 1024, 2),
+        'stages': {stage: {'count': len(times[stage]), **percentiles(times[stage])} for stage in STAGES}
+    }
+
+
+def compare(results: dict, baseline: dict, factor: float) -> List[str]:
+    """
+    Returns the regressions - stages that their p50 latency is slower than the baseline by more than the given factor
+    """
+    regressions = []
+    for resolution, result in results.items():
+        base = baseline.get(resolution)
+        if not base:
+            continue
+
+        for stage, stage_result in result['stages'].items():
+            base_p50 = base['stages'].get(stage, {}).get('p50')
+            p50 = stage_result.get('p50')
+            if base_p50 and p50 and p50 > base_p50 * factor:
+                regressions.append(f"{resolution} {stage}: p50 {p50}ms (baseline {base_p50}ms)")
+
+    return regressions
+
+
+def parse_resolutions(resolutions: str) -> List[Tuple[int, int]]:
+    return [tuple(int(v) for v in resolution.split('x')) for resolution in resolutions.split(',')]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Headless replay benchmark of the device pipeline")
+    parser.add_argument('--input', help="A recorded video to replay. Synthetic frames are used if not given")
+    parser.add_argument('--resolutions', default='640x480,1280x720,1920x1080')
+    parser.add_argument('--frames', type=int, default=300, help="Frames per resolution")
+    parser.add_argument('--motion-detector', default='diff')
+    parser.add_argument('--face-detector', default='haar')
+    parser.add_argument('--face-detection-interval', type=int, default=5)
+    parser.add_argument('--output', help="Write the results to this json file")
+    parser.add_argument('--save-baseline', help="Save the results as a baseline to this json file")
+    parser.add_argument('--baseline', help="Compare the results against this baseline json file")
+    parser.add_argument('--regression-factor', type=float, default=REGRESSION_FACTOR)
+    args = parser.parse_args()
+
+    results = {}
+    for width, height in parse_resolutions(args.resolutions):
+        if args.input:
+            frames = video_frames(args.input, width, height, args.frames)
+        else:
+            frames = synthetic_frames(width, height, args.frames)
+
+        resolution = f"{width}x{height}"
+        results[resolution] = run(frames, args.motion_detector, args.face_detector, args.face_detection_interval)
+        print(f"{resolution}: {results[resolution]['fps']} fps, peak memory {results[resolution]['peak_memory_mb']}MB")
+        for stage, stage_result in results[resolution]['stages'].items():
+            print(f"    {stage:>15}: " + ', '.join(f"{k} {v}" for k, v in stage_result.items()))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.regression_factor)
+        if regressions:
+            print("Regressions:\n    " + '\n    '.join(regressions))
+            return 1
+        print("No regressions")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+import time
+import queue
+import logging
+import threading
+from contextlib import contextmanager
+from typing import List, Optional, Any
+
+from device.common import MonitoredFrame
+from device import metrics
+from device.frames_sender import UploadUrls, FrameEncoder, get_uploader, submit_encoded
+
+
+POST_PROCESSING_WORKERS = 2
+POST_PROCESSING_QUEUE_SIZE = 8
+
+
+class PostProcessor:
+    """
+    Post processing stage of the reported frames - blurring, annotating, jpeg encoding and uploading.
+    Jobs are queued by submit() (which never blocks, so it's safe to call from the MQTT network thread) and run by a pool of worker threads.
+    Keeps the queue depth and the timing of each stage.
+    """
+    STAGES = ('encode', 'blur', 'annotate', 'upload', 'total')
+
+    def __init__(self, workers: int = POST_PROCESSING_WORKERS, queue_size: int = POST_PROCESSING_QUEUE_SIZE,
+                 uploader: Optional[Any] = None, encoder: Optional[FrameEncoder] = None):
+        """
+        uploader - A FramesUploader (or anything with the same submit(upload_url_data, data) method). Defaults to the process wide uploader
+        encoder - How the frames are prepared and encoded for the upload. Defaults to full frames in the default jpeg quality
+        """
+        self.workers = workers
+        self.uploader = uploader
+        self.encoder = encoder or FrameEncoder()
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.threads: List[threading.Thread] = []
+
+        # Counters
+        self.lock = threading.Lock()
+        self.processed_jobs = 0
+        self.dropped_jobs = 0
+        self.stage_count = {stage: 0 for stage in self.STAGES}
+        self.stage_total_time = {stage: 0.0 for stage in self.STAGES}
+        self.stage_max_time = {stage: 0.0 for stage in self.STAGES}
+
+        self.logger = logging.getLogger(__name__)
+
+    def start(self) -> None:
+        if self.uploader is None:
+            self.uploader = get_uploader()
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"post_processing_{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self) -> None:
+        for _ in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def submit(self, frames: List[MonitoredFrame], upload_urls: List[UploadUrls]) -> bool:
+        try:
+            self.jobs.put_nowait((frames, upload_urls))
+        except queue.Full:
+            with self.lock:
+                self.dropped_jobs += 1
+            self.logger.warning(f"Post processing queue is full, dropping job of {len(frames)} frames")
+            return False
+
+        return True
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'queue_depth': self.jobs.qsize(),
+                'processed_jobs': self.processed_jobs,
+                'dropped_jobs': self.dropped_jobs,
+                'encoder': self.encoder.stats(),
+                'stages': {stage: {
+                    'avg_ms': round(self.stage_total_time[stage] * 1000 / self.stage_count[stage], 1) if self.stage_count[stage] else None,
+                    'max_ms': round(self.stage_max_time[stage] * 1000, 1)
+                } for stage in self.STAGES}
+            }
+
+    def _run(self) -> None:
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+
+            try:
+                with self._timed('total'):
+                    self._process(*job)
+            except Exception:
+                self.logger.exception("Failed post processing frames")
+
+            with self.lock:
+                self.processed_jobs += 1
+            self.logger.info(f"Post processed frames. {self.stats()}")
+
+    def _process(self, frames: List[MonitoredFrame], upload_urls: List[UploadUrls]) -> None:
+        for monitored_frame, urls in zip(frames, upload_urls):
+            # The original (or its crops) and the blurred frame with all the detected objects (or its thumbnail) are prepared in one pass.
+            # Crops are made only if the backend handed out urls for them
+            original, features, crops = self.encoder.encode(monitored_frame, self._timed, crops=bool(urls[2]))
+
+            with self._timed('upload'):
+                for upload in submit_encoded(self.uploader, urls, original, features, crops):
+                    upload.result()
+
+    @contextmanager
+    def _timed(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.stage_count[stage] += 1
+                self.stage_total_time[stage] += elapsed
+                self.stage_max_time[stage] = max(self.stage_max_time[stage], elapsed)
+            metrics.observe('post_processing_seconds', elapsed, stage=stage)
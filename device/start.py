@@ -2,6 +2,7 @@ import logging
 import os
 from device import capture_video
 from device import mqtt
+from device import metrics
 
 
 logger = logging.getLogger(__name__)
@@ -14,15 +15,84 @@ def init_logger():
     logger.info("Starting")
 
 
+def start_metrics(camera_id=None, forward=None):
+    # e.g. METRICS_PORT=9108 to serve http://127.0.0.1:9108/metrics, or METRICS_FILE=/var/lib/node_exporter/smartguard.prom
+    # Camera processes have their own metrics - they forward them to the supervisor's endpoint, and write their own file
+    port = os.environ.get('METRICS_PORT')
+    if port and camera_id is None:
+        metrics.start_http_server(int(port))
+    if port and forward:
+        metrics.start_forwarder(forward, float(os.environ.get('METRICS_FORWARD_PERIOD_SEC', '5')))
+
+    path = os.environ.get('METRICS_FILE')
+    if path:
+        if camera_id is not None:
+            root, ext = os.path.splitext(path)
+            path = f"{root}_camera_{camera_id}{ext}"
+        metrics.start_file_writer(path, float(os.environ.get('METRICS_FILE_PERIOD_SEC', '15')))
+
+
+def get_frame_rate_conf():
+    # FPS is the rate while there's motion. IDLE_FPS=0 disables the idle rate, and CPU_BUDGET (e.g. 0.5 of a core) caps the rate
+    return {
+        'fps': int(os.environ.get('FPS', '10')),
+        'idle_fps': float(os.environ.get('IDLE_FPS', '2')) or None,
+        'cpu_budget': float(os.environ.get('CPU_BUDGET', '0')) or None
+    }
+
+
+def get_upload_conf():
+    # e.g. UPLOAD_MODE=crops UPLOAD_TARGET_KB=60 on a constrained (LTE) uplink
+    target_kb = int(os.environ.get('UPLOAD_TARGET_KB', '0'))
+    return {
+        'upload_mode': os.environ.get('UPLOAD_MODE', 'full'),
+        'upload_format': os.environ.get('UPLOAD_FORMAT', 'jpeg'),
+        'upload_target_bytes': target_kb * 1024 or None
+    }
+
+
 def start_capture():
-    capture_video.init(os.environ.get('DISPLAY_VIDEO') == '1', 10, None)
+    capture_video.init(os.environ.get('DISPLAY_VIDEO') == '1', input=None, **get_frame_rate_conf(), **get_upload_conf(),
+                       threaded=os.environ.get('THREADED_CAPTURE', '1') == '1',
+                       motion_detector=os.environ.get('MOTION_DETECTOR', 'diff'),
+                       face_detector=os.environ.get('FACE_DETECTOR', 'haar'),
+                       record_clips=os.environ.get('RECORD_CLIPS') == '1')
     # capture_video.init(True, 600, "test1.mp4")
 
     logger.info("Initialized successfully. Start capturing...")
     capture_video.capture()
 
 
+def start_cameras(camera_indexes):
+    # Every camera runs in its own process, sharing this process's MQTT connection and uploader
+    from device.supervisor import Supervisor
+
+    supervisor = Supervisor([{
+        'camera_id': str(camera_index),
+        'display': False,
+        'input': None,
+        **get_frame_rate_conf(),
+        **get_upload_conf(),
+        'camera_index': camera_index,
+        'threaded': os.environ.get('THREADED_CAPTURE', '1') == '1',
+        'motion_detector': os.environ.get('MOTION_DETECTOR', 'diff'),
+        'face_detector': os.environ.get('FACE_DETECTOR', 'haar'),
+        'record_clips': os.environ.get('RECORD_CLIPS') == '1',
+        'clips_dir': f"clips/camera_{camera_index}"
+    } for camera_index in camera_indexes])
+    supervisor.start()
+    supervisor.run()
+
+
 if __name__ == '__main__':
     init_logger()
+    start_metrics()
     mqtt.Mqtt().connect({'topic': 'to/device/raspberrypi_edi'})
-    start_capture()
+    mqtt.Mqtt().configure_publishing(float(os.environ.get('MQTT_COALESCE_SEC', '0')), os.environ.get('MQTT_ENCODING', mqtt.ENCODING_JSON))
+
+    # e.g. CAMERAS=0,1 to capture from /dev/video0 and /dev/video1
+    cameras = [int(camera) for camera in os.environ.get('CAMERAS', '0').split(',')]
+    if len(cameras) > 1:
+        start_cameras(cameras)
+    else:
+        start_capture()
@@ -0,0 +1,240 @@
+import time
+import queue
+import logging
+import threading
+import multiprocessing
+from functools import partial
+from concurrent.futures import Future
+from typing import List, Optional, Callable, Dict
+
+from device.mqtt import Mqtt
+from device.frames_sender import get_uploader
+from device import metrics
+
+
+logger = logging.getLogger(__name__)
+
+CAMERA_RESTART_DELAY_SEC = 5
+CAMERA_RESTART_MAX_DELAY_SEC = 5 * 60
+# A camera that ran for this long before dying is restarted after the initial delay again
+CAMERA_HEALTHY_RUN_SEC = 10 * 60
+
+
+class MqttProxy:
+    """
+    Stands in for the Mqtt connection inside a camera process.
+    Published messages are tagged with the camera id and passed to the supervisor, which publishes them on the shared connection.
+    Messages from the backend are routed back by the supervisor to the camera's inbox.
+    """
+    OnMessageCallback = Callable[[str, dict], None]
+
+    def __init__(self, camera_id: str, thing_name: str, outbox: multiprocessing.Queue, inbox: multiprocessing.Queue):
+        self.camera_id = camera_id
+        self.thing_name = thing_name
+        self.outbox = outbox
+        self.inbox = inbox
+        self.callbacks: List[MqttProxy.OnMessageCallback] = []
+
+        threading.Thread(target=self._receive, name='mqtt_proxy', daemon=True).start()
+
+    def register_callback(self, callback: OnMessageCallback):
+        self.callbacks.append(callback)
+
+    def send(self, topic, msg, coalesce: bool = False):
+        self.outbox.put(('publish', topic, {**msg, 'camera_id': self.camera_id}, coalesce))
+
+    def _receive(self):
+        while True:
+            topic, msg = self.inbox.get()
+            for callback in self.callbacks:
+                callback(topic, msg)
+
+
+class UploaderProxy:
+    """
+    Stands in for the FramesUploader inside a camera process. The encoded frames are passed to the supervisor,
+    which uploads them through the shared uploader (one pooled HTTP session for all the cameras).
+    The returned futures resolve when the supervisor acks the upload - with the uploader's result, or with its error.
+    """
+    def __init__(self, camera_id: str, outbox: multiprocessing.Queue, acks: multiprocessing.Queue):
+        self.camera_id = camera_id
+        self.outbox = outbox
+        self.acks = acks
+        self.lock = threading.Lock()
+        self.futures: Dict[int, Future] = {}
+        self.next_upload_id = 0
+
+        threading.Thread(target=self._receive_acks, name='uploader_proxy', daemon=True).start()
+
+    def submit(self, upload_url_data: dict, data: bytes) -> Future:
+        future = Future()
+        with self.lock:
+            upload_id = self.next_upload_id
+            self.next_upload_id += 1
+            self.futures[upload_id] = future
+
+        self.outbox.put(('upload', self.camera_id, upload_id, upload_url_data, data))
+
+        return future
+
+    def _receive_acks(self):
+        while True:
+            upload_id, result, error = self.acks.get()
+            with self.lock:
+                future = self.futures.pop(upload_id, None)
+            if future is None:
+                continue
+
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(RuntimeError(f"Upload failed in the supervisor. {error}"))
+
+
+def run_camera(camera_config: dict, thing_name: str, outbox: multiprocessing.Queue, inbox: multiprocessing.Queue,
+               acks: multiprocessing.Queue) -> None:
+    """
+    Entry point of a camera process. The module state of capture_video / objects_monitor is per process,
+    so every camera has its own pipeline, frame buffer and activity state.
+    """
+    from device import capture_video
+    from device.start import init_logger, start_metrics
+
+    init_logger()
+    camera_config = dict(camera_config)
+    camera_id = camera_config.pop('camera_id')
+    start_metrics(camera_id, forward=lambda metrics_snapshot: outbox.put(('metrics', camera_id, metrics_snapshot)))
+    capture_video.init(**camera_config,
+                       mqtt=MqttProxy(camera_id, thing_name, outbox, inbox),
+                       uploader=UploaderProxy(camera_id, outbox, acks))
+
+    logger.info(f"Camera {camera_id} initialized successfully. Start capturing...")
+    capture_video.capture()
+
+
+class Supervisor:
+    """
+    Runs every camera in its own process (so a multi core device runs several camera feeds in parallel)
+    and shares the single MQTT connection and the single uploader of this process between them.
+    A camera process that dies (crashes, or gets killed) is restarted, with a growing delay if it keeps dying.
+    A camera that exits normally (e.g. the end of a video file) isn't restarted.
+    Every camera process gets its own queues (see _start_camera), and the requests of all the outboxes are gathered
+    by a thread per outbox into a local (in process) queue served by run().
+    camera_configs - capture_video.init keyword arguments of each camera, plus a unique 'camera_id'
+    """
+    def __init__(self, camera_configs: List[dict]):
+        self.camera_configs = {camera_config['camera_id']: camera_config for camera_config in camera_configs}
+        self.context = multiprocessing.get_context('spawn')
+        self.requests = queue.Queue()
+        self.outboxes = {}
+        self.inboxes = {}
+        self.acks = {}
+        self.processes = {}
+        self.started_at = {}
+        self.restart_delays = {}
+        self.restart_at = {}
+        self.restarts = 0
+        self.running = False
+
+    def start(self) -> None:
+        Mqtt().register_callback(self._route)
+
+        for camera_id in self.camera_configs:
+            self._start_camera(camera_id)
+
+        self.running = True
+
+    def run(self) -> None:
+        """
+        Serve the cameras' publish and upload requests until all the camera processes exit
+        """
+        uploader = get_uploader()
+        while self.running:
+            self._restart_dead_cameras()
+            if not self.processes:
+                break
+
+            try:
+                request = self.requests.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            if request[0] == 'publish':
+                _, topic, msg, coalesce = request
+                Mqtt().send(topic, msg, coalesce=coalesce)
+            elif request[0] == 'upload':
+                _, camera_id, upload_id, upload_url_data, data = request
+                uploader.submit(upload_url_data, data).add_done_callback(partial(self._ack, self.acks[camera_id], upload_id))
+            elif request[0] == 'metrics':
+                _, camera_id, metrics_snapshot = request
+                metrics.set_remote_snapshot(camera_id, metrics_snapshot)
+
+        logger.info(f"All cameras finished. Restarts: {self.restarts}, uploads: {uploader.stats()}")
+
+    def stop(self) -> None:
+        self.running = False
+        for process in self.processes.values():
+            process.terminate()
+            process.join()
+
+    def _start_camera(self, camera_id: str) -> None:
+        # New queues for every run, not shared with the other cameras - a queue may be left locked by a process that was killed
+        # while using it, and it shouldn't block the rest of the cameras
+        self.outboxes[camera_id] = self.context.Queue()
+        self.inboxes[camera_id] = self.context.Queue()
+        self.acks[camera_id] = self.context.Queue()
+        threading.Thread(target=self._forward_requests, args=(camera_id, self.outboxes[camera_id]),
+                         name=f"outbox_{camera_id}", daemon=True).start()
+        process = self.context.Process(target=run_camera, name=f"camera_{camera_id}",
+                                       args=(self.camera_configs[camera_id], Mqtt().thing_name, self.outboxes[camera_id],
+                                             self.inboxes[camera_id], self.acks[camera_id]))
+        process.start()
+        self.processes[camera_id] = process
+        self.started_at[camera_id] = time.time()
+        logger.info(f"Started camera {camera_id} (pid {process.pid})")
+
+    def _restart_dead_cameras(self) -> None:
+        now = time.time()
+        for camera_id, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+
+            if camera_id in self.restart_at:
+                if now >= self.restart_at[camera_id]:
+                    del self.restart_at[camera_id]
+                    self.restarts += 1
+                    self._start_camera(camera_id)
+            elif process.exitcode == 0:
+                logger.info(f"Camera {camera_id} finished")
+                del self.processes[camera_id]
+            else:
+                # Back off when the camera dies again right after starting (e.g. the camera is disconnected)
+                if now - self.started_at[camera_id] >= CAMERA_HEALTHY_RUN_SEC:
+                    self.restart_delays[camera_id] = CAMERA_RESTART_DELAY_SEC
+                else:
+                    self.restart_delays[camera_id] = min(CAMERA_RESTART_MAX_DELAY_SEC,
+                                                         self.restart_delays.get(camera_id, CAMERA_RESTART_DELAY_SEC / 2) * 2)
+                self.restart_at[camera_id] = now + self.restart_delays[camera_id]
+                logger.error(f"Camera {camera_id} died (exit code {process.exitcode}). "
+                             f"Restarting in {self.restart_delays[camera_id]} seconds")
+
+    def _forward_requests(self, camera_id: str, outbox: multiprocessing.Queue) -> None:
+        # Until the camera is restarted with a new outbox - the outbox of a dead camera is abandoned
+        while self.outboxes.get(camera_id) is outbox:
+            try:
+                self.requests.put(outbox.get(timeout=1))
+            except queue.Empty:
+                continue
+
+    @staticmethod
+    def _ack(acks: multiprocessing.Queue, upload_id: int, future: Future) -> None:
+        # Runs on the uploader's worker thread
+        error = future.exception()
+        acks.put((upload_id, future.result() if error is None else None, None if error is None else str(error)))
+
+    def _route(self, topic: str, msg: dict) -> None:
+        # Replies of the backend carry the camera id of the report. Messages without one go to all the cameras
+        camera_id: Optional[str] = msg.get('camera_id')
+        for inbox_camera_id, inbox in self.inboxes.items():
+            if camera_id is None or camera_id == inbox_camera_id:
+                inbox.put((topic, msg))
@@ -0,0 +1,169 @@
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Any
+
+import cv2
+from numpy import ndarray
+
+from device.common import FrameObject
+from device.face_detection import is_inside_objects
+
+
+OPENCV_TRACKERS = ('mosse', 'kcf', 'csrt')
+
+
+@dataclass
+class Track:
+    track_id: int
+    face: FrameObject
+    misses: int = 0
+    hits: int = 1
+    opencv_tracker: Optional[Any] = None
+
+
+def iou(a: FrameObject, b: FrameObject) -> float:
+    x1 = max(a.x, b.x)
+    y1 = max(a.y, b.y)
+    x2 = min(a.x + a.w, b.x + b.w)
+    y2 = min(a.y + a.h, b.y + b.h)
+    intersection = max(0, x2 - x1) * max(0, y2 - y1)
+    union = a.w * a.h + b.w * b.h - intersection
+
+    return intersection / union if union > 0 else 0.0
+
+
+def create_opencv_tracker(name: str) -> Any:
+    # Depending on the OpenCV build, the trackers are either in cv2 or in cv2.legacy (and MOSSE exists only with contrib)
+    factory_name = f"Tracker{name.upper()}_create"
+    for module in (getattr(cv2, 'legacy', None), cv2):
+        if module is not None and hasattr(module, factory_name):
+            return getattr(module, factory_name)()
+
+    raise ValueError(f"OpenCV tracker '{name}' isn't available in this OpenCV build")
+
+
+class FaceTracker:
+    """
+    Associates the detected faces across frames (greedy IoU matching) and gives each face a stable track id.
+    The full face detection runs only every detect_interval frames, or earlier when there are no tracks or a track is lost.
+    In between, tracks are propagated cheaply - either with an OpenCV tracker (mosse / kcf / csrt), or by keeping the last box
+    as long as it's still inside a motion box.
+    update() returns only the faces that are actually seen (detected or tracked). The faces missed by the last detection are
+    coasted - their last box is kept in coasted_faces while it's still inside a motion box, so they aren't scored as fresh faces,
+    but a person isn't blurred out of the uploaded frame just because one detection pass didn't find their face.
+    """
+    def __init__(self, detector: Any, detect_interval: int = 5, iou_threshold: float = 0.3, max_misses: int = 5,
+                 opencv_tracker: Optional[str] = None):
+        if opencv_tracker:
+            # Fail early if the tracker isn't available
+            create_opencv_tracker(opencv_tracker)
+
+        self.detector = detector
+        self.detect_interval = max(1, detect_interval)
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.opencv_tracker = opencv_tracker
+
+        self.tracks: Dict[int, Track] = {}
+        self.next_track_id = 1
+        self.frames_since_detection = 0
+        self.force_detection = True
+        self.coasted_faces: List[FrameObject] = []
+
+        # Counters
+        self.frames = 0
+        self.detections = 0
+
+    def update(self, frame: ndarray, detected_objects: List[FrameObject]) -> List[FrameObject]:
+        """
+        Returns the faces of the current frame (with their track ids). The coasted faces of the frame are in coasted_faces
+        """
+        self.frames += 1
+        self.frames_since_detection += 1
+
+        if not detected_objects:
+            # Nothing moves, so the tracks are still where they were - keep them as is (without aging them), and verify them with
+            # a full detection as soon as something moves again. No faces are returned, the frame isn't monitored anyway
+            self.force_detection = True
+            self.coasted_faces = []
+            return []
+
+        if self.force_detection or not self.tracks or self.frames_since_detection >= self.detect_interval:
+            self._detect(frame, detected_objects)
+        else:
+            self._propagate(frame, detected_objects)
+
+        self.coasted_faces = [track.face for track in self.tracks.values()
+                              if track.misses > 0 and is_inside_objects(track.face, detected_objects)]
+
+        return [track.face for track in self.tracks.values() if track.misses == 0]
+
+    def stats(self) -> dict:
+        return {
+            'frames': self.frames,
+            'detections': self.detections,
+            'active_tracks': len(self.tracks),
+            'total_tracks': self.next_track_id - 1
+        }
+
+    def _detect(self, frame: ndarray, detected_objects: List[FrameObject]) -> None:
+        faces = self.detector.detect(frame, detected_objects)
+        self.detections += 1
+        self.frames_since_detection = 0
+        self.force_detection = False
+
+        # Greedy matching, best overlapping pairs first
+        pairs = sorted(((iou(track.face, face), track_id, i) for track_id, track in self.tracks.items() for i, face in enumerate(faces)),
+                       key=lambda pair: pair[0], reverse=True)
+        matched_tracks = set()
+        matched_faces = set()
+        for overlap, track_id, i in pairs:
+            if overlap < self.iou_threshold:
+                break
+            if track_id in matched_tracks or i in matched_faces:
+                continue
+            matched_tracks.add(track_id)
+            matched_faces.add(i)
+
+            track = self.tracks[track_id]
+            track.misses = 0
+            track.hits += 1
+            self._set_face(track, frame, faces[i])
+
+        for track_id in set(self.tracks.keys()) - matched_tracks:
+            self._miss(self.tracks[track_id])
+
+        for i, face in enumerate(faces):
+            if i not in matched_faces:
+                track = Track(track_id=self.next_track_id, face=face)
+                self.next_track_id += 1
+                self.tracks[track.track_id] = track
+                self._set_face(track, frame, face)
+
+    def _propagate(self, frame: ndarray, detected_objects: List[FrameObject]) -> None:
+        for track in list(self.tracks.values()):
+            if track.misses:
+                continue
+
+            if track.opencv_tracker is not None:
+                ok, (x, y, w, h) = track.opencv_tracker.update(frame)
+                if ok:
+                    x, y, w, h = int(x), int(y), int(w), int(h)
+                    track.face = FrameObject(x, y, w, h, w * h, track.track_id)
+                    continue
+            elif is_inside_objects(track.face, detected_objects):
+                continue
+
+            # Lost the track, detect again on the next frame
+            self._miss(track)
+            self.force_detection = True
+
+    def _set_face(self, track: Track, frame: ndarray, face: FrameObject) -> None:
+        track.face = FrameObject(face.x, face.y, face.w, face.h, face.area, track.track_id)
+        if self.opencv_tracker:
+            track.opencv_tracker = create_opencv_tracker(self.opencv_tracker)
+            track.opencv_tracker.init(frame, (face.x, face.y, face.w, face.h))
+
+    def _miss(self, track: Track) -> None:
+        track.misses += 1
+        if track.misses > self.max_misses:
+            del self.tracks[track.track_id]
@@ -1,71 +1,143 @@
-from typing import List
+import sys
+from typing import List, Optional, Tuple
 
 import cv2
 from device.common import FrameObject
+from device.face_detection import FaceDetector, HaarFaceDetector
 from numpy import ndarray
 
 
 UNBLURRED_FACE_MARGIN_PERCENT = 0.35
+MOTION_WORKING_WIDTH = 320
+MOTION_MIN_AREA = 10000  # In full resolution pixels
+MOTION_DILATE_ITERATIONS = 20  # Of a 3x3 kernel, in full resolution
+
+BLUR_METHOD_DOWNSCALE = 'downscale'
+BLUR_METHOD_BOX = 'box'
+BLUR_METHOD_GAUSSIAN = 'gaussian'
+BLUR_KERNEL_SIZE = 51  # Gaussian kernel size in full resolution
+BLUR_DOWNSCALE_FACTOR = 4
+BLUR_BOX_SIZE = 17  # 3 passes of a 17x17 box filter are close to a 51x51 gaussian (sigma 8)
+BLUR_BOX_PASSES = 3
+
+this = sys.modules[__name__]
+this.face_detector = None
+this.dilate_kernels = {}
+
+
+def detect_motion(prev_frame: ndarray, cur_frame: ndarray, draw: bool = False,
+                  working_width: Optional[int] = MOTION_WORKING_WIDTH) -> List[FrameObject]:
+    """
+    Frame differencing motion detection.
+    The moving pixels are found in full resolution as before (thin edges of slow objects would fade away in a downscaled diff),
+    but the expensive part - dilating and finding the contours - works on the motion mask downscaled to working_width pixels wide,
+    using a single morphological kernel equivalent to MOTION_DILATE_ITERATIONS 3x3 dilations and an area threshold scaled to the
+    working resolution. Returned boxes are in full resolution coordinates.
+    python -m device.motion_benchmark checks it's equivalent to the original implementation.
+    """
+    scale = get_motion_scale(cur_frame, working_width)
 
-
-def detect_motion(prev_frame: ndarray, cur_frame: ndarray, draw: bool = False) -> List[FrameObject]:
     # Diff between this and previous frame
-    diff = cv2.absdiff(prev_frame, cur_frame)
+    detected_objects = find_motion_objects(get_frames_motion_mask(prev_frame, cur_frame, scale), scale)
+
+    if draw:
+        # Draw a bounding box around the moving objects
+        draw_objects_in_frame(prev_frame, detected_objects)
+
+    return detected_objects
+
+
+def get_frames_motion_mask(prev_frame: ndarray, cur_frame: ndarray, scale: float) -> ndarray:
+    """
+    The binary motion mask (255 = moving) of two full resolution frames, downscaled by scale
+    """
+    # The diff is taken before the gray conversion, so color changes of the same brightness are still motion
+    diff = cv2.cvtColor(cv2.absdiff(prev_frame, cur_frame), cv2.COLOR_BGR2GRAY)
+
+    return downscale_motion_mask(threshold_motion_diff(diff, 1.0), scale)
+
+
+def downscale_motion_mask(motion_mask: ndarray, scale: float) -> ndarray:
+    # A working resolution pixel is moving if any of its full resolution pixels is moving (like dilating before downscaling)
+    if scale < 1.0:
+        motion_mask = cv2.resize(motion_mask, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        _, motion_mask = cv2.threshold(motion_mask, 0, 255, cv2.THRESH_BINARY)
+
+    return motion_mask
+
 
-    # Convert the diff to gray scale and blur in order to amplify the diff between the moving objects
-    # All the non moving objects will be dark
-    gray = cv2.cvtColor(diff, cv2.COLOR_BGR2GRAY)
-    blur = cv2.GaussianBlur(gray, (5, 5), 0)
+def threshold_motion_diff(diff: ndarray, scale: float) -> ndarray:
+    # Blur the diff in order to amplify the diff between the moving objects. All the non moving objects will be dark
+    blur_size = max(3, int(5 * scale) | 1)
+    blur = cv2.GaussianBlur(diff, (blur_size, blur_size), 0)
 
-    # Remove non moving objects and dilate the moving ones
+    # Remove non moving objects
     _, thresh = cv2.threshold(blur, 20, 255, cv2.THRESH_BINARY)
-    dilated = cv2.dilate(thresh, None, iterations=20)
+
+    return thresh
+
+
+def find_motion_objects(motion_mask: ndarray, scale: float, min_area: int = MOTION_MIN_AREA) -> List[FrameObject]:
+    """
+    Dilate the moving pixels of a (downscaled) binary motion mask and return the bounding boxes of the large enough moving objects
+    in full resolution coordinates.
+    min_area is in full resolution pixels.
+    """
+    dilated = cv2.dilate(motion_mask, get_dilate_kernel(scale))
 
     # Draw contours across the (moving) objects that are in the remainng image after all filters
     contours, _ = cv2.findContours(dilated, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
 
     detected_objects = []
 
-    for i, contour in enumerate(contours):
+    scaled_min_area = min_area * scale * scale
+    for contour in contours:
         # Get the area of the contour and ignore small moving objects
         area = cv2.contourArea(contour)
-        if area > 10000:
-            # Draw the contour
-            # cv2.drawContours(prev_frame, contours, i, (0, 255, 0), 2)
-
+        if area > scaled_min_area:
+            # Map the bounding box back to full resolution
             x, y, w, h = cv2.boundingRect(contour)
-            detected_objects.append(FrameObject(x, y, w, h, area))
-
-            if draw:
-                # Draw a bounding box around the contour
-                cv2.rectangle(prev_frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
+            x, y, w, h = int(x / scale), int(y / scale), int(w / scale), int(h / scale)
+            detected_objects.append(FrameObject(x, y, w, h, area / (scale * scale)))
 
     return detected_objects
 
 
-def detect_faces(frame: ndarray, detected_objects: List[FrameObject], draw: bool = False) -> List[FrameObject]:
-    face_cascade = cv2.CascadeClassifier('device/haarcascade_frontalface_default.xml')
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    faces = face_cascade.detectMultiScale(gray, 1.1, 4)
+def get_motion_scale(frame: ndarray, working_width: Optional[int]) -> float:
+    if not working_width:
+        return 1.0
+
+    return min(1.0, working_width / frame.shape[1])
+
+
+def prepare_motion_frame(frame: ndarray, scale: float) -> ndarray:
+    if scale < 1.0:
+        frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
 
-    detected_faces = []
+def get_dilate_kernel(scale: float) -> ndarray:
+    # N iterations of a 3x3 dilation are equal to a single (2N+1)x(2N+1) dilation
+    size = 2 * max(1, round(MOTION_DILATE_ITERATIONS * scale)) + 1
+    if size not in this.dilate_kernels:
+        this.dilate_kernels[size] = cv2.getStructuringElement(cv2.MORPH_RECT, (size, size))
 
-    for (x, y, w, h) in faces:
-        # Check if the detected face is moving (and not just some false positive of a static object)
-        # Do this by going through all detected objects and checking if the center of the face is inside the bounds of any of those objects
-        center_face_x = int(x + w/2)
-        center_face_y = int(y + h/2)
-        for detected_object in detected_objects:
-            if detected_object.x < center_face_x < detected_object.x + detected_object.w \
-                    and detected_object.y < center_face_y < detected_object.y + detected_object.h:
-                break
-        else:
-            continue
+    return this.dilate_kernels[size]
 
-        detected_faces.append(FrameObject(x, y, w, h, w * h))
 
-        if draw:
-            cv2.rectangle(frame, (x, y), (x + w, y + h), (255, 0, 0), 2)
+def detect_faces(frame: ndarray, detected_objects: List[FrameObject], draw: bool = False,
+                 detector: Optional[FaceDetector] = None) -> List[FrameObject]:
+    if detector is None:
+        # Load the cascade only once and reuse it on all the next frames
+        if this.face_detector is None:
+            this.face_detector = HaarFaceDetector()
+        detector = this.face_detector
+
+    detected_faces = detector.detect(frame, detected_objects)
+
+    if draw:
+        draw_objects_in_frame(frame, detected_faces, (255, 0, 0))
 
     # if len(detected_faces) > 0:
     #     print(f"Detected {len(detected_faces)} faces")
@@ -73,8 +145,44 @@ def detect_faces(frame: ndarray, detected_objects: List[FrameObject], draw: bool
     return detected_faces
 
 
-def blur(frame: ndarray, faces: List[FrameObject]) -> ndarray:
-    def get_face_range(face, frame):
+def blur(frame: ndarray, faces: List[FrameObject], out: Optional[ndarray] = None, method: str = BLUR_METHOD_DOWNSCALE) -> ndarray:
+    """
+    Blur the whole frame except the (margined) faces.
+    Methods:
+    * downscale - Blur a downscaled frame and upscale it back (default, cheapest)
+    * box - A few box filter passes approximating the gaussian blur (cost doesn't depend on the kernel size)
+    * gaussian - Full resolution gaussian blur
+    The result is written into out if it's given (it must have the frame's shape and dtype, and must not be the frame itself).
+    """
+    height, width = frame.shape[:2]
+
+    # Blur the whole image
+    if method == BLUR_METHOD_DOWNSCALE:
+        small = cv2.resize(frame, (max(1, width // BLUR_DOWNSCALE_FACTOR), max(1, height // BLUR_DOWNSCALE_FACTOR)),
+                           interpolation=cv2.INTER_AREA)
+        kernel_size = max(3, (BLUR_KERNEL_SIZE // BLUR_DOWNSCALE_FACTOR) | 1)
+        small = cv2.GaussianBlur(small, (kernel_size, kernel_size), 0)
+        frame_blurred = cv2.resize(small, (width, height), dst=out, interpolation=cv2.INTER_LINEAR)
+    elif method == BLUR_METHOD_BOX:
+        frame_blurred = cv2.blur(frame, (BLUR_BOX_SIZE, BLUR_BOX_SIZE), dst=out)
+        for _ in range(BLUR_BOX_PASSES - 1):
+            cv2.blur(frame_blurred, (BLUR_BOX_SIZE, BLUR_BOX_SIZE), dst=frame_blurred)
+    elif method == BLUR_METHOD_GAUSSIAN:
+        frame_blurred = cv2.GaussianBlur(frame, (BLUR_KERNEL_SIZE, BLUR_KERNEL_SIZE), 0, dst=out)
+    else:
+        raise ValueError(f"Unknown blur method '{method}'")
+
+    # Return the original faces to their places ontop of the blurred image
+    # The faces are copied straight from the (untouched) source frame, so there's no need to save them before blurring
+    for yfrom, yto, xfrom, xto in get_faces_ranges(frame, faces):
+        frame_blurred[yfrom:yto, xfrom:xto] = frame[yfrom:yto, xfrom:xto]
+
+    return frame_blurred
+
+
+def get_faces_ranges(frame: ndarray, faces: List[FrameObject]) -> List[Tuple[int, int, int, int]]:
+    ranges = []
+    for face in faces:
         margins_y = int(face.h * UNBLURRED_FACE_MARGIN_PERCENT)
         margins_x = int(face.w * UNBLURRED_FACE_MARGIN_PERCENT)
 
@@ -83,28 +191,9 @@ def blur(frame: ndarray, faces: List[FrameObject]) -> ndarray:
         xfrom = max(0, face.x - margins_x)
         xto = min(frame.shape[1], face.x + face.w + margins_x)
 
-        return yfrom, yto, xfrom, xto
+        ranges.append((yfrom, yto, xfrom, xto))
 
-    original_face_images = []
-
-    # Save original faces
-    for face in faces:
-        yfrom, yto, xfrom, xto = get_face_range(face, frame)
-        original_face_image = frame.copy()[yfrom:yto, xfrom:xto]
-        original_face_images.append(original_face_image)
-
-    # Blur the whole image
-    frame_blurred = cv2.GaussianBlur(frame, (51, 51), 0)
-
-    # Return the original faces to their places ontop of the blurred image
-    for i, face in enumerate(faces):
-        original_face_image = original_face_images[i]
-        yfrom, yto, xfrom, xto = get_face_range(face, frame)
-        frame_blurred[yfrom:yto, xfrom:xto] = original_face_image
-
-    # TODO - Bug - Check video with 2 faces - both of them should be blurred, and if 1 face detected and the other is not,
-
-    return frame_blurred
+    return ranges
 
 
 def draw_objects_in_frame(frame: ndarray, frame_objects: List[FrameObject], color: tuple = (0, 255, 0)):
@@ -122,7 +211,12 @@ def detect_door_opening():
 if __name__ == '__main__':
     # Read in image
     image = cv2.imread('/home/edi/code/smartguard/device/18_07_17.jpg')
-    blurred = blur(image, [FrameObject(x=384, y=183, w=97, h=97, area=9409)])
+    faces = [FrameObject(x=384, y=183, w=97, h=97, area=9409), FrameObject(x=100, y=100, w=80, h=80, area=6400)]
+    blurred = blur(image, faces)
+
+    # Every face is kept as is, even when the faces' ranges overlap
+    for yfrom, yto, xfrom, xto in get_faces_ranges(image, faces):
+        assert (blurred[yfrom:yto, xfrom:xto] == image[yfrom:yto, xfrom:xto]).all()
 
     cv2.imshow('blur', blurred)
     cv2.imshow('image', image)